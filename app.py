@@ -4,8 +4,9 @@
 Kindle Transfer App - Flask主应用
 私人版Kindle电子书传输应用
 """
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Request, render_template, request, jsonify, send_file
 import os
+import re
 import json
 from datetime import datetime
 from pathlib import Path
@@ -16,6 +17,8 @@ from dotenv import load_dotenv
 import logging
 import time
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # 加载.env文件
 load_dotenv()
@@ -32,13 +35,102 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # 导入工具模块
-from app.utils.pdf_converter import convert_pdf_to_epub
-from app.utils.kindle_sender import send_to_kindle
+from app.utils.pdf_converter import (
+    convert_pdf_to_epub, get_converter, epub_output_path, EPUB_OPTIONS, ConversionLimits, ConversionCancelled, CONVERT_TIMEOUT, CONVERT_CPU_LIMIT, CONVERT_MEMORY_LIMIT
+)
+from app.utils.txt_converter import convert_txt_to_epub
+from app.utils.kindle_sender import (
+    send_to_kindle,
+    send_to_kindle_recipients,
+    send_files_to_kindle,
+    estimate_send_volume,
+    max_attachment_size,
+    MAX_ATTACHMENTS_PER_EMAIL
+)
 from app.utils.file_helper import safe_filename, generate_unique_filename
+from app.utils.file_store import store_stream, SpooledUpload
+from app.utils.batch_upload import iter_multipart
+from app.utils.job_store import create_job, load_job, update_job, request_cancel, cancel_requested
+from app.utils.delivery_queue import (
+    enqueue, claim_batch, mark_sent, mark_failed, mark_cancelled, cancel_pending, defer, lease_owner, renew,
+    LEASE_RENEW_INTERVAL
+)
+from app.utils.rate_limiter import RateLimits
+from app.utils.account_pool import (
+    account_key,
+    classify_error,
+    choose_account,
+    get_health,
+    sending,
+    record_success,
+    record_failure
+)
+from app.utils.smtp_pool import is_transient_error, get_smtp_pool
+from app.utils.async_smtp import get_delivery_engine
+from app.utils.part_cache import configure_part_cache, PART_CACHE_SIZE
+from app.utils.convert_pool import (
+    configure_convert_pool, get_convert_pool, ConversionQueueFull, CONVERT_QUEUE_SIZE, CONVERT_NICENESS
+)
+from app.utils.convert_cache import configure_convert_cache, get_convert_cache, CONVERT_CACHE_SIZE
+from app.utils.mime_stream import binary_supported
+from app.utils.content_encoding import DecompressMiddleware, supported_encodings
+from app.utils.upload_guard import (
+    UploadRejected, magic_validator, MULTIPART_OVERHEAD, SNIFF_SIZE
+)
+from app.utils.chunked_upload import (
+    create_upload_session, get_upload_status, write_chunk, finalize_upload, load_finalized,
+    read_head, discard_upload
+)
+
+def create_upload_container(filename, max_bytes=None):
+    """
+    为上传的文件创建暂存容器
+    
+    扩展名在读取文件内容之前检查，文件头和大小在接收过程中检查
+    """
+    if filename and not allowed_file(filename):
+        logger.error(f"[PREFLIGHT] 不支持的文件格式: {filename}")
+        raise UploadRejected('不支持的文件格式')
+    
+    validator = None
+    if filename and app.config.get('SNIFF_UPLOAD_CONTENT', True):
+        validator = magic_validator(filename)
+    
+    return SpooledUpload(app.config['UPLOAD_FOLDER'], validator=validator, max_bytes=max_bytes)
+
+class UploadRequest(Request):
+    """上传文件在解析表单时直接写入上传目录内的暂存区，保存时只需重命名"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._spools = []
+    
+    @property
+    def max_content_length(self):
+        # 批量接口一次上传多个文件，使用单独的请求体上限
+        if self.endpoint == 'batch_process':
+            return app.config['BATCH_MAX_CONTENT_LENGTH']
+        return app.config['MAX_CONTENT_LENGTH']
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        max_bytes = upload_size_limit() if self.endpoint in SEND_ENDPOINTS else None
+        container = create_upload_container(filename, max_bytes)
+        self._spools.append(container)
+        return container
+    
+    def close(self):
+        # 请求体读取中途失败（如解压后超限）时，文件不会进入 request.files，在这里删除暂存文件
+        for container in self._spools:
+            container.close()
+        super().close()
 
 app = Flask(__name__, 
             template_folder='app/templates',
             static_folder='app/static')
+app.request_class = UploadRequest
+# 解压 Content-Encoding: gzip/zstd 的请求体
+app.wsgi_app = DecompressMiddleware(app.wsgi_app)
 
 # 添加请求日志
 @app.before_request
@@ -47,11 +139,83 @@ def log_request_info():
     logger.info(f'Body Size: {request.content_length}')
     logger.info(f'Method: {request.method}, Path: {request.path}')
 
+# 上传后直接发送到Kindle的接口，文件大小受邮件限制
+SEND_ENDPOINTS = {'api_send_to_kindle', 'process_file'}
+
+def upload_size_limit():
+    """
+    上传时可接受的最大附件（原始字节数）
+    
+    发件服务器在之前的连接中支持二进制传输（BINARYMIME）时按原始大小计算，
+    否则（包括还没有连接过）按base64编码后的大小计算
+    """
+    accounts = get_sender_accounts(load_config())
+    binary = any(binary_supported(account['smtp_server'], account['smtp_port']) for account in accounts)
+    return max_attachment_size(binary=binary)
+
+@app.before_request
+def preflight_upload():
+    """在读取请求体之前按Content-Length拒绝超过邮件限制的上传"""
+    if request.endpoint not in SEND_ENDPOINTS or request.content_length is None:
+        return None
+    
+    max_size = upload_size_limit()
+    limit = max_size + MULTIPART_OVERHEAD
+    if request.content_length > limit:
+        logger.error(f"[PREFLIGHT] 请求体 {request.content_length} 字节超过可发送上限 {limit} 字节")
+        raise UploadRejected(
+            f'文件过大：Kindle邮件限制50MB（按传输编码后计算），'
+            f'可发送的文件最大约 {max_size / 1024 / 1024:.1f}MB',
+            code=413
+        )
+    return None
+
+@app.before_request
+def start_delivery_workers():
+    """
+    确保本进程的发送线程已启动，继续处理重启前队列中未完成的任务
+    
+    gunicorn 的 post_fork 在工作进程启动时调用，不必等到收到请求；收到请求时再检查一次
+    （直接用 Flask 运行或未使用 gunicorn 配置时）
+    """
+    configure_part_cache(os.path.join(app.config['UPLOAD_FOLDER'], '.partcache'),
+                         app.config['PART_CACHE_SIZE'])
+    configure_convert_pool(os.path.join(app.config['UPLOAD_FOLDER'], '.convert'),
+                           app.config['CONVERT_WORKERS'], app.config['CONVERT_QUEUE_SIZE'],
+                           app.config['CONVERT_NICENESS'])
+    configure_convert_cache(os.path.join(app.config['UPLOAD_FOLDER'], '.convertcache'),
+                            app.config['CONVERT_CACHE_SIZE'])
+    ensure_delivery_workers()
+
+@app.errorhandler(UploadRejected)
+def handle_upload_rejected(e):
+    """预检拒绝时返回JSON，同时提供message和error两种字段以兼容各接口"""
+    return jsonify({'success': False, 'message': e.description, 'error': e.description}), e.code
+
 # 配置
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'epub', 'mobi', 'txt', 'doc', 'docx'}
 app.config['CONVERT_PDF_TO_EPUB'] = False  # 是否转换PDF到EPUB，False则直接发送PDF
+app.config['CONVERT_TXT_TO_EPUB'] = os.getenv('CONVERT_TXT_TO_EPUB', 'false').lower() == 'true'  # 是否将TXT转换为EPUB（内置转换，不需要Calibre）
+app.config['SNIFF_UPLOAD_CONTENT'] = True  # 是否按文件头魔数校验上传内容
+app.config['BATCH_MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 批量上传请求体上限 1GB
+app.config['BATCH_SEND_WORKERS'] = 2  # 批量上传时同时转换/发送的文件数
+app.config['JOB_WORKERS'] = 2  # 每个工作进程执行后台发送任务的线程数
+app.config['DELIVERY_POLL_INTERVAL'] = 5  # 发送线程检查队列的间隔（秒）
+app.config['SMTP_MESSAGES_PER_MINUTE'] = 10  # 每个发件账号每分钟最多发送的邮件数（0为不限制）
+app.config['SMTP_BYTES_PER_HOUR'] = 1024 * 1024 * 1024  # 每个发件账号每小时最多发送的字节数（0为不限制）
+app.config['SEND_RATE_MAX_WAIT'] = 30  # 同步发送达到速率限制时最多等待的秒数
+app.config['SMTP_ENGINE'] = os.getenv('SMTP_ENGINE', 'threads')  # SMTP发送方式：threads（smtplib）或 asyncio（单线程事件循环）
+app.config['PART_CACHE_SIZE'] = int(os.getenv('PART_CACHE_SIZE', PART_CACHE_SIZE))  # 已编码附件缓存的上限（字节，0为不缓存）
+app.config['CONVERT_WORKERS'] = int(os.getenv('CONVERT_WORKERS', 0))  # 整台机器同时运行的格式转换数（0为CPU数）
+app.config['CONVERT_QUEUE_SIZE'] = int(os.getenv('CONVERT_QUEUE_SIZE', CONVERT_QUEUE_SIZE))  # 每个工作进程最多排队等待的转换数
+app.config['CONVERT_NICENESS'] = int(os.getenv('CONVERT_NICENESS', CONVERT_NICENESS))  # 转换进程的nice值（越大优先级越低）
+app.config['CONVERT_RETRY_DELAY'] = 30  # 转换排队已满时建议重试的间隔（秒）
+app.config['CONVERT_CACHE_SIZE'] = int(os.getenv('CONVERT_CACHE_SIZE', CONVERT_CACHE_SIZE))  # 转换结果缓存的上限（字节，0为不缓存）
+app.config['CONVERT_TIMEOUT'] = int(os.getenv('CONVERT_TIMEOUT', CONVERT_TIMEOUT))  # 单次转换的最长耗时（秒，0为不限制）
+app.config['CONVERT_CPU_LIMIT'] = int(os.getenv('CONVERT_CPU_LIMIT', CONVERT_CPU_LIMIT))  # 单次转换的CPU时间上限（秒，0为不限制）
+app.config['CONVERT_MEMORY_LIMIT'] = int(os.getenv('CONVERT_MEMORY_LIMIT', CONVERT_MEMORY_LIMIT))  # 转换进程的内存上限（字节，0为不限制）
 
 # 配置文件路径
 CONFIG_FILE = 'config.json'
@@ -94,6 +258,24 @@ def save_config(config):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
 
+def save_upload(file):
+    """
+    将上传文件流式写入内容存储，并生成可读文件名
+    
+    相同内容只保存一份，重复上传时 stats['deduplicated'] 为 True
+    
+    Returns:
+        tuple: (保存的文件名, 文件路径, 写入统计)
+    """
+    if isinstance(file.stream, SpooledUpload):
+        # 解析表单时已写入暂存区并计算好摘要，直接重命名
+        return file.stream.commit(file.filename)
+    return store_stream(file.stream, app.config['UPLOAD_FOLDER'], file.filename)
+
+def get_sessions_dir():
+    """分块上传会话目录（位于上传目录内，保证完成时可以直接重命名）"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.sessions')
+
 @app.route('/')
 def index():
     """主页"""
@@ -108,6 +290,9 @@ def handle_config():
         # 隐藏密码
         if 'smtp_password' in config:
             config['smtp_password'] = '*' * 8
+        for account in config.get('smtp_accounts') or []:
+            if 'smtp_password' in account:
+                account['smtp_password'] = '*' * 8
         return jsonify(config)
     
     elif request.method == 'POST':
@@ -118,6 +303,15 @@ def handle_config():
         if data.get('smtp_password') == '*' * 8:
             data['smtp_password'] = current_config.get('smtp_password', '')
         
+        # 网页表单只提交单个发件账号，未提交 smtp_accounts 时保留原有的多账号配置
+        if 'smtp_accounts' not in data and current_config.get('smtp_accounts'):
+            data['smtp_accounts'] = current_config['smtp_accounts']
+        current_passwords = {account.get('smtp_email'): account.get('smtp_password', '')
+                             for account in current_config.get('smtp_accounts') or []}
+        for account in data.get('smtp_accounts') or []:
+            if account.get('smtp_password') == '*' * 8:
+                account['smtp_password'] = current_passwords.get(account.get('smtp_email'), '')
+        
         save_config(data)
         return jsonify({'success': True, 'message': '配置已保存'})
 
@@ -143,22 +337,19 @@ def upload_file():
     
     # 保存文件，保留原始文件名
     original_filename = file.filename
-    # 生成唯一且安全的文件名（保留中文）
-    filename = generate_unique_filename(original_filename, app.config['UPLOAD_FOLDER'])
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    
-    logger.info(f"[UPLOAD] 准备保存文件: {original_filename} -> {filepath}")
     
     try:
-        file.save(filepath)
-        logger.info(f"[UPLOAD] 文件保存成功: {filepath}")
+        # 生成唯一且安全的文件名（保留中文），流式写入磁盘
+        filename, filepath, stats = save_upload(file)
+        logger.info(f"[UPLOAD] 文件保存成功: {original_filename} -> {filepath}, "
+                    f"SHA-256: {stats['sha256']}, 重复内容: {stats['deduplicated']}")
     except Exception as e:
         logger.error(f"[UPLOAD] 文件保存失败: {e}")
         return jsonify({'success': False, 'message': f'文件保存失败: {str(e)}'}), 500
     
     # 获取文件信息
-    file_size = os.path.getsize(filepath) / 1024 / 1024  # MB
-    logger.info(f"[UPLOAD] 文件大小: {file_size:.2f}MB")
+    file_size = stats['bytes'] / 1024 / 1024  # MB
+    logger.info(f"[UPLOAD] 文件大小: {file_size:.2f}MB, 耗时: {stats['seconds']:.2f}秒, 速度: {stats['speed_mb_s']:.2f}MB/s")
     
     response = {
         'success': True,
@@ -167,7 +358,9 @@ def upload_file():
             'name': original_filename,  # 返回原始文件名
             'path': filepath,
             'size': round(file_size, 2),
-            'saved_as': filename  # 实际保存的文件名
+            'saved_as': filename,  # 实际保存的文件名
+            'sha256': stats['sha256'],
+            'deduplicated': stats['deduplicated']
         }
     }
     
@@ -193,7 +386,7 @@ def convert_file():
             if app.config.get('CONVERT_PDF_TO_EPUB', False):
                 # 转换为EPUB
                 logger.info("[CONVERT] 开始转换PDF到EPUB")
-                epub_path = convert_pdf_to_epub(filepath)
+                epub_path = run_conversion(filepath)
                 if epub_path and os.path.exists(epub_path):
                     logger.info(f"[CONVERT] 转换成功: {epub_path}")
                     return jsonify({
@@ -214,6 +407,19 @@ def convert_file():
                     'converted_path': filepath,
                     'format': 'PDF'
                 })
+        elif filepath.lower().endswith('.txt') and app.config['CONVERT_TXT_TO_EPUB']:
+            logger.info("[CONVERT] 开始转换TXT到EPUB")
+            epub_path = submit_txt_conversion(filepath)
+            if epub_path:
+                logger.info(f"[CONVERT] 转换成功: {epub_path}")
+                return jsonify({
+                    'success': True,
+                    'message': '转换成功',
+                    'converted_path': epub_path,
+                    'format': 'EPUB'
+                })
+            logger.error("[CONVERT] 转换失败")
+            return jsonify({'success': False, 'message': '转换失败'}), 500
         else:
             # 其他格式直接返回
             file_format = filepath.split('.')[-1].upper()
@@ -225,6 +431,9 @@ def convert_file():
                 'format': file_format
             })
     
+    except ConversionQueueFull as e:
+        logger.warning(f"[CONVERT] {e}")
+        return convert_busy_response(str(e))
     except Exception as e:
         logger.error(f"[CONVERT] 转换出错: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -242,40 +451,50 @@ def send_to_kindle_api():
         logger.error(f"[SEND] 文件不存在: {filepath}")
         return jsonify({'success': False, 'message': '文件不存在'}), 400
     
-    # 加载配置
+    # 加载配置（可以通过 kindle_emails 同时发送到多个Kindle邮箱）
     config = load_config()
+    if data.get('kindle_emails'):
+        config['kindle_email'] = ', '.join(split_kindle_emails(data['kindle_emails']))
     
     if not config.get('kindle_email'):
         logger.error("[SEND] 未配置Kindle邮箱")
         return jsonify({'success': False, 'message': '请先配置Kindle邮箱'}), 400
     
-    if not config.get('smtp_email') or not config.get('smtp_password'):
+    if not get_sender_accounts(config):
         logger.error("[SEND] 未配置发送邮箱")
         return jsonify({'success': False, 'message': '请先配置发送邮箱'}), 400
     
+    account, wait = acquire_send_slot(config, [filepath])
+    if account is None:
+        return rate_limited_response(wait)
+    
     try:
         # 发送文件
         logger.info(f"[SEND] 发送文件到: {config['kindle_email']}")
-        logger.info(f"[SEND] 使用SMTP: {config.get('smtp_server', 'smtp.163.com')}:{config.get('smtp_port', 465)}")
+        logger.info(f"[SEND] 使用SMTP: {account['smtp_email']} ({account['smtp_server']}:{account['smtp_port']})")
         
-        success = send_to_kindle(
-            kindle_email=config['kindle_email'],
-            sender_email=config['smtp_email'],
-            sender_password=config['smtp_password'],
-            file_path=filepath,
-            smtp_server=config.get('smtp_server', 'smtp.163.com'),
-            smtp_port=int(config.get('smtp_port', 465))
-        )
+        recipients = split_kindle_emails(config['kindle_email'])
+        errors = send_file_to_recipients(account, recipients, filepath)
         
-        if success:
+        if not any(errors.values()):
             logger.info("[SEND] 发送成功！")
-            return jsonify({
+            response = {
                 'success': True,
                 'message': '发送成功！请在Kindle上查收'
-            })
+            }
+            if len(recipients) > 1:
+                response['recipients'] = recipient_results(errors)
+            return jsonify(response)
+        elif len(recipients) > 1 and not all(errors.values()):
+            logger.warning(f"[SEND] 部分Kindle邮箱发送失败: {errors}")
+            return jsonify({'success': False, 'message': '部分Kindle邮箱发送失败',
+                            'recipients': recipient_results(errors)}), 207
         else:
             logger.error("[SEND] 发送失败")
-            return jsonify({'success': False, 'message': '发送失败，请检查配置'}), 500
+            response = {'success': False, 'message': '发送失败，请检查配置'}
+            if len(recipients) > 1:
+                response['recipients'] = recipient_results(errors)
+            return jsonify(response), 500
     
     except Exception as e:
         logger.error(f"[SEND] 发送出错: {str(e)}", exc_info=True)
@@ -328,51 +547,56 @@ def api_send_to_kindle():
         # 2. 获取配置
         config = load_config()
         
-        # 允许通过请求参数覆盖某些配置
-        if request.form.get('kindle_email'):
-            config['kindle_email'] = request.form.get('kindle_email')
+        # 允许通过请求参数覆盖某些配置（kindle_email 可以用逗号分隔多个，也可以重复 kindle_emails 字段）
+        kindle_emails = request.form.getlist('kindle_emails') or request.form.get('kindle_email')
+        if kindle_emails:
+            config['kindle_email'] = ', '.join(split_kindle_emails(kindle_emails))
         
         convert_pdf = request.form.get('convert_pdf', 'false').lower() == 'true'
         
         # 3. 保存文件
         original_filename = file.filename
-        filename = generate_unique_filename(original_filename, app.config['UPLOAD_FOLDER'])
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
+        filename, filepath, stats = save_upload(file)
         logger.info(f"[API-SEND] 保存文件: {original_filename} -> {filepath}")
-        file.save(filepath)
-        logger.info(f"[API-SEND] 文件保存成功，大小: {os.path.getsize(filepath) / (1024*1024):.2f}MB")
+        logger.info(f"[API-SEND] 文件保存成功，大小: {stats['bytes'] / (1024*1024):.2f}MB, 耗时: {stats['seconds']:.2f}秒")
+        
+        # 需要后台处理时立即返回任务ID
+        if wants_async():
+            error = check_send_config(config)
+            if error:
+                return jsonify({'success': False, 'error': error}), 400
+            return job_accepted_response(submit_send_job(filepath, original_filename, config, convert_pdf))
         
         # 4. 处理文件（可能需要转换）
         final_path = filepath
         converted = False
         
-        if filepath.lower().endswith('.pdf') and convert_pdf:
-            logger.info("[API-SEND] 开始转换PDF到EPUB")
+        if needs_conversion(filepath, convert_pdf):
+            logger.info("[API-SEND] 开始转换到EPUB")
             try:
-                epub_path = convert_pdf_to_epub(filepath)
-                if epub_path and os.path.exists(epub_path):
+                epub_path, converted, _ = convert_for_delivery(filepath, convert_pdf)
+                if converted:
                     final_path = epub_path
-                    converted = True
-                    logger.info(f"[API-SEND] PDF转换成功: {epub_path}")
+                    logger.info(f"[API-SEND] 转换成功: {epub_path}")
             except Exception as e:
-                logger.error(f"[API-SEND] PDF转换失败: {e}")
+                logger.error(f"[API-SEND] 转换失败: {e}")
         
         # 5. 发送到Kindle
         logger.info(f"[API-SEND] 准备发送文件到Kindle: {config['kindle_email']}")
-        logger.info(f"[API-SEND] 使用SMTP服务器: {config.get('smtp_server', 'smtp.163.com')}:{config.get('smtp_port', 465)}")
         logger.info(f"[API-SEND] 发送文件: {final_path}")
         
-        success = send_to_kindle(
-            kindle_email=config['kindle_email'],
-            sender_email=config['smtp_email'],
-            sender_password=config['smtp_password'],
-            file_path=final_path,
-            smtp_server=config.get('smtp_server', 'smtp.163.com'),
-            smtp_port=int(config.get('smtp_port', 465))
-        )
+        if not get_sender_accounts(config):
+            return jsonify({'success': False, 'error': '请先配置发送邮箱'}), 400
+        account, wait = acquire_send_slot(config, [final_path])
+        if account is None:
+            return rate_limited_response(wait, key='error')
+        logger.info(f"[API-SEND] 使用SMTP服务器: {account['smtp_email']} ({account['smtp_server']}:{account['smtp_port']})")
+        
+        recipients = split_kindle_emails(config['kindle_email'])
+        errors = send_file_to_recipients(account, recipients, final_path)
+        delivered = [email for email, error in errors.items() if error is None]
         
-        if success:
+        if delivered:
             response = {
                 'success': True,
                 'message': '文件已成功发送到Kindle',
@@ -380,20 +604,29 @@ def api_send_to_kindle():
                     'original_filename': original_filename,
                     'file_size_mb': round(os.path.getsize(final_path) / 1024 / 1024, 2),
                     'converted_to_epub': converted,
-                    'sent_to': config['kindle_email'],
+                    'sent_to': ', '.join(delivered),
                     'format': 'EPUB' if converted else filepath.split('.')[-1].upper()
                 }
             }
+            if len(recipients) > 1:
+                response['recipients'] = recipient_results(errors)
+            if len(delivered) < len(recipients):
+                response.update({'success': False, 'error': '部分Kindle邮箱发送失败'})
+                logger.warning(f"[API-SEND] 部分Kindle邮箱发送失败: {errors}")
+                return jsonify(response), 207
             logger.info(f"[API-SEND] 发送成功！返回响应: {response}")
             logger.info("[API-SEND] ========== API发送请求处理完成 ==========")
             return jsonify(response)
         else:
             logger.error("[API-SEND] 发送失败！")
             logger.info("[API-SEND] ========== API发送请求处理失败 ==========")
-            return jsonify({
+            response = {
                 'success': False,
                 'error': '发送失败，请检查SMTP配置'
-            }), 500
+            }
+            if len(recipients) > 1:
+                response['recipients'] = recipient_results(errors)
+            return jsonify(response), 500
     
     except Exception as e:
         logger.error(f"[API-SEND] 处理出错: {str(e)}", exc_info=True)
@@ -403,6 +636,898 @@ def api_send_to_kindle():
             'error': f'处理失败: {str(e)}'
         }), 500
 
+def split_kindle_emails(value):
+    """
+    解析一个或多个Kindle邮箱
+    
+    Args:
+        value: 字符串（逗号、分号或空白分隔）或字符串列表
+    
+    Returns:
+        list: 去重后的邮箱地址（保持原顺序）
+    """
+    items = [value] if isinstance(value, str) else list(value or [])
+    emails = []
+    for item in items:
+        for email in re.split(r'[,;\s]+', item or ''):
+            if email and email.lower() not in (e.lower() for e in emails):
+                emails.append(email)
+    return emails
+
+def recipient_results(errors):
+    """各Kindle邮箱的发送结果（用于响应）"""
+    return [{'kindle_email': email, 'success': error is None, 'error': error}
+            for email, error in errors.items()]
+
+def send_file_to_recipients(account, recipients, file_path):
+    """
+    用指定账号同步发送一个文件，多个Kindle邮箱时在同一个SMTP事务中发送
+    
+    Returns:
+        dict: Kindle邮箱 -> 错误信息，发送成功为 None
+    """
+    send_start = time.time()
+    with sending(account):
+        if len(recipients) == 1:
+            success = send_to_kindle(
+                kindle_email=recipients[0],
+                sender_email=account['smtp_email'],
+                sender_password=account['smtp_password'],
+                file_path=file_path,
+                smtp_server=account['smtp_server'],
+                smtp_port=account['smtp_port']
+            )
+            errors = {recipients[0]: None if success else '发送失败'}
+        else:
+            results = send_to_kindle_recipients(
+                kindle_emails=recipients,
+                sender_email=account['smtp_email'],
+                sender_password=account['smtp_password'],
+                file_path=file_path,
+                smtp_server=account['smtp_server'],
+                smtp_port=account['smtp_port']
+            )
+            errors = {email: None if error is None else str(error) for email, error in results.items()}
+    if any(error is None for error in errors.values()):
+        record_success(get_rate_limit_db(), account, time.time() - send_start)
+    return errors
+
+def get_conversion_limits():
+    """单次转换的耗时、CPU时间和内存限制"""
+    return ConversionLimits(app.config['CONVERT_TIMEOUT'], app.config['CONVERT_CPU_LIMIT'],
+                            app.config['CONVERT_MEMORY_LIMIT'])
+
+def run_conversion(filepath, should_cancel=None):
+    """
+    将PDF转换为EPUB，等待转换完成
+    
+    先查转换结果缓存（按文件内容、Calibre版本和转换选项索引），未命中时在转换池中转换。
+    同一内容同时有多个转换请求时只转换一次，其他请求等它完成后直接使用缓存。
+    
+    Args:
+        should_cancel: 返回 True 时取消转换的函数（可选）
+    
+    Raises:
+        ConversionQueueFull: 排队等待转换的任务过多
+        ConversionCancelled: 转换被取消
+    """
+    cache = get_convert_cache()
+    converter = get_converter()
+    if cache is None or not converter['ready']:
+        return submit_conversion(filepath, should_cancel, converter)
+    
+    key = cache.key(filepath, converter['version'], EPUB_OPTIONS)
+    output_path = epub_output_path(filepath)
+    cached = cache.fetch(key, output_path)
+    if cached is None:
+        with cache.single_flight(key):
+            cached = cache.fetch(key, output_path)
+            if cached is None:
+                epub_path = submit_conversion(filepath, should_cancel, converter)
+                if epub_path and epub_path != filepath and os.path.exists(epub_path):
+                    cache.publish(key, epub_path)
+                return epub_path
+    logger.info(f"[CONVERT] 使用缓存的转换结果: {cached}")
+    return cached
+
+def submit_conversion(filepath, should_cancel=None, converter=None):
+    """在转换池中将PDF转换为EPUB（限制同时运行的Calibre进程数和资源），等待转换完成"""
+    pool = get_convert_pool()
+    stats = pool.stats()
+    if stats['running'] >= stats['workers']:
+        logger.info(f"[CONVERT] 转换池已满（{stats['running']}个正在转换，{stats['queued']}个排队），等待空闲")
+    return pool.run(convert_pdf_to_epub, filepath, limits=get_conversion_limits(), should_cancel=should_cancel,
+                    converter=converter or get_converter())
+
+def submit_txt_conversion(filepath, should_cancel=None):
+    """
+    在转换池中将TXT转换为EPUB，等待转换完成
+    
+    内置转换不启动Calibre，但同样占用CPU，和PDF转换共用转换池的并发数和排队上限
+    """
+    return get_convert_pool().run(convert_txt_to_epub, filepath, should_cancel=should_cancel)
+
+def convert_busy_response(message):
+    """转换排队已满的响应（503，带Retry-After）"""
+    retry_after = app.config['CONVERT_RETRY_DELAY']
+    response = jsonify({'success': False, 'message': message, 'error': message, 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+def needs_conversion(filepath, convert_pdf=False):
+    """发送前是否要转换为EPUB：PDF由 convert_pdf 决定，TXT由 CONVERT_TXT_TO_EPUB 决定"""
+    extension = filepath.rsplit('.', 1)[-1].lower()
+    return (extension == 'pdf' and bool(convert_pdf)) or (extension == 'txt' and app.config['CONVERT_TXT_TO_EPUB'])
+
+def convert_for_delivery(filepath, convert_pdf=False, should_cancel=None):
+    """
+    按需将PDF或TXT转换为EPUB（TXT使用内置转换，不经过Calibre，但同样在转换池中进行）
+    
+    Returns:
+        tuple: (要发送的文件路径, 是否已转换, 转换耗时)，转换失败时文件路径为 None
+    
+    Raises:
+        ConversionQueueFull: 排队等待转换的任务过多
+        ConversionCancelled: 转换被取消
+    """
+    if not needs_conversion(filepath, convert_pdf):
+        return filepath, False, 0.0
+    
+    convert_start = time.time()
+    logger.info(f"开始转换到EPUB: {filepath}")
+    if filepath.lower().endswith('.txt'):
+        epub_path = submit_txt_conversion(filepath, should_cancel)
+    else:
+        epub_path = run_conversion(filepath, should_cancel)
+    convert_time = time.time() - convert_start
+    if epub_path and os.path.exists(epub_path) and epub_path != filepath:
+        logger.info(f"转换完成，耗时: {convert_time:.2f}秒")
+        return epub_path, True, convert_time
+    logger.error("转换失败")
+    return None, False, convert_time
+
+def deliver_file(filepath, config, convert_pdf=False, on_progress=None, max_wait=None, should_cancel=None):
+    """
+    转换（如需要）并发送单个文件到Kindle
+    
+    不依赖请求上下文，可以在后台线程中调用
+    
+    Args:
+        filepath: 已保存的文件路径
+        config: 配置（需包含kindle_email和SMTP信息）
+        convert_pdf: 是否将PDF转换为EPUB（TXT是否转换由 CONVERT_TXT_TO_EPUB 决定）
+        on_progress: 进度回调 on_progress(阶段, 总进度百分比)（可选）
+        max_wait: 达到发送速率限制时最多等待的秒数（默认 SEND_RATE_MAX_WAIT）
+        should_cancel: 返回 True 时取消任务的函数（可选，转换期间定期检查）
+    
+    Returns:
+        dict: 处理结果，失败时 'error' 为错误信息，'stage' 为失败的阶段，
+              'cancelled' 表示任务在发送前被取消，
+              'transient' 表示是否为可重试的临时性发送错误，
+              'retry_after' 为达到速率限制时可以重新发送的时间；
+              kindle_email 含多个邮箱时 'recipients' 为各邮箱的错误信息（成功为 None），
+              'failed_recipients' 为发送失败的邮箱
+    """
+    result = {
+        'success': False,
+        'final_path': filepath,
+        'converted': False,
+        'format': filepath.split('.')[-1].upper(),
+        'convert_time': 0.0,
+        'send_time': 0.0,
+        'error': None,
+        'stage': None,
+        'transient': False,
+        'retry_after': None,
+        'recipients': None,
+        'failed_recipients': [],
+        'cancelled': False
+    }
+    
+    def report(stage, percent):
+        if on_progress is not None:
+            on_progress(stage, percent)
+    
+    # 1. 转换格式（如果需要）
+    needs_convert = needs_conversion(filepath, convert_pdf)
+    if needs_convert:
+        report('converting', 0)
+        try:
+            final_path, converted, result['convert_time'] = convert_for_delivery(filepath, convert_pdf,
+                                                                                 should_cancel)
+        except ConversionQueueFull as e:
+            result.update({'error': str(e), 'stage': 'convert', 'transient': True,
+                           'retry_after': time.time() + app.config['CONVERT_RETRY_DELAY']})
+            return result
+        except ConversionCancelled:
+            result.update({'error': '任务已取消', 'stage': 'convert', 'cancelled': True})
+            return result
+        if final_path is None:
+            result.update({'error': '文件转换失败', 'stage': 'convert'})
+            return result
+        result.update({'final_path': final_path, 'converted': converted, 'format': 'EPUB'})
+    
+    # 2. 发送到Kindle（选择负载最低的发件账号，账号认证失败或被限流时换其他账号）
+    if should_cancel is not None and should_cancel():
+        result.update({'error': '任务已取消', 'stage': 'send', 'cancelled': True})
+        return result
+    final_path = result['final_path']
+    recipients = split_kindle_emails(config['kindle_email'])
+    logger.info(f"开始发送邮件到: {config['kindle_email']}")
+    logger.info(f"文件大小: {os.path.getsize(final_path) / (1024*1024):.2f}MB")
+    
+    # 转换大约占总耗时的前40%，发送进度按已写入连接的字节数计算
+    send_base = 40 if needs_convert else 0
+    extra = {}
+    if on_progress is not None:
+        extra['progress_callback'] = lambda sent, total: report(
+            'sending', send_base + (100 - send_base) * sent // max(total, 1))
+    
+    accounts_count = len(get_sender_accounts(config))
+    tried = set()
+    success = False
+    error = '发送失败，请检查配置'
+    send_start = time.time()
+    while True:
+        account, wait = acquire_send_slot(config, [final_path], max_wait, exclude=tried)
+        if account is None:
+            if wait:
+                result.update({'error': f'发送过于频繁，请{wait:.0f}秒后重试', 'stage': 'send',
+                               'transient': True, 'retry_after': time.time() + wait})
+                result['send_time'] = time.time() - send_start
+                return result
+            break
+        
+        tried.add(account_key(account))
+        report('sending', send_base)
+        attempt_start = time.time()
+        try:
+            with sending(account):
+                if len(recipients) > 1:
+                    # 多个Kindle邮箱在同一个SMTP事务中发送，附件只传输一次
+                    errors = send_to_kindle_recipients(
+                        kindle_emails=recipients,
+                        sender_email=account['smtp_email'],
+                        sender_password=account['smtp_password'],
+                        file_path=final_path,
+                        smtp_server=account['smtp_server'],
+                        smtp_port=account['smtp_port'],
+                        raise_on_error=True,
+                        **extra
+                    )
+                    result['recipients'] = {email: None if e is None else f'发送失败: {e}'
+                                            for email, e in errors.items()}
+                    refused = [e for e in errors.values() if e is not None]
+                    result['failed_recipients'] = [email for email, e in errors.items() if e is not None]
+                    success = not refused
+                    if refused:
+                        error = f"部分Kindle邮箱发送失败: {', '.join(result['failed_recipients'])}"
+                        result['transient'] = all(is_transient_error(e) for e in refused)
+                elif app.config['SMTP_ENGINE'] == 'asyncio':
+                    send_error = smtp_send_files(account, config['kindle_email'], [final_path],
+                                                 extra.get('progress_callback'))[0]
+                    if send_error is not None:
+                        raise send_error
+                    success = True
+                else:
+                    success = send_to_kindle(
+                        kindle_email=config['kindle_email'],
+                        sender_email=account['smtp_email'],
+                        sender_password=account['smtp_password'],
+                        file_path=final_path,
+                        smtp_server=account['smtp_server'],
+                        smtp_port=account['smtp_port'],
+                        raise_on_error=True,
+                        **extra
+                    )
+        except Exception as e:
+            success = False
+            error = f'发送失败: {e}'
+            result['transient'] = is_transient_error(e)
+            if report_send_failure(account, e, accounts_count):
+                # 由账号引起的错误：换其他账号，所有账号都失败时稍后重试
+                result['transient'] = True
+                logger.warning(f"发件账号 {account['smtp_email']} 发送失败，尝试其他账号")
+                continue
+            break
+        if success or result['failed_recipients']:
+            record_success(get_rate_limit_db(), account, time.time() - attempt_start)
+        break
+    result['send_time'] = time.time() - send_start
+    
+    if success:
+        logger.info(f"发送成功！邮件发送耗时: {result['send_time']:.2f}秒")
+        result['success'] = True
+    else:
+        logger.error(f"发送失败，耗时: {result['send_time']:.2f}秒")
+        result.update({'error': error, 'stage': 'send'})
+    return result
+
+def check_send_config(config):
+    """检查发送所需的配置，返回错误信息，配置完整时返回None"""
+    if not config.get('kindle_email'):
+        logger.error("未配置Kindle邮箱")
+        return '请先配置Kindle邮箱'
+    
+    if not get_sender_accounts(config):
+        logger.error("未配置SMTP")
+        return '请先配置发送邮箱'
+    
+    return None
+
+def get_rate_limit_db():
+    """发件账号速率限制的令牌桶数据库（所有工作进程共用）"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.ratelimit.db')
+
+def get_rate_limits(config):
+    """发件账号的速率限制，config.json 中的 smtp_messages_per_minute / smtp_bytes_per_hour 优先"""
+    return RateLimits(
+        messages_per_minute=int(config.get('smtp_messages_per_minute', app.config['SMTP_MESSAGES_PER_MINUTE'])),
+        bytes_per_hour=int(config.get('smtp_bytes_per_hour', app.config['SMTP_BYTES_PER_HOUR']))
+    )
+
+def get_sender_accounts(config):
+    """
+    发件账号列表
+    
+    config.json 中的 smtp_accounts 为多个账号（每项含 smtp_email、smtp_password，
+    smtp_server、smtp_port 和速率限制可选，未填写时使用顶层配置）；
+    没有配置 smtp_accounts 时使用顶层的 smtp_email / smtp_password
+    """
+    entries = config.get('smtp_accounts') or [config]
+    accounts = []
+    for entry in entries:
+        if not entry.get('smtp_email') or not entry.get('smtp_password'):
+            continue
+        merged = dict(config, **entry)
+        accounts.append({
+            'smtp_email': merged['smtp_email'],
+            'smtp_password': merged['smtp_password'],
+            'smtp_server': merged.get('smtp_server', 'smtp.163.com'),
+            'smtp_port': int(merged.get('smtp_port', 465)),
+            'limits': get_rate_limits(merged)
+        })
+    return accounts
+
+def acquire_send_slot(config, file_paths, max_wait=None, exclude=()):
+    """
+    选择发件账号并取速率限制的令牌
+    
+    Args:
+        file_paths: 要发送的文件（按合并发送的方式估算邮件数和字节数）
+        max_wait: 所有账号都达到限制时最多等待的秒数，0表示不等待（默认 SEND_RATE_MAX_WAIT）
+        exclude: 本次发送已失败的账号标识
+    
+    Returns:
+        tuple: (账号, 0)；所有账号都达到限制时为 (None, 还需等待的秒数)；
+               没有可用账号时为 (None, 0)
+    """
+    if max_wait is None:
+        max_wait = app.config['SEND_RATE_MAX_WAIT']
+    accounts = get_sender_accounts(config)
+    messages, nbytes = estimate_send_volume([os.path.getsize(path) for path in file_paths])
+    deadline = time.time() + max_wait
+    while True:
+        account, wait = choose_account(get_rate_limit_db(), accounts, messages, nbytes, exclude)
+        if account is not None or not wait or time.time() + wait > deadline:
+            break
+        time.sleep(wait)
+    if wait:
+        logger.warning(f"[RATE] 所有发件账号都达到发送速率限制或暂不可用，需等待 {wait:.0f}秒")
+    return account, wait
+
+def smtp_send_files(account, kindle_email, file_paths, progress_callback=None):
+    """
+    用指定账号把文件合并成尽量少的邮件发送
+    
+    SMTP_ENGINE 为 asyncio 时提交给本进程的事件循环发送（调用线程只等待结果，不占用网络I/O），
+    否则在当前线程用 smtplib 发送
+    
+    Returns:
+        list: 与 file_paths 一一对应，发送成功为 None，失败为异常对象
+    """
+    if app.config['SMTP_ENGINE'] == 'asyncio':
+        future = get_delivery_engine().submit_send(
+            kindle_email, account['smtp_email'], account['smtp_password'], file_paths,
+            account['smtp_server'], account['smtp_port'], progress_callback=progress_callback)
+        return future.result()
+    return send_files_to_kindle(
+        kindle_email=kindle_email,
+        sender_email=account['smtp_email'],
+        sender_password=account['smtp_password'],
+        file_paths=file_paths,
+        smtp_server=account['smtp_server'],
+        smtp_port=account['smtp_port']
+    )
+
+def prewarm_smtp_connections():
+    """
+    预先为各发件账号建立并登录SMTP连接（gunicorn 的 post_fork 在工作进程启动时调用）
+    
+    在后台线程中进行，不阻塞工作进程启动，失败只记录日志。第一次发送直接复用这些连接；
+    连接空闲超时后重新连接时，也可以用预热时保存的TLS会话快速握手
+    """
+    accounts = get_sender_accounts(load_config())
+    
+    def prewarm():
+        for account in accounts:
+            start = time.time()
+            try:
+                if app.config['SMTP_ENGINE'] == 'asyncio':
+                    get_delivery_engine().submit_prewarm(
+                        account['smtp_server'], account['smtp_port'],
+                        account['smtp_email'], account['smtp_password']).result()
+                else:
+                    get_smtp_pool().prewarm(account['smtp_server'], account['smtp_port'],
+                                            account['smtp_email'], account['smtp_password'])
+                logger.info(f"[PREWARM] 已连接 {account['smtp_email']}，耗时: {time.time() - start:.2f}秒")
+            except Exception as e:
+                logger.warning(f"[PREWARM] 预先连接 {account['smtp_email']} 失败: {e}")
+    
+    if accounts:
+        threading.Thread(target=prewarm, name='smtp-prewarm', daemon=True).start()
+
+def report_send_failure(account, error, accounts_count):
+    """
+    记录账号的发送失败
+    
+    Returns:
+        bool: 错误是否由账号引起（认证失败、被限流），可以换其他账号重新发送
+    """
+    kind = record_failure(get_rate_limit_db(), account, error)
+    if kind is None:
+        return False
+    logger.warning(f"[ACCOUNT] 发件账号 {account['smtp_email']} {'认证失败' if kind == 'auth' else '被限流'}: {error}")
+    return accounts_count > 1
+
+def rate_limited_response(wait, key='message'):
+    """达到发送速率限制的响应（429，带Retry-After）"""
+    response = jsonify({'success': False, key: f'发送过于频繁，请{wait:.0f}秒后重试',
+                        'retry_after': round(wait)})
+    response.headers['Retry-After'] = str(max(int(wait + 0.5), 1))
+    return response, 429
+
+def get_jobs_dir():
+    """后台任务状态目录"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.jobs')
+
+def get_delivery_db():
+    """发送队列数据库（与上传文件放在同一目录，容器重启后仍然保留）"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.delivery.db')
+
+_delivery_pid = None
+_delivery_lock = threading.Lock()
+_delivery_wakeup = threading.Event()
+
+def ensure_delivery_workers():
+    """
+    启动本进程的发送线程
+    
+    线程不会被fork继承，按进程号判断：gunicorn预加载应用后fork出的每个工作进程各自启动一组线程，
+    所有进程通过同一个SQLite队列领取任务。
+    """
+    global _delivery_pid
+    with _delivery_lock:
+        if _delivery_pid == os.getpid():
+            return
+        _delivery_pid = os.getpid()
+        for index in range(app.config['JOB_WORKERS']):
+            threading.Thread(target=delivery_loop, name=f'delivery-{index}', daemon=True).start()
+
+def delivery_loop():
+    """发送线程：从队列领取到期的任务并发送，没有任务时等待唤醒或定期轮询"""
+    owner = lease_owner()
+    while True:
+        deliveries = []
+        db_path = get_delivery_db()
+        try:
+            if os.path.exists(db_path):
+                # 同一Kindle邮箱的到期任务一起领取，合并成少量邮件发送
+                deliveries = claim_batch(db_path, owner, limit=MAX_ATTACHMENTS_PER_EMAIL,
+                                         on_dead=delivery_expired)
+        except Exception as e:
+            logger.error(f"[QUEUE] 领取任务失败: {e}")
+        
+        if not deliveries:
+            _delivery_wakeup.wait(app.config['DELIVERY_POLL_INTERVAL'])
+            _delivery_wakeup.clear()
+            continue
+        
+        # 一批任务共用一个租约期限，逐个处理期间需要续租，否则排在后面的任务可能被重新领取、重复发送
+        renew_leases = keep_leases(db_path, deliveries)
+        if len(deliveries) == 1 or len(split_kindle_emails(deliveries[0]['kindle_email'])) > 1:
+            # 发送到多个Kindle邮箱的任务逐个发送（每封邮件一个文件、多个收件人）
+            for delivery in deliveries:
+                try:
+                    if delivery['id'] not in renew_leases(force=True):
+                        logger.warning(f"[QUEUE] 任务 {delivery['id']} 的租约已失效，跳过")
+                        continue
+                    process_delivery(db_path, delivery, renew_leases)
+                except Exception as e:
+                    abort_delivery(db_path, delivery, e)
+        else:
+            try:
+                process_deliveries(db_path, deliveries, renew_leases)
+            except Exception as e:
+                # 已经更新过状态的任务不再持有租约，abort_delivery 会跳过它们
+                for delivery in deliveries:
+                    abort_delivery(db_path, delivery, e)
+
+def abort_delivery(db_path, delivery, error):
+    """
+    处理任务时出现意外错误（如文件已被删除、任务状态文件丢失）：按发送失败处理
+    
+    文件不存在时不再重试，其他错误按退避重试，次数用尽后进入 dead 状态。
+    任务已不由本线程持有（已完成或被其他线程领取）时不做处理。
+    """
+    logger.error(f"[QUEUE] 处理任务 {delivery['id']} 出错: {error}", exc_info=error)
+    message = f'处理出错: {error}'
+    try:
+        if not renew(db_path, [delivery['id']], delivery['lease_owner']):
+            return
+        next_attempt = mark_failed(db_path, delivery, message,
+                                   transient=not isinstance(error, FileNotFoundError))
+    except Exception as e:
+        logger.error(f"[QUEUE] 任务 {delivery['id']} 无法标记为失败: {e}")
+        return
+    
+    try:
+        if next_attempt is not None:
+            set_delivery_job(delivery, status='retrying', stage='queued', progress=0,
+                             error=message, next_attempt_at=next_attempt)
+        else:
+            set_delivery_job(delivery, status='failed', finished=time.time(), error=message,
+                             failed_stage='internal')
+    except Exception as e:
+        logger.warning(f"[QUEUE] 任务 {delivery['id']} 的状态无法更新: {e}")
+
+def delivery_expired(delivery):
+    """租约多次过期、尝试次数用尽的任务进入 dead 状态时，把对应的后台任务标记为失败"""
+    logger.error(f"[QUEUE] 任务 {delivery['id']} {delivery['last_error']}")
+    try:
+        set_delivery_job(delivery, status='failed', finished=time.time(), error=delivery['last_error'],
+                         failed_stage='internal')
+    except Exception as e:
+        logger.warning(f"[QUEUE] 任务 {delivery['id']} 的状态无法更新: {e}")
+
+def set_delivery_job(delivery, **fields):
+    """更新队列记录对应的任务状态"""
+    if delivery['job_id']:
+        update_job(get_jobs_dir(), delivery['job_id'], **fields)
+
+def delivery_cancelled(delivery):
+    """队列记录对应的任务是否已被要求取消"""
+    return bool(delivery['job_id']) and cancel_requested(get_jobs_dir(), delivery['job_id'])
+
+def keep_leases(db_path, deliveries, interval=LEASE_RENEW_INTERVAL):
+    """
+    返回续租函数 renew_leases(force=False)
+    
+    调用时为仍持有的任务续租（距上次续租不足 interval 秒且未指定 force 时跳过），
+    返回仍持有租约的任务ID集合
+    """
+    owner = deliveries[0]['lease_owner']
+    state = {'held': {delivery['id'] for delivery in deliveries}, 'renewed': time.monotonic()}
+    
+    def renew_leases(force=False):
+        now = time.monotonic()
+        if state['held'] and (force or now - state['renewed'] >= interval):
+            state['held'] = renew(db_path, state['held'], owner)
+            state['renewed'] = now
+        return state['held']
+    
+    return renew_leases
+
+def process_delivery(db_path, delivery, renew_leases=None):
+    """
+    执行一次发送尝试，并按结果更新队列和任务状态
+    
+    转换期间定期续租；租约失效（已被其他线程领取）时按取消处理，不再发送
+    """
+    if renew_leases is None:
+        renew_leases = keep_leases(db_path, [delivery])
+    
+    def should_cancel():
+        return delivery_cancelled(delivery) or delivery['id'] not in renew_leases()
+    
+    started = time.time()
+    logger.info(f"[QUEUE] 开始第 {delivery['attempts']} 次发送: {delivery['filename']}")
+    
+    def set_job(**fields):
+        set_delivery_job(delivery, **fields)
+    
+    set_job(status='running', started=started, attempts=delivery['attempts'],
+            timings={'queue_wait': round(started - delivery['created_at'], 3)})
+    last_reported = {'stage': 'queued', 'progress': 0}
+    
+    def on_progress(stage, percent):
+        # 进度每变化5%以上才写一次状态文件
+        if stage != last_reported['stage'] or percent - last_reported['progress'] >= 5:
+            last_reported.update(stage=stage, progress=percent)
+            set_job(stage=stage, progress=percent)
+    
+    # 发送账号每次从配置读取，队列中不保存密码
+    config = load_config()
+    config['kindle_email'] = delivery['kindle_email']
+    error = check_send_config(config)
+    if error:
+        result = {'success': False, 'error': error, 'stage': 'config', 'transient': False,
+                  'converted': False, 'convert_time': 0.0, 'send_time': 0.0}
+    else:
+        # 达到速率限制时不占用发送线程等待，放回队列推迟领取
+        result = deliver_file(delivery['filepath'], config, bool(delivery['convert_pdf']),
+                              on_progress=on_progress, max_wait=0, should_cancel=should_cancel)
+    
+    finish_delivery(db_path, delivery, result, started)
+
+def finish_delivery(db_path, delivery, result, started):
+    """按一次发送尝试的结果（deliver_file 的返回格式）更新队列和任务状态"""
+    def set_job(**fields):
+        set_delivery_job(delivery, **fields)
+    
+    # 租约已过期并被其他线程领取时，队列和任务状态由新的领取者更新
+    if not renew(db_path, [delivery['id']], delivery['lease_owner']):
+        logger.warning(f"[QUEUE] 任务 {delivery['id']} 的租约已被其他线程领取，不更新状态")
+        return
+    
+    finished = time.time()
+    timings = {
+        'convert_time': round(result['convert_time'], 3),
+        'send_time': round(result['send_time'], 3),
+        'run_time': round(finished - started, 3)
+    }
+    
+    if result.get('cancelled'):
+        mark_cancelled(db_path, delivery, result['error'])
+        logger.info(f"[QUEUE] 任务 {delivery['id']} 已取消")
+        set_job(status='cancelled', finished=finished, timings=timings, error=result['error'])
+        return
+    
+    if result['success']:
+        if len(split_kindle_emails(delivery['kindle_email'])) > 1:
+            set_job(recipients=result.get('recipients'))
+        mark_sent(db_path, delivery['id'], delivery['lease_owner'])
+        logger.info(f"[QUEUE] 任务 {delivery['id']} 发送成功，耗时: {finished - started:.2f}秒")
+        set_job(status='succeeded', stage='done', progress=100, finished=finished, timings=timings,
+                error=None, result={'converted': result['converted'], 'format': result['format']})
+        return
+    
+    # 已转换好的文件直接用于重试，不再重复转换
+    retry_path = result['final_path'] if result['converted'] else None
+    if result.get('retry_after'):
+        defer(db_path, delivery, result['retry_after'], retry_path)
+        reason = '转换排队已满' if result['stage'] == 'convert' else '达到发送速率限制'
+        logger.info(f"[QUEUE] 任务 {delivery['id']} {reason}，{result['retry_after'] - finished:.0f}秒后发送")
+        set_job(status='queued', stage='throttled', progress=0, timings=timings,
+                next_attempt_at=result['retry_after'])
+        return
+    
+    # 部分Kindle邮箱发送失败时只重试这些邮箱
+    retry_emails = None
+    if result.get('failed_recipients'):
+        retry_emails = ', '.join(result['failed_recipients'])
+    next_attempt = mark_failed(db_path, delivery, result['error'], result['transient'], retry_path,
+                               kindle_email=retry_emails)
+    if next_attempt is not None:
+        logger.warning(f"[QUEUE] 任务 {delivery['id']} 发送失败，{next_attempt - finished:.0f}秒后重试: {result['error']}")
+        set_job(status='retrying', stage='queued', progress=0, timings=timings,
+                error=result['error'], next_attempt_at=next_attempt,
+                recipients=result.get('recipients'))
+    else:
+        logger.error(f"[QUEUE] 任务 {delivery['id']} 发送失败，不再重试: {result['error']}")
+        set_job(status='failed', finished=finished, timings=timings,
+                error=result['error'], failed_stage=result['stage'],
+                recipients=result.get('recipients'))
+
+def process_deliveries(db_path, deliveries, renew_leases=None):
+    """
+    合并发送同一Kindle邮箱的多个任务
+    
+    各文件先分别转换，转换成功的文件按大小装进尽量少的邮件，通过同一个SMTP连接发送，
+    每个任务按其所在邮件的发送结果分别更新状态。
+    
+    每个文件转换前和每次发送前为整批任务续租，租约已失效的任务不再处理。
+    """
+    if renew_leases is None:
+        renew_leases = keep_leases(db_path, deliveries)
+    started = time.time()
+    logger.info(f"[QUEUE] 开始合并发送 {len(deliveries)} 个文件到: {deliveries[0]['kindle_email']}")
+    
+    config = load_config()
+    config['kindle_email'] = deliveries[0]['kindle_email']
+    error = check_send_config(config)
+    
+    ready = []
+    for delivery in deliveries:
+        set_delivery_job(delivery, status='running', started=started, attempts=delivery['attempts'],
+                         timings={'queue_wait': round(started - delivery['created_at'], 3)})
+        result = {
+            'success': False,
+            'final_path': delivery['filepath'],
+            'converted': False,
+            'format': delivery['filepath'].split('.')[-1].upper(),
+            'convert_time': 0.0,
+            'send_time': 0.0,
+            'error': error,
+            'stage': 'config' if error else None,
+            'transient': False,
+            'retry_after': None
+        }
+        if error:
+            finish_delivery(db_path, delivery, result, started)
+            continue
+        if delivery['id'] not in renew_leases(force=True):
+            logger.warning(f"[QUEUE] 任务 {delivery['id']} 的租约已失效，跳过")
+            continue
+        if delivery_cancelled(delivery):
+            result.update({'error': '任务已取消', 'stage': 'convert', 'cancelled': True})
+            finish_delivery(db_path, delivery, result, started)
+            continue
+        
+        if needs_conversion(delivery['filepath'], delivery['convert_pdf']):
+            set_delivery_job(delivery, stage='converting', progress=0)
+            try:
+                final_path, converted, result['convert_time'] = convert_for_delivery(
+                    delivery['filepath'], delivery['convert_pdf'],
+                    lambda: delivery_cancelled(delivery) or delivery['id'] not in renew_leases())
+            except ConversionQueueFull as e:
+                result.update({'error': str(e), 'stage': 'convert',
+                               'retry_after': time.time() + app.config['CONVERT_RETRY_DELAY']})
+                finish_delivery(db_path, delivery, result, started)
+                continue
+            except ConversionCancelled:
+                result.update({'error': '任务已取消', 'stage': 'convert', 'cancelled': True})
+                finish_delivery(db_path, delivery, result, started)
+                continue
+            if final_path is None:
+                result.update({'error': '文件转换失败', 'stage': 'convert'})
+                finish_delivery(db_path, delivery, result, started)
+                continue
+            result.update({'final_path': final_path, 'converted': converted, 'format': 'EPUB'})
+        ready.append((delivery, result))
+    
+    if not ready:
+        return
+    
+    for delivery, result in ready:
+        set_delivery_job(delivery, stage='sending', progress=40 if result['converted'] else 0)
+    
+    # 由账号引起的失败（认证失败、被限流）换其他账号重新发送这些文件
+    accounts_count = len(get_sender_accounts(config))
+    tried = set()
+    send_start = time.time()
+    while ready:
+        held = renew_leases(force=True)
+        lost = [delivery['id'] for delivery, _ in ready if delivery['id'] not in held]
+        if lost:
+            logger.warning(f"[QUEUE] 任务 {', '.join(map(str, lost))} 的租约已失效，不再发送")
+            ready = [(delivery, result) for delivery, result in ready if delivery['id'] in held]
+            if not ready:
+                return
+        
+        account, wait = acquire_send_slot(config, [result['final_path'] for _, result in ready],
+                                          max_wait=0, exclude=tried)
+        if account is None:
+            for delivery, result in ready:
+                if wait:
+                    result['retry_after'] = time.time() + wait
+                finish_delivery(db_path, delivery, result, started)
+            return
+        
+        tried.add(account_key(account))
+        attempt_start = time.time()
+        with sending(account):
+            errors = smtp_send_files(account, config['kindle_email'],
+                                     [result['final_path'] for _, result in ready])
+        send_time = time.time() - send_start
+        logger.info(f"[QUEUE] 使用 {account['smtp_email']} 合并发送完成，耗时: {time.time() - attempt_start:.2f}秒")
+        
+        failover = []
+        account_error = None
+        for (delivery, result), send_error in zip(ready, errors):
+            result['send_time'] = send_time
+            if send_error is None:
+                result.update({'success': True, 'error': None, 'stage': None})
+                finish_delivery(db_path, delivery, result, started)
+                continue
+            result.update({'error': f'发送失败: {send_error}', 'stage': 'send',
+                           'transient': is_transient_error(send_error)})
+            if classify_error(send_error) is not None:
+                account_error = send_error
+                failover.append((delivery, result))
+            else:
+                finish_delivery(db_path, delivery, result, started)
+        
+        if account_error is None:
+            record_success(get_rate_limit_db(), account, time.time() - attempt_start)
+        elif report_send_failure(account, account_error, accounts_count):
+            for _, result in failover:
+                result['transient'] = True
+            logger.warning(f"[QUEUE] 发件账号 {account['smtp_email']} 发送失败，{len(failover)} 个文件尝试其他账号")
+        ready = failover
+
+def submit_send_job(filepath, original_filename, config, convert_pdf, wake=True):
+    """
+    创建后台发送任务并放入持久化队列，立即返回
+    
+    Args:
+        wake: 是否立即唤醒发送线程（批量提交时最后统一唤醒，使同一批文件一起领取、合并发送）
+    
+    Returns:
+        dict: 任务状态
+    """
+    job = create_job(get_jobs_dir(), original_filename, sent_to=config['kindle_email'])
+    enqueue(get_delivery_db(), filepath, original_filename, config['kindle_email'],
+            convert_pdf=convert_pdf, job_id=job['job_id'])
+    ensure_delivery_workers()
+    if wake:
+        _delivery_wakeup.set()
+    logger.info(f"[JOB] 已创建任务 {job['job_id']}: {original_filename}")
+    return job
+
+def wants_async():
+    """请求是否要求后台处理（async=true，可放在查询参数、表单或JSON中）"""
+    value = request.values.get('async')
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get('async')
+    return str(value).lower() == 'true'
+
+def job_accepted_response(job):
+    """任务已受理的响应（202）"""
+    return jsonify({
+        'success': True,
+        'message': '文件已接收，正在后台发送',
+        'job_id': job['job_id'],
+        'status_url': f"/api/jobs/{job['job_id']}"
+    }), 202
+
+def convert_and_send(filepath, original_filename, start_time, run_async=False):
+    """
+    一键处理的后半段：按配置转换格式并发送到Kindle
+    
+    Args:
+        filepath: 已保存的上传文件路径
+        original_filename: 原始文件名
+        start_time: 请求开始时间，用于统计总耗时
+        run_async: 是否在后台执行，立即返回任务ID
+    
+    Returns:
+        Flask响应
+    """
+    config = load_config()
+    error = check_send_config(config)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    
+    convert_pdf = app.config.get('CONVERT_PDF_TO_EPUB', False)
+    if run_async:
+        return job_accepted_response(submit_send_job(filepath, original_filename, config, convert_pdf))
+    
+    result = deliver_file(filepath, config, convert_pdf)
+    total_time = time.time() - start_time
+    
+    if result['stage'] == 'convert' and result.get('retry_after'):
+        return convert_busy_response(result['error'])
+    if result['stage'] == 'send' and result.get('retry_after'):
+        return rate_limited_response(max(result['retry_after'] - time.time(), 0))
+    if not result['success']:
+        return jsonify({'success': False, 'message': result['error']}), 500
+    
+    logger.info(f"总处理时间: {total_time:.2f}秒")
+    logger.info(f"========== 处理完成 ==========")
+    
+    return jsonify({
+        'success': True,
+        'message': '处理完成！文件已发送到Kindle',
+        'details': {
+            'original_file': original_filename,
+            'converted': result['converted'],
+            'sent_to': config['kindle_email'],
+            'format': result['format'],
+            'processing_time': f"{total_time:.2f}秒"
+        }
+    })
+
 @app.route('/api/process', methods=['POST'])
 def process_file():
     """一键处理：上传、转换、发送"""
@@ -425,92 +1550,384 @@ def process_file():
     try:
         # 1. 保存文件，保留原始文件名
         original_filename = file.filename
-        file_size_mb = len(file.read()) / (1024 * 1024)
-        file.seek(0)  # 重置文件指针
-        logger.info(f"接收文件: {original_filename}, 大小: {file_size_mb:.2f}MB")
+        logger.info(f"接收文件: {original_filename}")
         
-        save_start = time.time()
-        filename = generate_unique_filename(original_filename, app.config['UPLOAD_FOLDER'])
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        # 流式保存文件，边写边统计大小和耗时
+        filename, filepath, stats = save_upload(file)
+        file_size_mb = stats['bytes'] / (1024 * 1024)
+        logger.info(f"文件保存完成: {filepath}, 大小: {file_size_mb:.2f}MB, "
+                    f"耗时: {stats['seconds']:.2f}秒, 速度: {stats['speed_mb_s']:.2f}MB/s")
+        if stats['deduplicated']:
+            logger.info(f"文件内容已存在（SHA-256: {stats['sha256']}），未占用新的磁盘空间")
         
-        # 分块保存大文件
-        logger.info(f"开始保存文件到: {filepath}")
-        chunk_size = 4096  # 4KB chunks
-        with open(filepath, 'wb') as f:
-            while True:
-                chunk = file.stream.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
-        
-        save_time = time.time() - save_start
-        logger.info(f"文件保存完成，耗时: {save_time:.2f}秒, 速度: {file_size_mb/save_time:.2f}MB/s")
-        
-        # 2. 转换格式（如果需要）
-        final_path = filepath
-        if filepath.lower().endswith('.pdf') and app.config.get('CONVERT_PDF_TO_EPUB', False):
-            convert_start = time.time()
-            logger.info("开始转换PDF到EPUB...")
-            epub_path = convert_pdf_to_epub(filepath)
-            if epub_path and os.path.exists(epub_path):
-                final_path = epub_path
-                convert_time = time.time() - convert_start
-                logger.info(f"PDF转换完成，耗时: {convert_time:.2f}秒")
-            else:
-                logger.error("PDF转换失败")
-                return jsonify({'success': False, 'message': '文件转换失败'}), 500
-        
-        # 3. 发送到Kindle
-        config = load_config()
-        
-        if not config.get('kindle_email'):
-            logger.error("未配置Kindle邮箱")
-            return jsonify({'success': False, 'message': '请先配置Kindle邮箱'}), 400
-        
-        if not config.get('smtp_email') or not config.get('smtp_password'):
-            logger.error("未配置SMTP")
-            return jsonify({'success': False, 'message': '请先配置发送邮箱'}), 400
-        
-        send_start = time.time()
-        logger.info(f"开始发送邮件到: {config['kindle_email']}")
-        logger.info(f"文件大小: {os.path.getsize(final_path) / (1024*1024):.2f}MB")
-        
-        success = send_to_kindle(
-            kindle_email=config['kindle_email'],
-            sender_email=config['smtp_email'],
-            sender_password=config['smtp_password'],
-            file_path=final_path,
-            smtp_server=config.get('smtp_server', 'smtp.163.com'),
-            smtp_port=int(config.get('smtp_port', 465))
-        )
-        
-        send_time = time.time() - send_start
-        total_time = time.time() - start_time
-        
-        if success:
-            logger.info(f"发送成功！邮件发送耗时: {send_time:.2f}秒")
-            logger.info(f"总处理时间: {total_time:.2f}秒")
-            logger.info(f"========== 处理完成 ==========")
-            
-            return jsonify({
-                'success': True,
-                'message': '处理完成！文件已发送到Kindle',
-                'details': {
-                    'original_file': original_filename,
-                    'converted': filepath != final_path,
-                    'sent_to': config['kindle_email'],
-                    'format': 'EPUB' if filepath != final_path else filepath.split('.')[-1].upper(),
-                    'processing_time': f"{total_time:.2f}秒"
-                }
-            })
-        else:
-            logger.error(f"发送失败，耗时: {send_time:.2f}秒")
-            return jsonify({'success': False, 'message': '发送失败，请检查配置'}), 500
+        # 2. 转换并发送
+        return convert_and_send(filepath, original_filename, start_time, run_async=wants_async())
     
     except Exception as e:
         logger.error(f"处理出错: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def batch_process():
+    """
+    批量处理：一个请求上传多个文件，边接收边转换发送
+    
+    请求参数（multipart，字段需放在文件之前）：
+    - kindle_email: 目标Kindle邮箱（可选）
+    - convert_pdf: 是否转换PDF为EPUB（可选，默认使用服务器配置）
+    - async: 为true时全部文件放入发送队列后返回202，同一批文件合并成尽量少的邮件发送（可选，也可放在查询参数中）
+    - file / files: 要发送的文件，可重复多次
+    
+    返回每个文件的处理结果清单（后台发送时为每个文件的任务ID）
+    """
+    start_time = time.time()
+    logger.info("[BATCH] ========== 开始处理批量请求 ==========")
+    
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'success': False, 'message': '请使用multipart/form-data上传文件'}), 400
+    
+    config = load_config()
+    convert_pdf = app.config.get('CONVERT_PDF_TO_EPUB', False)
+    # 请求体按流读取，不能通过 request.values 读取表单
+    run_async = request.args.get('async', '').lower() == 'true'
+    results = []
+    pending = []
+    queued = []
+    
+    def container_factory(filename):
+        return create_upload_container(filename, upload_size_limit())
+    
+    parse_error = None
+    with ThreadPoolExecutor(max_workers=app.config['BATCH_SEND_WORKERS']) as executor:
+        try:
+            for event in iter_multipart(request.stream, boundary.encode('latin-1'), container_factory):
+                if event[0] == 'field':
+                    _, name, value = event
+                    if name == 'kindle_email' and value:
+                        config['kindle_email'] = value
+                    elif name == 'convert_pdf':
+                        convert_pdf = value.lower() == 'true'
+                    elif name == 'async':
+                        run_async = value.lower() == 'true'
+                    continue
+                
+                if event[0] == 'error':
+                    _, _, filename, error = event
+                    logger.error(f"[BATCH] 文件被拒绝: {filename} - {error.description}")
+                    results.append({'filename': filename, 'success': False,
+                                    'error': error.description, 'stage': 'upload'})
+                    continue
+                
+                _, _, filename, container = event
+                item = {'filename': filename, 'success': False}
+                results.append(item)
+                
+                if not filename:
+                    container.close()
+                    item.update({'error': '文件名为空', 'stage': 'upload'})
+                    continue
+                
+                error = check_send_config(config)
+                if error:
+                    container.close()
+                    item.update({'error': error, 'stage': 'upload'})
+                    continue
+                
+                saved_as, filepath, stats = container.commit(filename)
+                container.close()
+                item.update({
+                    'saved_as': saved_as,
+                    'size_mb': round(stats['bytes'] / 1024 / 1024, 2),
+                    'sha256': stats['sha256'],
+                    'deduplicated': stats['deduplicated'],
+                    'upload_time': round(stats['seconds'], 2)
+                })
+                if run_async:
+                    logger.info(f"[BATCH] 文件接收完成: {filename} -> {filepath}，等待放入发送队列")
+                    queued.append((item, filepath))
+                    continue
+                
+                logger.info(f"[BATCH] 文件接收完成: {filename} -> {filepath}，开始转换发送")
+                
+                # 立即开始转换发送，后续文件继续接收
+                pending.append((item, executor.submit(deliver_file, filepath, dict(config), convert_pdf)))
+        except ValueError as e:
+            # 请求体格式错误：已接收的文件照常处理，只有未接收的部分算作失败
+            logger.error(f"[BATCH] 请求体解析失败: {e}")
+            parse_error = e
+        
+        for item, future in pending:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"[BATCH] 处理出错: {item['filename']} - {str(e)}", exc_info=True)
+                item.update({'error': str(e), 'stage': 'send'})
+                continue
+            item.update({
+                'success': result['success'],
+                'converted': result['converted'],
+                'format': result['format'],
+                'sent_to': config['kindle_email'],
+                'convert_time': round(result['convert_time'], 2),
+                'send_time': round(result['send_time'], 2),
+                'error': result['error'],
+                'stage': result['stage']
+            })
+    
+    if parse_error is not None:
+        if run_async:
+            queue_batch_jobs(queued, config, convert_pdf)
+        return jsonify({'success': False, 'message': f'请求体解析失败: {str(parse_error)}', 'results': results}), 400
+    
+    if not results:
+        return jsonify({'success': False, 'message': '没有文件'}), 400
+    
+    if run_async:
+        return submit_batch_jobs(results, queued, config, convert_pdf, start_time)
+    
+    succeeded = sum(1 for item in results if item['success'])
+    total_time = time.time() - start_time
+    logger.info(f"[BATCH] 完成: {succeeded}/{len(results)} 个文件发送成功，总耗时: {total_time:.2f}秒")
+    
+    return jsonify({
+        'success': succeeded == len(results),
+        'message': f'{succeeded}/{len(results)} 个文件已发送到Kindle',
+        'results': results,
+        'processing_time': f"{total_time:.2f}秒"
+    })
+
+def queue_batch_jobs(queued, config, convert_pdf):
+    """把已接收的批量文件一起放入发送队列，再唤醒发送线程"""
+    for item, filepath in queued:
+        job = submit_send_job(filepath, item['filename'], config, convert_pdf, wake=False)
+        item.update({
+            'success': True,
+            'job_id': job['job_id'],
+            'status_url': f"/api/jobs/{job['job_id']}",
+            'sent_to': config['kindle_email']
+        })
+    if queued:
+        _delivery_wakeup.set()
+
+def submit_batch_jobs(results, queued, config, convert_pdf, start_time):
+    """批量请求的后台发送：所有文件接收完后一起放入队列，返回每个文件的任务ID"""
+    queue_batch_jobs(queued, config, convert_pdf)
+    accepted = len(queued)
+    total_time = time.time() - start_time
+    logger.info(f"[BATCH] 已放入发送队列: {accepted}/{len(results)} 个文件，耗时: {total_time:.2f}秒")
+    
+    return jsonify({
+        'success': accepted == len(results),
+        'message': f'{accepted}/{len(results)} 个文件已接收，正在后台发送',
+        'results': results,
+        'processing_time': f"{total_time:.2f}秒"
+    }), 202 if accepted else 400
+
+@app.route('/api/uploads', methods=['POST'])
+def create_chunked_upload():
+    """
+    创建分块上传会话
+    
+    请求参数（JSON）：
+    - filename: 原始文件名（必需）
+    - size: 文件总大小，字节（必需）
+    - chunk_size: 分块大小，字节（可选）
+    - sha256: 文件内容的SHA-256（可选），完成时用于校验上传的内容
+    """
+    data = request.json or {}
+    filename = data.get('filename', '')
+    logger.info(f"[CHUNK] 创建上传会话: {filename}, 大小: {data.get('size')}")
+    
+    if not filename or not allowed_file(filename):
+        logger.error(f"[CHUNK] 不支持的文件格式: {filename}")
+        return jsonify({'success': False, 'message': '不支持的文件格式'}), 400
+    
+    try:
+        size = int(data.get('size') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '文件大小无效'}), 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'success': False, 'message': '文件过大'}), 413
+    
+    try:
+        meta = create_upload_session(get_sessions_dir(), filename, size, data.get('chunk_size'),
+                                     sha256=data.get('sha256'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    logger.info(f"[CHUNK] 会话已创建: {meta['upload_id']}, 共 {meta['total_chunks']} 块")
+    return jsonify({'success': True, **meta})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """查询分块上传进度，客户端据此跳过已上传的分块"""
+    try:
+        status = get_upload_status(get_sessions_dir(), upload_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if status is None:
+        return jsonify({'success': False, 'message': '上传会话不存在或已过期'}), 404
+    return jsonify({'success': True, **status})
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """上传一个分块，请求体为分块的原始字节"""
+    try:
+        written = write_chunk(get_sessions_dir(), upload_id, index, request.stream)
+        
+        # 第一个分块到达后检查文件头，格式不符时直接放弃整个会话
+        if index == 0 and app.config.get('SNIFF_UPLOAD_CONTENT', True):
+            status = get_upload_status(get_sessions_dir(), upload_id)
+            validate = magic_validator(status['filename'])
+            try:
+                validate(read_head(get_sessions_dir(), upload_id, SNIFF_SIZE))
+            except UploadRejected:
+                logger.error(f"[CHUNK] 文件内容与扩展名不符: {status['filename']}")
+                discard_upload(get_sessions_dir(), upload_id)
+                raise
+    except ValueError as e:
+        logger.error(f"[CHUNK] 分块 {upload_id}/{index} 写入失败: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({'success': True, 'index': index, 'size': written})
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """
+    完成分块上传
+    
+    重复提交（客户端重试或并发请求）时返回第一次完成的结果，不会重复组装，也不会再次发送
+    
+    请求参数（JSON）：
+    - process: 是否继续转换并发送到Kindle（可选，默认false）
+    - async: 是否在后台转换发送，立即返回任务ID（可选，默认false）
+    """
+    start_time = time.time()
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        status = get_upload_status(get_sessions_dir(), upload_id)
+        if status is None and load_finalized(get_sessions_dir(), upload_id) is None:
+            return jsonify({'success': False, 'message': '上传会话不存在或已过期'}), 404
+        
+        meta, filename, filepath, stats = finalize_upload(
+            get_sessions_dir(), upload_id, app.config['UPLOAD_FOLDER'])
+        original_filename = meta['filename']
+    except ValueError as e:
+        logger.error(f"[CHUNK] 完成上传失败: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    already_finalized = stats.get('already_finalized', False)
+    if already_finalized:
+        logger.info(f"[CHUNK] 上传会话已完成过，返回之前的结果: {upload_id}")
+    else:
+        logger.info(f"[CHUNK] 上传完成: {original_filename} -> {filepath}")
+    
+    if data.get('process') and not already_finalized:
+        try:
+            return convert_and_send(filepath, original_filename, start_time, run_async=wants_async())
+        except Exception as e:
+            logger.error(f"处理出错: {str(e)}", exc_info=True)
+            return jsonify({'success': False, 'message': str(e)}), 500
+    
+    return jsonify({
+        'success': True,
+        'message': '文件已上传完成，未重复处理' if already_finalized else '文件上传成功',
+        'already_finalized': already_finalized,
+        'file': {
+            'name': original_filename,
+            'path': filepath,
+            'size': round(stats['bytes'] / 1024 / 1024, 2),
+            'saved_as': filename,
+            'sha256': stats['sha256'],
+            'deduplicated': stats['deduplicated']
+        }
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """查询后台发送任务的阶段、进度和耗时"""
+    try:
+        job = load_job(get_jobs_dir(), job_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    
+    job['success'] = job['status'] != 'failed'
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    取消后台发送任务
+    
+    排队中的任务立即取消；正在转换的任务终止 Calibre 进程后取消（202）；已结束的任务返回409
+    """
+    jobs_dir = get_jobs_dir()
+    try:
+        job = load_job(jobs_dir, job_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    if job['status'] in ('succeeded', 'failed', 'cancelled'):
+        return jsonify({'success': False, 'message': '任务已结束，无法取消', 'status': job['status']}), 409
+    
+    request_cancel(jobs_dir, job_id)
+    if cancel_pending(get_delivery_db(), job_id):
+        logger.info(f"[QUEUE] 任务 {job_id} 在排队中被取消")
+        update_job(jobs_dir, job_id, status='cancelled', finished=time.time(), error='任务已取消')
+        return jsonify({'success': True, 'message': '任务已取消', 'status': 'cancelled'})
+    
+    logger.info(f"[QUEUE] 任务 {job_id} 正在执行，请求取消")
+    return jsonify({'success': True, 'message': '正在取消任务', 'status': 'cancelling'}), 202
+
+@app.route('/api/accounts', methods=['GET'])
+def get_accounts_status():
+    """查询各发件账号的健康状态、配额和平均延迟（不含密码）"""
+    accounts = get_sender_accounts(load_config())
+    health = get_health(get_rate_limit_db(), accounts)
+    now = time.time()
+    items = []
+    for account in accounts:
+        state = health.get(account_key(account), {})
+        cooldown = max(state.get('cooldown_until', 0) - now, 0)
+        items.append({
+            'smtp_email': account['smtp_email'],
+            'smtp_server': f"{account['smtp_server']}:{account['smtp_port']}",
+            'healthy': not cooldown and not state.get('auth_failed'),
+            'auth_failed': bool(state.get('auth_failed')),
+            'cooldown_seconds': round(cooldown),
+            'consecutive_failures': state.get('failures', 0),
+            'average_latency': round(state['latency'], 3) if state.get('latency') is not None else None,
+            'sends': state.get('sends', 0),
+            'last_error': state.get('last_error'),
+            'messages_per_minute': account['limits'].messages_per_minute,
+            'bytes_per_hour': account['limits'].bytes_per_hour
+        })
+    return jsonify({'success': True, 'accounts': items})
+
+@app.route('/api/convert/status', methods=['GET'])
+def get_convert_status():
+    """查询本工作进程转换池的并发数和排队数，以及Calibre是否可用"""
+    converter = get_converter()
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        **get_convert_pool().stats(),
+        'converter_ready': converter['ready'],
+        'converter': {
+            'path': converter['path'],
+            'version': converter['version'],
+            'input_formats': converter['input_formats']
+        }
+    })
+
 @app.route('/api/docs')
 def api_docs():
     """API文档"""
@@ -519,6 +1936,7 @@ def api_docs():
         'version': '2.0',
         'description': '既包含Web界面，也提供API接口',
         'web_interface': 'http://localhost:5000',
+        'request_encodings': supported_encodings(),
         'api_endpoints': [
             {
                 'path': '/api/send-to-kindle',
@@ -527,14 +1945,78 @@ def api_docs():
                 'parameters': {
                     'file': '要发送的文件 (必需)',
                     'convert_pdf': '是否转换PDF为EPUB，true/false (可选)',
-                    'kindle_email': '目标Kindle邮箱 (可选，默认使用环境变量)'
+                    'kindle_email': '目标Kindle邮箱，多个用逗号分隔 (可选，默认使用环境变量)',
+                    'kindle_emails': '目标Kindle邮箱，可重复多次；多个邮箱在一封邮件中发送，返回每个邮箱的结果 (可选)',
+                    'async': '为true时后台转换发送，立即返回job_id (可选)'
                 },
                 'example': 'curl -X POST -F "file=@book.pdf" http://localhost:5000/api/send-to-kindle'
             },
             {
                 'path': '/api/process',
                 'method': 'POST',
-                'description': 'Web界面使用的处理接口'
+                'description': 'Web界面使用的处理接口，async=true时立即返回job_id'
+            },
+            {
+                'path': '/api/jobs/<job_id>',
+                'method': 'GET',
+                'description': '查询后台发送任务的状态（status/stage/progress/timings）',
+                'example': 'curl http://localhost:5000/api/jobs/<job_id>'
+            },
+            {
+                'path': '/api/jobs/<job_id>/cancel',
+                'method': 'POST',
+                'description': '取消后台发送任务（排队中的任务立即取消，正在转换的任务终止转换进程；发送开始后无法取消）',
+                'example': 'curl -X POST http://localhost:5000/api/jobs/<job_id>/cancel'
+            },
+            {
+                'path': '/api/accounts',
+                'method': 'GET',
+                'description': '查询发件账号的健康状态、配额和平均延迟（config.json 的 smtp_accounts 可配置多个发件账号）',
+                'example': 'curl http://localhost:5000/api/accounts'
+            },
+            {
+                'path': '/api/convert/status',
+                'method': 'GET',
+                'description': '查询格式转换的并发数和排队数（排队已满时转换接口返回503和Retry-After），以及Calibre是否可用、版本和支持的输入格式',
+                'example': 'curl http://localhost:5000/api/convert/status'
+            },
+            {
+                'path': '/api/batch',
+                'method': 'POST',
+                'description': '一次上传多个文件，边接收边转换发送，返回每个文件的结果清单',
+                'parameters': {
+                    'file': '要发送的文件，可重复多次 (必需)',
+                    'convert_pdf': '是否转换PDF为EPUB，true/false (可选，需放在文件之前)',
+                    'kindle_email': '目标Kindle邮箱 (可选，需放在文件之前)',
+                    'async': 'true时放入发送队列后立即返回每个文件的job_id，同一批文件合并成尽量少的邮件发送 (可选)'
+                },
+                'example': 'curl -X POST -F "file=@1.pdf" -F "file=@2.epub" http://localhost:5000/api/batch'
+            },
+            {
+                'path': '/api/uploads',
+                'method': 'POST',
+                'description': '创建分块上传会话（断点续传）',
+                'parameters': {
+                    'filename': '原始文件名 (必需)',
+                    'size': '文件总大小，字节 (必需)',
+                    'chunk_size': '分块大小，字节 (可选，默认8MB)',
+                    'sha256': '文件SHA-256 (可选)，完成时校验上传的内容'
+                }
+            },
+            {
+                'path': '/api/uploads/<upload_id>',
+                'method': 'GET',
+                'description': '查询已上传的分块'
+            },
+            {
+                'path': '/api/uploads/<upload_id>/chunks/<index>',
+                'method': 'PUT',
+                'description': '上传一个分块，请求体为原始字节，可按任意顺序上传'
+            },
+            {
+                'path': '/api/uploads/<upload_id>/complete',
+                'method': 'POST',
+                'description': '完成上传，process=true时继续转换并发送到Kindle，再加async=true时在后台发送并返回job_id'
             },
             {
                 'path': '/api/config',
@@ -558,7 +2040,8 @@ def get_history():
     
     if upload_dir.exists():
         for file_path in upload_dir.glob('*'):
-            if file_path.is_file():
+            # 跳过队列、限流数据库等内部文件（以 . 开头）
+            if file_path.is_file() and not file_path.name.startswith('.'):
                 files.append({
                     'name': file_path.name,
                     'size': round(file_path.stat().st_size / 1024 / 1024, 2),
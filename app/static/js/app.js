@@ -1,6 +1,7 @@
 // Kindle Transfer App - 前端JavaScript
 
 let currentFile = null;
+let currentFiles = [];
 
 // 页面加载时初始化
 document.addEventListener('DOMContentLoaded', function() {
@@ -29,7 +30,7 @@ function setupDragDrop() {
         
         const files = e.dataTransfer.files;
         if (files.length > 0) {
-            handleFile(files[0]);
+            handleFiles(files);
         }
     });
 }
@@ -39,14 +40,33 @@ function setupFileInput() {
     const fileInput = document.getElementById('fileInput');
     fileInput.addEventListener('change', (e) => {
         if (e.target.files.length > 0) {
-            handleFile(e.target.files[0]);
+            handleFiles(e.target.files);
         }
     });
 }
 
+// 处理选择的文件（多个文件时批量发送）
+function handleFiles(files) {
+    if (files.length === 1) {
+        handleFile(files[0]);
+        return;
+    }
+    
+    currentFiles = Array.from(files);
+    currentFile = null;
+    
+    const totalSize = currentFiles.reduce((sum, file) => sum + file.size, 0);
+    document.getElementById('fileName').textContent = `${currentFiles.length} 个文件`;
+    document.getElementById('fileSize').textContent = (totalSize / 1024 / 1024).toFixed(2) + ' MB';
+    document.getElementById('fileInfo').classList.remove('hidden');
+    
+    showNotification(`已选择 ${currentFiles.length} 个文件，点击"发送到Kindle"开始处理`, 'info');
+}
+
 // 处理文件
 function handleFile(file) {
     currentFile = file;
+    currentFiles = [];
     
     // 显示文件信息
     document.getElementById('fileName').textContent = file.name;
@@ -57,8 +77,16 @@ function handleFile(file) {
     showNotification('文件已选择，点击"发送到Kindle"开始处理', 'info');
 }
 
-// 处理并发送文件
+// 分块上传参数
+const CHUNK_SIZE = 8 * 1024 * 1024;  // 8MB
+const MAX_CHUNK_RETRIES = 5;
+
+// 处理并发送文件（分块上传，失败后可从断点继续）
 async function processFile() {
+    if (currentFiles.length > 1) {
+        return processBatch();
+    }
+    
     if (!currentFile) {
         showNotification('请先选择文件', 'error');
         return;
@@ -66,116 +94,300 @@ async function processFile() {
     
     // 显示进度条
     const progressContainer = document.getElementById('progressContainer');
-    const progressBar = document.getElementById('progressBar');
     const progressText = document.getElementById('progressText');
-    const progressPercent = document.getElementById('progressPercent');
     
     progressContainer.classList.remove('hidden');
     
+    const file = currentFile;
     const startTime = Date.now();
     console.log('=== 开始上传文件 ===');
-    console.log(`文件名: ${currentFile.name}`);
-    console.log(`文件大小: ${(currentFile.size / 1024 / 1024).toFixed(2)} MB`);
-    console.log(`文件类型: ${currentFile.type}`);
+    console.log(`文件名: ${file.name}`);
+    console.log(`文件大小: ${(file.size / 1024 / 1024).toFixed(2)} MB`);
+    console.log(`文件类型: ${file.type}`);
     
     try {
-        // 准备上传
-        progressText.textContent = '准备上传...';
-        updateProgress(10);
+        progressText.textContent = '连接服务器...';
+        updateProgress(5);
+        
+        // 1. 创建或恢复上传会话
+        const session = await getUploadSession(file);
+        const received = new Set(session.received_chunks || []);
+        let uploadedBytes = session.received_bytes || 0;
+        
+        if (received.size > 0) {
+            console.log(`恢复上传: 已有 ${received.size}/${session.total_chunks} 块`);
+        }
+        
+        if (session.deduplicated) {
+            console.log('服务器已有相同内容的文件，跳过上传');
+        }
+        
+        // 2. 上传缺失的分块（上传阶段占60%进度）
+        for (let index = 0; index < session.total_chunks && !session.deduplicated; index++) {
+            if (received.has(index)) {
+                continue;
+            }
+            
+            uploadedBytes += await uploadChunk(session.upload_id, file, index, session.chunk_size);
+            
+            const percentComplete = Math.round((uploadedBytes / file.size) * 100);
+            const uploadSpeed = (uploadedBytes / 1024 / 1024) / ((Date.now() - startTime) / 1000);
+            console.log(`上传进度: ${percentComplete}%, 速度: ${uploadSpeed.toFixed(2)} MB/s`);
+            
+            updateProgress(Math.round(percentComplete * 0.6));
+            progressText.textContent = `上传中... ${percentComplete}% (${uploadSpeed.toFixed(1)} MB/s)`;
+        }
+        
+        const uploadTime = (Date.now() - startTime) / 1000;
+        console.log(`上传完成，耗时: ${uploadTime.toFixed(2)}秒`);
         
-        const formData = new FormData();
-        formData.append('file', currentFile);
+        // 3. 完成上传并转换发送
+        progressText.textContent = '正在发送到Kindle...';
+        updateProgress(70);
+        
+        const response = await fetch(`/api/uploads/${session.upload_id}/complete`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ process: true, async: true })
+        });
+        const result = await response.json();
+        console.log('服务器响应:', result);
+        
+        // 除了分块缺失（400）外，会话都已在服务器端结束，不再需要续传
+        if (response.status !== 400) {
+            localStorage.removeItem(uploadSessionKey(file));
+        }
+        
+        if (!result.success) {
+            throw new Error(result.message);
+        }
+        
+        // 4. 后台转换发送，轮询任务状态
+        const job = await waitForJob(result.job_id, progressText);
+        if (job.status === 'failed') {
+            throw new Error(job.error || '发送失败');
+        }
+        
+        if (job.status === 'retrying') {
+            progressText.textContent = '发送暂时失败，服务器将自动重试';
+            showNotification(`发送暂时失败（${job.error}），服务器将自动重试，无需重新上传`, 'info');
+            setTimeout(resetUploadArea, 3000);
+            return;
+        }
+        
+        updateProgress(100);
+        progressText.textContent = '发送成功！';
+        showNotification('处理完成！文件已发送到Kindle', 'success');
+        console.log('服务器处理耗时:', job.timings);
+        
+        // 刷新历史记录
+        setTimeout(() => {
+            loadHistory();
+            resetUploadArea();
+        }, 2000);
+        
+    } catch (error) {
+        console.error('处理失败:', error);
+        showNotification('处理失败: ' + error.message + '，重新发送将从断点继续', 'error');
+        progressContainer.classList.add('hidden');
+    }
+}
+
+// 任务状态轮询间隔
+const JOB_POLL_INTERVAL = 1000;
+
+const JOB_STAGE_TEXT = {
+    queued: '排队中...',
+    throttled: '发送过于频繁，稍后自动发送...',
+    converting: '正在转换格式...',
+    sending: '正在发送到Kindle...',
+    done: '发送成功！'
+};
+
+// 轮询后台任务直到结束（发送阶段占70%-100%进度）
+async function waitForJob(jobId, progressText) {
+    while (true) {
+        const response = await fetch(`/api/jobs/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.message);
+        }
         
-        // 创建XMLHttpRequest以监控上传进度
+        updateProgress(70 + Math.round(job.progress * 0.3));
+        progressText.textContent = `${JOB_STAGE_TEXT[job.stage] || job.stage} ${job.progress}%`;
+        
+        // 临时性错误由服务器稍后自动重试，无需继续等待
+        if (job.status === 'succeeded' || job.status === 'failed' || job.status === 'retrying') {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+    }
+}
+
+// 批量发送：一个请求上传所有文件，服务器边接收边发送
+function processBatch() {
+    const files = currentFiles;
+    const progressContainer = document.getElementById('progressContainer');
+    const progressText = document.getElementById('progressText');
+    progressContainer.classList.remove('hidden');
+    
+    const formData = new FormData();
+    files.forEach(file => formData.append('file', file));
+    
+    const startTime = Date.now();
+    console.log(`=== 开始批量上传 ${files.length} 个文件 ===`);
+    
+    return new Promise(resolve => {
         const xhr = new XMLHttpRequest();
         
-        // 监听上传进度
-        xhr.upload.addEventListener('progress', (e) => {
+        xhr.upload.onprogress = (e) => {
             if (e.lengthComputable) {
                 const percentComplete = Math.round((e.loaded / e.total) * 100);
                 const uploadSpeed = (e.loaded / 1024 / 1024) / ((Date.now() - startTime) / 1000);
-                
-                console.log(`上传进度: ${percentComplete}%, 速度: ${uploadSpeed.toFixed(2)} MB/s`);
-                
-                // 上传阶段占60%进度
-                const displayPercent = Math.round(percentComplete * 0.6);
-                updateProgress(displayPercent);
+                updateProgress(Math.round(percentComplete * 0.9));
                 progressText.textContent = `上传中... ${percentComplete}% (${uploadSpeed.toFixed(1)} MB/s)`;
             }
-        });
+        };
         
-        // 监听状态变化
-        xhr.onreadystatechange = function() {
-            console.log(`XHR状态: readyState=${xhr.readyState}, status=${xhr.status}`);
+        xhr.upload.onload = () => {
+            progressText.textContent = '正在发送到Kindle...';
+        };
+        
+        xhr.onload = () => {
+            let result;
+            try {
+                result = JSON.parse(xhr.responseText);
+            } catch (error) {
+                result = { success: false, message: `服务器错误 (${xhr.status})` };
+            }
+            console.log('服务器响应:', result);
             
-            if (xhr.readyState === 4) {
-                const uploadTime = (Date.now() - startTime) / 1000;
-                console.log(`上传完成，耗时: ${uploadTime.toFixed(2)}秒`);
-                
-                if (xhr.status === 200) {
-                    try {
-                        const result = JSON.parse(xhr.responseText);
-                        console.log('服务器响应:', result);
-                        
-                        if (result.success) {
-                            updateProgress(100);
-                            progressText.textContent = '发送成功！';
-                            showNotification(result.message, 'success');
-                            
-                            if (result.details && result.details.processing_time) {
-                                console.log(`服务器处理时间: ${result.details.processing_time}`);
-                            }
-                            
-                            // 刷新历史记录
-                            setTimeout(() => {
-                                loadHistory();
-                                resetUploadArea();
-                            }, 2000);
-                        } else {
-                            throw new Error(result.message);
-                        }
-                    } catch (e) {
-                        console.error('解析响应失败:', e);
-                        throw new Error('服务器响应格式错误');
-                    }
-                } else {
-                    console.error(`上传失败: HTTP ${xhr.status}`);
-                    throw new Error(`上传失败: HTTP ${xhr.status}`);
+            (result.results || []).forEach(item => {
+                if (!item.success) {
+                    console.error(`发送失败: ${item.filename} - ${item.error}`);
                 }
+            });
+            
+            if (result.results && result.results.some(item => item.success)) {
+                updateProgress(100);
+                progressText.textContent = result.message;
+                showNotification(result.message, result.success ? 'success' : 'error');
+                setTimeout(() => {
+                    loadHistory();
+                    resetUploadArea();
+                }, 2000);
+            } else {
+                showNotification('处理失败: ' + result.message, 'error');
+                progressContainer.classList.add('hidden');
             }
+            resolve();
         };
         
-        // 监听错误
-        xhr.onerror = function() {
-            const uploadTime = (Date.now() - startTime) / 1000;
-            console.error(`网络错误，耗时: ${uploadTime.toFixed(2)}秒`);
-            showNotification('网络连接失败，请检查网络', 'error');
-            progressContainer.classList.add('hidden');
-        };
-        
-        // 监听超时
-        xhr.ontimeout = function() {
-            const uploadTime = (Date.now() - startTime) / 1000;
-            console.error(`请求超时，耗时: ${uploadTime.toFixed(2)}秒`);
-            showNotification('上传超时，请重试', 'error');
+        xhr.onerror = () => {
+            showNotification('处理失败: 网络错误', 'error');
             progressContainer.classList.add('hidden');
+            resolve();
         };
         
-        // 设置超时（5分钟）
-        xhr.timeout = 300000;
-        
-        // 开始上传
-        console.log('开始发送请求...');
-        progressText.textContent = '连接服务器...';
-        updateProgress(5);
-        
-        xhr.open('POST', '/api/process', true);
+        xhr.open('POST', '/api/batch');
         xhr.send(formData);
-        
+    });
+}
+
+// 上传会话在本地保存的键（同一文件再次发送时恢复）
+function uploadSessionKey(file) {
+    return `kindle-upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+// 获取上传会话：优先恢复未完成的会话，否则新建
+async function getUploadSession(file) {
+    const key = uploadSessionKey(file);
+    const savedId = localStorage.getItem(key);
+    
+    if (savedId) {
+        try {
+            const response = await fetch(`/api/uploads/${savedId}`);
+            const status = await response.json();
+            if (response.ok && status.success) {
+                return status;
+            }
+        } catch (error) {
+            console.error('查询上传会话失败:', error);
+        }
+        localStorage.removeItem(key);
+    }
+    
+    const response = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            filename: file.name,
+            size: file.size,
+            chunk_size: CHUNK_SIZE,
+            sha256: await computeSha256(file)
+        })
+    });
+    const session = await response.json();
+    
+    if (!session.success) {
+        throw new Error(session.message);
+    }
+    
+    localStorage.setItem(key, session.upload_id);
+    return session;
+}
+
+// 计算文件SHA-256，服务器已有相同内容时可跳过上传（浏览器不支持时返回null）
+async function computeSha256(file) {
+    if (!window.crypto || !window.crypto.subtle) {
+        return null;
+    }
+    try {
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest))
+            .map(b => b.toString(16).padStart(2, '0'))
+            .join('');
     } catch (error) {
-        console.error('处理失败:', error);
-        showNotification('处理失败: ' + error.message, 'error');
-        progressContainer.classList.add('hidden');
+        console.error('计算文件摘要失败:', error);
+        return null;
+    }
+}
+
+// 上传单个分块，网络错误或服务器错误时按指数退避重试
+async function uploadChunk(uploadId, file, index, chunkSize) {
+    const start = index * chunkSize;
+    const blob = file.slice(start, Math.min(start + chunkSize, file.size));
+    
+    for (let attempt = 1; ; attempt++) {
+        let response = null;
+        try {
+            response = await fetch(`/api/uploads/${uploadId}/chunks/${index}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/octet-stream'
+                },
+                body: blob
+            });
+            if (response.ok) {
+                return blob.size;
+            }
+        } catch (error) {
+            console.error(`分块 ${index} 上传失败（第${attempt}次）:`, error);
+        }
+        
+        // 4xx错误重试也不会成功
+        if (response && response.status < 500) {
+            const result = await response.json();
+            throw new Error(result.message || `上传失败: HTTP ${response.status}`);
+        }
+        if (attempt >= MAX_CHUNK_RETRIES) {
+            throw new Error('网络连接失败，请检查网络');
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * Math.pow(2, attempt - 1)));
     }
 }
 
@@ -191,6 +403,7 @@ function updateProgress(percent) {
 // 重置上传区域
 function resetUploadArea() {
     currentFile = null;
+    currentFiles = [];
     document.getElementById('fileInfo').classList.add('hidden');
     document.getElementById('progressContainer').classList.add('hidden');
     document.getElementById('fileInput').value = '';
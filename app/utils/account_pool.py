@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多个发件账号的负载均衡与故障切换
+
+每个发件账号（dict，含 smtp_email / smtp_password / smtp_server / smtp_port / limits）记录：
+- 健康状态：连续失败次数、冷却截止时间、最近一次错误
+- 配额：limits（RateLimits），通过 rate_limiter 的令牌桶控制
+- 延迟：每次发送耗时的指数移动平均
+
+选择账号时按「本进程正在发送的数量、平均延迟」从低到高依次尝试取令牌，第一个取得令牌的账号用于发送：
+- 被服务器限流（421/450/451/452）的账号进入冷却，冷却时间随连续失败次数翻倍，冷却期间不会被选中
+- 认证失败的账号排到最后，只有没有其他可用账号时才使用（用户修改授权码后可以立即恢复）
+
+健康状态保存在与令牌桶相同的 SQLite 数据库中，所有 gunicorn 工作进程共用。
+注意：所有发件账号都需要加入亚马逊「已认可的发件人电子邮箱列表」。
+"""
+import time
+import smtplib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from app.utils.rate_limiter import reserve
+
+
+# 限流后的冷却时间（秒），连续失败时翻倍，不超过 THROTTLE_COOLDOWN_MAX
+THROTTLE_COOLDOWN = 300
+THROTTLE_COOLDOWN_MAX = 3600
+
+# 延迟移动平均的权重
+LATENCY_ALPHA = 0.3
+
+# 服务器限流时返回的响应码
+THROTTLE_CODES = {421, 450, 451, 452}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sender_health (
+    account TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    auth_failed INTEGER NOT NULL DEFAULT 0,
+    cooldown_until REAL NOT NULL DEFAULT 0,
+    latency REAL,
+    sends INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL NOT NULL
+);
+'''
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+# 本进程中每个账号正在进行的发送数
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA busy_timeout = 30000')
+    with _init_lock:
+        if db_path not in _initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_SCHEMA)
+            _initialized.add(db_path)
+    return conn
+
+
+def account_key(account):
+    """账号标识（邮箱地址，不区分大小写）"""
+    return account['smtp_email'].lower()
+
+
+def classify_error(error):
+    """
+    判断发送错误是否由发件账号引起（换账号发送可能成功）
+
+    Returns:
+        str: 'auth'（认证失败）、'throttle'（被限流），与账号无关的错误返回 None
+    """
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return 'auth'
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # 收件人被拒绝与发件账号无关
+        return None
+    if isinstance(error, smtplib.SMTPResponseException):
+        if error.smtp_code in (530, 534, 535):
+            return 'auth'
+        if error.smtp_code in THROTTLE_CODES:
+            return 'throttle'
+    return None
+
+
+def get_health(db_path, accounts):
+    """
+    读取账号的健康状态
+
+    Returns:
+        dict: 账号标识 -> 状态（未发送过的账号没有记录）
+    """
+    conn = _connect(db_path)
+    try:
+        keys = [account_key(account) for account in accounts]
+        if not keys:
+            return {}
+        rows = conn.execute(
+            f"SELECT * FROM sender_health WHERE account IN ({', '.join('?' * len(keys))})", keys
+        ).fetchall()
+        return {row['account']: dict(row) for row in rows}
+    finally:
+        conn.close()
+
+
+def choose_account(db_path, accounts, messages, nbytes, exclude=()):
+    """
+    选择负载最低且配额足够的账号，并扣减其令牌
+
+    Args:
+        accounts: 账号列表
+        messages, nbytes: 要发送的邮件封数和字节数
+        exclude: 本次发送已经失败过的账号标识
+
+    Returns:
+        tuple: (账号, 0)；没有账号可以立即发送时为 (None, 需要等待的秒数)，
+               没有可用账号（都已排除）时为 (None, 0)
+    """
+    now = time.time()
+    health = get_health(db_path, accounts)
+    candidates = []
+    cooling = []
+    for account in accounts:
+        key = account_key(account)
+        if key in exclude:
+            continue
+        state = health.get(key, {})
+        if state.get('cooldown_until', 0) > now:
+            cooling.append(state['cooldown_until'] - now)
+            continue
+        with _in_flight_lock:
+            load = _in_flight.get(key, 0)
+        candidates.append(((state.get('auth_failed', 0), load, state.get('latency') or 0), account))
+    candidates.sort(key=lambda item: item[0])
+
+    waits = list(cooling)
+    for _, account in candidates:
+        wait = reserve(db_path, account['smtp_email'], messages, nbytes, account.get('limits'))
+        if wait == 0:
+            return account, 0
+        waits.append(wait)
+    return None, min(waits) if waits else 0
+
+
+@contextmanager
+def sending(account):
+    """发送期间计入账号的负载：with sending(account): ..."""
+    key = account_key(account)
+    with _in_flight_lock:
+        _in_flight[key] = _in_flight.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight[key] = max(_in_flight.get(key, 0) - 1, 0)
+
+
+def record_success(db_path, account, latency):
+    """发送成功：清除失败记录，更新平均延迟"""
+    now = time.time()
+    conn = _connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT latency, sends FROM sender_health WHERE account = ?',
+                           (account_key(account),)).fetchone()
+        if row is None or row['latency'] is None:
+            average = latency
+        else:
+            average = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * row['latency']
+        conn.execute(
+            'INSERT OR REPLACE INTO sender_health '
+            '(account, failures, auth_failed, cooldown_until, latency, sends, last_error, updated_at) '
+            'VALUES (?, 0, 0, 0, ?, ?, NULL, ?)',
+            (account_key(account), average, (row['sends'] if row else 0) + 1, now)
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def record_failure(db_path, account, error):
+    """
+    发送失败：由账号引起的错误更新健康状态
+
+    Returns:
+        str: classify_error 的结果，与账号无关的错误返回 None（不记录）
+    """
+    kind = classify_error(error)
+    if kind is None:
+        return None
+
+    now = time.time()
+    conn = _connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT * FROM sender_health WHERE account = ?',
+                           (account_key(account),)).fetchone()
+        state = dict(row) if row else {'failures': 0, 'auth_failed': 0, 'cooldown_until': 0,
+                                       'latency': None, 'sends': 0}
+        state['failures'] += 1
+        if kind == 'auth':
+            state['auth_failed'] = 1
+        else:
+            cooldown = min(THROTTLE_COOLDOWN * 2 ** (state['failures'] - 1), THROTTLE_COOLDOWN_MAX)
+            state['cooldown_until'] = now + cooldown
+        conn.execute(
+            'INSERT OR REPLACE INTO sender_health '
+            '(account, failures, auth_failed, cooldown_until, latency, sends, last_error, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (account_key(account), state['failures'], state['auth_failed'], state['cooldown_until'],
+             state['latency'], state['sends'], str(error), now)
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return kind
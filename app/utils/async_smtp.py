@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于 asyncio 的SMTP发送引擎
+
+smtplib 是阻塞的，每个正在发送的邮件都要占用一个线程等待网络。这里用 asyncio 实现一个精简的SMTP客户端，
+所有连接在一个专用线程的事件循环中复用，几百个并发发送也只需要一个线程：
+- 465端口使用SSL，其余端口使用STARTTLS（与 smtp_pool.open_smtp_connection 一致）
+- 附件按块从磁盘读取并编码（在线程池中完成），边编码边写入连接，写入时等待缓冲区排空
+- 读取响应、等待缓冲区排空和 STARTTLS 握手都有超时（timeout），服务器不再接收数据时不会一直挂起
+- 服务器支持 CHUNKING 和 BINARYMIME 时附件以原始字节通过 BDAT 发送（与 mime_stream 一致）
+- 已登录的连接按 (服务器, 端口, 账号) 复用，每个账号的并发连接数受 MAX_CONNECTIONS_PER_ACCOUNT 限制
+- 错误以 smtplib 的异常类型抛出，is_transient_error / classify_error 可以直接判断
+
+同步代码（Flask路由、发送线程）通过 submit_send() 提交，返回 concurrent.futures.Future，
+调用 result() 等待结果；结果格式与 kindle_sender.send_files_to_kindle 相同。
+"""
+import os
+import time
+import base64
+import atexit
+import asyncio
+import smtplib
+import threading
+
+from app.utils.kindle_sender import plan_messages, group_attachments, transfer_is_binary
+from app.utils.mime_stream import (
+    build_multi_message_frame,
+    iter_parts,
+    remember_binary_support,
+    READ_BLOCK_SIZE,
+    BDAT_CHUNK_SIZE
+)
+from app.utils.smtp_pool import (
+    MAX_CONNECTIONS_PER_ACCOUNT,
+    IDLE_TIMEOUT,
+    SOCKET_TIMEOUT,
+    is_stale_error,
+    get_ssl_context,
+    remember_tls_session
+)
+
+
+def tls_mode(smtp_port):
+    """连接方式：465端口为 'ssl'，其余为 'starttls'"""
+    return 'ssl' if smtp_port == 465 else 'starttls'
+
+
+class AsyncSMTPClient:
+    """单个SMTP连接（只在事件循环线程中使用）"""
+
+    def __init__(self, host, port, tls='ssl', timeout=SOCKET_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+
+    async def connect(self):
+        """建立连接并完成 EHLO（需要时先 STARTTLS）"""
+        context = get_ssl_context() if self.tls else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port,
+                                    ssl=context if self.tls == 'ssl' else None),
+            self.timeout
+        )
+        code, msg = await self._read_reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        await self.ehlo()
+
+        if self.tls == 'starttls':
+            if 'starttls' not in self.extensions:
+                raise smtplib.SMTPNotSupportedError('服务器不支持STARTTLS')
+            code, msg = await self.command('STARTTLS')
+            if code != 220:
+                raise smtplib.SMTPResponseException(code, msg)
+            try:
+                await asyncio.wait_for(self.writer.start_tls(context, server_hostname=self.host),
+                                       self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('STARTTLS握手超时')
+            await self.ehlo()
+
+    async def _read_reply(self):
+        """读取一个（可能多行的）响应，返回 (响应码, 内容)"""
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('等待服务器响应超时')
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            try:
+                code = int(line[:3])
+            except ValueError:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(f'无效的响应: {line!r}')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def _drain(self):
+        """等待写缓冲区排空（服务器长时间不接收数据时视为断开）"""
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise smtplib.SMTPServerDisconnected('发送数据超时')
+
+    async def command(self, line):
+        """发送一条命令并读取响应"""
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('连接已关闭')
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self._drain()
+        return await self._read_reply()
+
+    async def ehlo(self):
+        code, msg = await self.command('EHLO kindle-transfer')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, msg)
+        self.extensions = {}
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.lower()] = params
+
+    async def login(self, user, password):
+        """AUTH PLAIN（服务器不支持时使用 AUTH LOGIN）"""
+        methods = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in methods or 'LOGIN' not in methods:
+            token = base64.b64encode(f'\0{user}\0{password}'.encode('utf-8')).decode('ascii')
+            code, msg = await self.command(f'AUTH PLAIN {token}')
+        else:
+            code, msg = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(user.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def rset(self):
+        return await self.command('RSET')
+
+    def supports_binary(self):
+        """是否支持 BDAT 二进制传输（CHUNKING + BINARYMIME）"""
+        return 'chunking' in self.extensions and 'binarymime' in self.extensions
+
+    async def send_frame(self, sender, recipient, frame, progress_callback=None):
+        """
+        发送一封邮件，附件边读取编码边写入连接
+
+        Returns:
+            dict: 被拒绝的收件人（recipient 为列表时逐个 RCPT TO，与 mime_stream.send_message_stream 一致）
+        """
+        options = f' SIZE={frame.size}' if 'size' in self.extensions else ''
+        if frame.binary:
+            options += ' BODY=BINARYMIME'
+        code, msg = await self.command(f'MAIL FROM:<{sender}>{options}')
+        if code != 250:
+            await self._reset(code)
+            raise smtplib.SMTPSenderRefused(code, msg, sender)
+
+        recipients = [recipient] if isinstance(recipient, str) else list(recipient)
+        refused = {}
+        for address in recipients:
+            code, msg = await self.command(f'RCPT TO:<{address}>')
+            if code not in (250, 251):
+                refused[address] = (code, msg)
+            if code == 421:
+                break
+        if len(refused) == len(recipients) or code == 421:
+            await self._reset(code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if frame.binary:
+            await self._send_chunked(frame, progress_callback)
+            return refused
+
+        code, msg = await self.command('DATA')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, msg)
+
+        loop = asyncio.get_running_loop()
+        sent = 0
+
+        async def write(chunk):
+            nonlocal sent
+            self.writer.write(chunk)
+            await self._drain()
+            sent += len(chunk)
+            if progress_callback is not None:
+                progress_callback(sent, frame.size)
+
+        # 读取、编码和写入附件缓存都在线程池中进行，已缓存的附件按块读出后直接写入
+        parts = iter_parts(frame)
+        try:
+            while True:
+                item = await loop.run_in_executor(None, next, parts, None)
+                if item is None:
+                    break
+                if isinstance(item, bytes):
+                    await write(item)
+                    continue
+                while True:
+                    chunk = await loop.run_in_executor(None, item.read, READ_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    await write(chunk)
+        finally:
+            parts.close()
+
+        self.writer.write(b'.\r\n')
+        await self._drain()
+        code, msg = await self._read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, msg)
+        return refused
+
+    async def _send_chunked(self, frame, progress_callback=None):
+        """用 BDAT 分块发送邮件内容（分块方式与 mime_stream._send_chunked 相同）"""
+        loop = asyncio.get_running_loop()
+        sent = 0
+        pending = b''
+
+        async def chunk(data, f=None, count=0, last=False):
+            nonlocal sent
+            size = len(data) + count
+            self.writer.write(f"BDAT {size}{' LAST' if last else ''}\r\n".encode('ascii') + data)
+            while count > 0:
+                block = await loop.run_in_executor(None, f.read, min(READ_BLOCK_SIZE, count))
+                if not block:
+                    raise OSError('文件在发送过程中被截断')
+                self.writer.write(block)
+                await self._drain()
+                count -= len(block)
+            await self._drain()
+            code, msg = await self._read_reply()
+            if code != 250:
+                raise smtplib.SMTPDataError(code, msg)
+            sent += size
+            if progress_callback is not None:
+                progress_callback(sent, frame.size)
+
+        parts = iter_parts(frame)
+        try:
+            while True:
+                item = await loop.run_in_executor(None, next, parts, None)
+                if item is None:
+                    break
+                if isinstance(item, bytes):
+                    pending += item
+                    continue
+                remaining = os.fstat(item.fileno()).st_size - item.tell()
+                while remaining > 0:
+                    count = min(remaining, max(BDAT_CHUNK_SIZE - len(pending), READ_BLOCK_SIZE))
+                    await chunk(pending, item, count)
+                    pending = b''
+                    remaining -= count
+            await chunk(pending, last=True)
+        finally:
+            parts.close()
+
+    async def _reset(self, code):
+        """命令被拒绝后清除事务状态（421表示服务器即将断开，无需RSET）"""
+        if code == 421:
+            self.close()
+        else:
+            await self.rset()
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class DeliveryEngine:
+    """在专用线程的事件循环中运行所有SMTP发送"""
+
+    def __init__(self, max_per_account=MAX_CONNECTIONS_PER_ACCOUNT, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_account = max_per_account
+        self.idle_timeout = idle_timeout
+        self._idle = {}          # key -> [(连接, 放回时间)]
+        self._limits = {}        # key -> asyncio.Semaphore
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='smtp-engine', daemon=True)
+        self._thread.start()
+
+    def submit_send(self, kindle_email, sender_email, sender_password, file_paths,
+                    smtp_server="smtp.163.com", smtp_port=465, subject="convert", progress_callback=None):
+        """
+        提交发送任务（可在任意线程调用）
+
+        Args:
+            progress_callback: progress_callback(已发送字节数, 总字节数)，在事件循环线程中调用，不应阻塞
+            其余参数同 kindle_sender.send_files_to_kindle
+
+        Returns:
+            concurrent.futures.Future: result() 为与 file_paths 一一对应的列表，成功为 None，失败为异常对象
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.send_files(kindle_email, sender_email, sender_password, file_paths,
+                            smtp_server, smtp_port, subject, progress_callback),
+            self._loop
+        )
+
+    def submit_prewarm(self, smtp_server, smtp_port, email, password):
+        """预先建立并登录一个连接放入池中，返回 concurrent.futures.Future"""
+        async def noop(client):
+            return None
+        return asyncio.run_coroutine_threadsafe(
+            self.run(smtp_server, smtp_port, email, password, noop), self._loop)
+
+    async def send_files(self, kindle_email, sender_email, sender_password, file_paths,
+                         smtp_server, smtp_port, subject="convert", progress_callback=None):
+        """合并成尽量少的邮件发送（见 kindle_sender.plan_messages）"""
+        loop = asyncio.get_running_loop()
+        planned = transfer_is_binary(smtp_server, smtp_port)
+        paths, sizes, results, groups = await loop.run_in_executor(None, plan_messages, file_paths, planned)
+        plan = {'binary': planned, 'groups': groups}
+        done = 0
+        total = 0
+        sent = set()
+
+        def on_progress(sent_bytes, _):
+            if progress_callback is not None:
+                progress_callback(done + sent_bytes, total)
+
+        async def deliver(client):
+            nonlocal done, total
+            binary = client.supports_binary()
+            remember_binary_support(smtp_server, smtp_port, binary)
+            if binary != plan['binary']:
+                # 服务器支持的传输方式与计划不同时，按实际方式重新分组尚未发送的文件
+                pending = [index for group in plan['groups'] for index in group
+                           if index not in sent and results[index] is None]
+                plan.update(binary=binary, groups=group_attachments(paths, sizes, results, pending, binary))
+            frames = [build_multi_message_frame(sender_email, kindle_email, subject,
+                                                [(paths[index], sizes[index]) for index in group],
+                                                binary=binary)
+                      for group in plan['groups']]
+            total = done + sum(frame.size for group, frame in zip(plan['groups'], frames)
+                               if group[0] not in sent)
+
+            # 某封邮件被拒绝时记录错误后继续发送下一封；连接断开时换新连接重新调用，已处理的邮件跳过
+            for group, frame in zip(plan['groups'], frames):
+                if group[0] in sent:
+                    continue
+                try:
+                    await client.send_frame(sender_email, kindle_email, frame, on_progress)
+                except smtplib.SMTPResponseException as e:
+                    if e.smtp_code == 421:
+                        raise
+                    for index in group:
+                        results[index] = e
+                sent.update(group)
+                done += frame.size
+
+        try:
+            await self.run(smtp_server, smtp_port, sender_email, sender_password, deliver)
+        except Exception as e:
+            for group in plan['groups']:
+                for index in group:
+                    if index not in sent and results[index] is None:
+                        results[index] = e
+        return results
+
+    async def run(self, smtp_server, smtp_port, email, password, operation):
+        """
+        用池中的连接执行 operation(client)
+
+        复用的连接已被服务器断开时，换新连接重试一次（与 SMTPPool.run 一致）
+        """
+        key = (smtp_server, smtp_port, email)
+        limit = self._limits.setdefault(key, asyncio.Semaphore(self.max_per_account))
+        async with limit:
+            while True:
+                client, reused = await self._checkout(key, password)
+                try:
+                    result = await operation(client)
+                except Exception as e:
+                    client.close()
+                    if reused and is_stale_error(e):
+                        continue
+                    raise
+                self._idle.setdefault(key, []).append((client, time.time()))
+                return result
+
+    async def _checkout(self, key, password):
+        """取出空闲连接（RSET 检查），没有时建立新连接并登录"""
+        idle = self._idle.get(key, [])
+        while idle:
+            client, released_at = idle.pop()
+            if time.time() - released_at > self.idle_timeout:
+                await client.quit()
+                continue
+            try:
+                code, _ = await client.rset()
+                if code == 250:
+                    return client, True
+            except Exception:
+                pass
+            client.close()
+
+        smtp_server, smtp_port, email = key
+        client = AsyncSMTPClient(smtp_server, smtp_port, tls_mode(smtp_port))
+        try:
+            await client.connect()
+            await client.login(email, password)
+        except Exception:
+            client.close()
+            raise
+        remember_tls_session(smtp_server, client.writer.get_extra_info('ssl_object'))
+        return client, False
+
+    async def _close_idle(self):
+        idle, self._idle = self._idle, {}
+        for clients in idle.values():
+            for client, _ in clients:
+                await client.quit()
+
+    def close(self, timeout=5):
+        """关闭空闲连接并停止事件循环"""
+        if not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_idle(), self._loop).result(timeout)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_delivery_engine():
+    """
+    返回本进程的发送引擎
+
+    线程不会被fork继承，按进程号判断：gunicorn fork出的每个工作进程各自启动一个事件循环线程
+    """
+    global _engine, _engine_pid
+    with _engine_lock:
+        if _engine is None or _engine_pid != os.getpid():
+            _engine = DeliveryEngine()
+            _engine_pid = os.getpid()
+        return _engine
+
+
+def shutdown_delivery_engine():
+    """停止本进程的发送引擎"""
+    global _engine
+    with _engine_lock:
+        if _engine is not None and _engine_pid == os.getpid():
+            _engine.close()
+        _engine = None
+
+
+atexit.register(shutdown_delivery_engine)
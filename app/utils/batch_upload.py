@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量上传的流式 multipart 解析
+
+直接从请求流中逐块解析 multipart 请求体，每个文件接收完毕就立即交给调用方，
+调用方可以在后续文件仍在上传时开始转换和发送前面的文件。
+"""
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from app.utils.file_helper import STREAM_CHUNK_SIZE
+from app.utils.upload_guard import UploadRejected
+
+
+# 普通表单字段的最大长度
+MAX_FIELD_SIZE = 64 * 1024
+
+
+def iter_multipart(stream, boundary, container_factory, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    流式解析 multipart 请求体
+
+    Args:
+        stream: 请求体输入流
+        boundary: multipart 边界（bytes）
+        container_factory: container_factory(filename) 返回文件容器（如 SpooledUpload），
+                           可以抛出 UploadRejected 拒绝该文件
+        chunk_size: 每次从请求流读取的字节数
+
+    Yields:
+        ('field', name, value)                  表单字段
+        ('file', name, filename, container)     接收完毕的文件
+        ('error', name, filename, error)        被拒绝的文件（其余文件继续处理）
+
+    Raises:
+        ValueError: 请求体格式错误，此前已交出的文件不受影响
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FIELD_SIZE)
+    current = None
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Field):
+                    current = ['field', event.name, bytearray()]
+                elif isinstance(event, File):
+                    try:
+                        container = container_factory(event.filename)
+                        current = ['file', event.name, event.filename, container]
+                    except UploadRejected as e:
+                        current = ['skip', event.name, event.filename, e]
+                elif isinstance(event, Data) and current is not None:
+                    kind = current[0]
+                    if kind == 'field':
+                        current[2] += event.data
+                    elif kind == 'file':
+                        try:
+                            current[3].write(event.data)
+                        except UploadRejected as e:
+                            current[3].close()
+                            current = ['skip', current[1], current[2], e]
+
+                    if not event.more_data:
+                        # 交出之后文件由调用方负责关闭
+                        finished, current = current, None
+                        kind = finished[0]
+                        if kind == 'field':
+                            yield ('field', finished[1], finished[2].decode('utf-8', 'replace'))
+                        elif kind == 'file':
+                            try:
+                                # 回到开头，同时触发文件头检查
+                                finished[3].seek(0)
+                            except UploadRejected as e:
+                                finished = ('error', finished[1], finished[2], e)
+                            yield tuple(finished)
+                        else:
+                            yield ('error', finished[1], finished[2], finished[3])
+                event = decoder.next_event()
+
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    except ValueError as e:
+        # 请求体格式错误：正在接收的文件报告为失败，之后的内容无法再解析
+        if current is not None and current[0] in ('file', 'skip'):
+            yield ('error', current[1], current[2], UploadRejected(f'请求体解析失败: {e}'))
+        raise
+    finally:
+        # 请求体中途出错或调用方停止迭代时，删除未接收完的文件
+        if current is not None and current[0] == 'file':
+            current[3].close()
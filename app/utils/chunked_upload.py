@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分块断点续传上传工具
+
+每个上传会话在会话目录下占用一个子目录：
+    meta.json   会话信息（文件名、总大小、分块大小）
+    data.part   目标文件，各分块按偏移量直接写入
+    chunks/     已完成分块的标记文件（文件名为分块序号）
+
+分块可以任意顺序上传，完成后 data.part 直接重命名进内容存储，无需再次拼接复制。
+标记文件保存在磁盘上，多个 gunicorn 工作进程可以同时处理同一会话的不同分块。
+
+完成（finalize_upload）在会话锁（<upload_id>.lock）内进行，完成后保存结果（<upload_id>.done.json），
+客户端重试或并发提交完成请求时直接返回同一结果，不会重复组装。
+
+创建会话时提供的 sha256 只用于完成时校验上传的内容；是否与已存储的内容重复
+由服务端对实际收到的字节计算摘要后判断，客户端声明的摘要不能代替上传。
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from app.utils.file_helper import STREAM_CHUNK_SIZE
+from app.utils.file_store import file_sha256, store_file
+
+
+# 默认分块大小 8MB，客户端可在创建会话时指定
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+
+# 超过该时间未活动的会话会被清理（秒）
+SESSION_EXPIRE_SECONDS = 24 * 3600
+
+_UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _session_dir(sessions_dir, upload_id):
+    """返回会话目录，upload_id 不合法时抛出 ValueError"""
+    if not upload_id or not _UPLOAD_ID_PATTERN.match(upload_id):
+        raise ValueError('无效的上传会话ID')
+    return os.path.join(sessions_dir, upload_id)
+
+
+@contextmanager
+def _session_lock(sessions_dir, upload_id):
+    """持有会话的文件锁（跨线程和工作进程），不支持 flock 的系统上不加锁"""
+    if fcntl is None:
+        yield
+        return
+    with open(_session_dir(sessions_dir, upload_id) + '.lock', 'a+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _done_path(sessions_dir, upload_id):
+    """已完成会话的结果文件"""
+    return _session_dir(sessions_dir, upload_id) + '.done.json'
+
+
+def load_finalized(sessions_dir, upload_id):
+    """
+    读取已完成会话的结果
+
+    Returns:
+        tuple: 与 finalize_upload 的返回值相同，会话未完成时返回 None
+    """
+    try:
+        with open(_done_path(sessions_dir, upload_id), 'r', encoding='utf-8') as f:
+            done = json.load(f)
+    except FileNotFoundError:
+        return None
+    return done['meta'], done['filename'], done['filepath'], done['stats']
+
+
+def create_upload_session(sessions_dir, filename, total_size, chunk_size=None, sha256=None):
+    """
+    创建上传会话
+
+    Args:
+        sessions_dir: 会话根目录
+        filename: 原始文件名
+        total_size: 文件总大小（字节）
+        chunk_size: 分块大小（字节，可选）
+        sha256: 客户端计算的内容摘要（可选），完成时用于校验
+
+    Returns:
+        dict: 会话信息
+    """
+    try:
+        total_size = int(total_size)
+        chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        raise ValueError('文件大小或分块大小无效')
+
+    if total_size <= 0:
+        raise ValueError('文件大小无效')
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f'分块大小必须在 {MIN_CHUNK_SIZE} 到 {MAX_CHUNK_SIZE} 字节之间')
+
+    sha256 = sha256.lower() if sha256 else None
+
+    cleanup_expired_sessions(sessions_dir)
+
+    upload_id = uuid.uuid4().hex
+    session_dir = _session_dir(sessions_dir, upload_id)
+    os.makedirs(os.path.join(session_dir, 'chunks'))
+
+    # 预先设置目标文件长度（稀疏文件），分块直接写到对应偏移
+    with open(os.path.join(session_dir, 'data.part'), 'wb') as f:
+        f.truncate(total_size)
+
+    meta = {
+        'upload_id': upload_id,
+        'filename': filename,
+        'total_size': total_size,
+        'chunk_size': chunk_size,
+        'total_chunks': (total_size + chunk_size - 1) // chunk_size,
+        'sha256': sha256,
+        'created': time.time()
+    }
+    with open(os.path.join(session_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    return meta
+
+
+def load_upload_session(sessions_dir, upload_id):
+    """
+    读取会话信息
+
+    Returns:
+        dict: 会话信息，不存在时返回 None
+    """
+    meta_path = os.path.join(_session_dir(sessions_dir, upload_id), 'meta.json')
+    try:
+        # 会话可能正被另一个完成请求删除
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_received_chunks(sessions_dir, upload_id):
+    """返回已完成的分块序号列表（升序）"""
+    chunks_dir = os.path.join(_session_dir(sessions_dir, upload_id), 'chunks')
+    try:
+        names = os.listdir(chunks_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def get_upload_status(sessions_dir, upload_id):
+    """
+    查询会话进度
+
+    Returns:
+        dict: 会话信息和已接收的分块/字节数，不存在时返回 None
+    """
+    meta = load_upload_session(sessions_dir, upload_id)
+    if meta is None:
+        return None
+
+    received = get_received_chunks(sessions_dir, upload_id)
+    received_bytes = sum(_chunk_length(meta, index) for index in received)
+
+    status = dict(meta)
+    status.update({
+        'received_chunks': received,
+        'received_bytes': received_bytes,
+        'complete': len(received) == meta['total_chunks']
+    })
+    return status
+
+
+def _chunk_length(meta, index):
+    """分块的期望长度（最后一块可能较短）"""
+    offset = index * meta['chunk_size']
+    return min(meta['chunk_size'], meta['total_size'] - offset)
+
+
+def write_chunk(sessions_dir, upload_id, index, stream):
+    """
+    将一个分块写入目标文件的对应偏移位置
+
+    Args:
+        sessions_dir: 会话根目录
+        upload_id: 会话ID
+        index: 分块序号（从0开始）
+        stream: 分块内容的输入流
+
+    Returns:
+        int: 写入的字节数
+    """
+    meta = load_upload_session(sessions_dir, upload_id)
+    if meta is None:
+        raise ValueError('上传会话不存在或已过期')
+    if not 0 <= index < meta['total_chunks']:
+        raise ValueError(f'分块序号超出范围: {index}')
+
+    session_dir = _session_dir(sessions_dir, upload_id)
+    expected = _chunk_length(meta, index)
+    offset = index * meta['chunk_size']
+
+    buffer = bytearray(min(STREAM_CHUNK_SIZE, expected))
+    view = memoryview(buffer)
+    written = 0
+
+    fd = os.open(os.path.join(session_dir, 'data.part'), os.O_WRONLY)
+    try:
+        while written < expected:
+            n = stream.readinto(view[:min(len(buffer), expected - written)])
+            if not n:
+                break
+            os.pwrite(fd, view[:n], offset + written)
+            written += n
+
+        # 分块长度必须与预期一致，多余数据视为错误
+        if written != expected or stream.read(1):
+            raise ValueError(f'分块 {index} 长度不正确，期望 {expected} 字节')
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    # 分块写完后再创建标记，保证标记存在即数据完整
+    open(os.path.join(session_dir, 'chunks', str(index)), 'wb').close()
+    return written
+
+
+def read_head(sessions_dir, upload_id, size):
+    """读取已写入文件开头的若干字节（用于第一个分块到达后的格式检查）"""
+    data_path = os.path.join(_session_dir(sessions_dir, upload_id), 'data.part')
+    with open(data_path, 'rb') as f:
+        return f.read(size)
+
+
+def discard_upload(sessions_dir, upload_id):
+    """删除上传会话"""
+    shutil.rmtree(_session_dir(sessions_dir, upload_id), ignore_errors=True)
+
+
+def finalize_upload(sessions_dir, upload_id, upload_dir):
+    """
+    完成上传：检查分块齐全后将目标文件移入内容存储
+
+    同一会话重复完成时返回第一次完成的结果，stats['already_finalized'] 为 True
+
+    Args:
+        sessions_dir: 会话根目录
+        upload_id: 会话ID
+        upload_dir: 上传目录
+
+    Returns:
+        tuple: (会话信息, 保存的文件名, 文件路径, 统计)
+    """
+    with _session_lock(sessions_dir, upload_id):
+        done = load_finalized(sessions_dir, upload_id)
+        if done is not None:
+            meta, filename, filepath, stats = done
+            return meta, filename, filepath, dict(stats, already_finalized=True)
+        return _finalize(sessions_dir, upload_id, upload_dir)
+
+
+def _finalize(sessions_dir, upload_id, upload_dir):
+    """组装并存储文件（调用方持有会话锁）"""
+    meta = load_upload_session(sessions_dir, upload_id)
+    if meta is None:
+        raise ValueError('上传会话不存在或已过期')
+
+    session_dir = _session_dir(sessions_dir, upload_id)
+
+    received = get_received_chunks(sessions_dir, upload_id)
+    if len(received) != meta['total_chunks']:
+        missing = sorted(set(range(meta['total_chunks'])) - set(received))
+        raise ValueError(f'还有 {len(missing)} 个分块未上传')
+
+    # 分块可能乱序到达，无法边写边计算摘要，这里对组装好的文件计算一次
+    data_path = os.path.join(session_dir, 'data.part')
+    digest = file_sha256(data_path)
+    if meta.get('sha256') and meta['sha256'] != digest:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise ValueError('文件校验失败，请重新上传')
+
+    filename, filepath, stats = store_file(data_path, upload_dir, meta['filename'], digest)
+    done_path = _done_path(sessions_dir, upload_id)
+    with open(f'{done_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'filename': filename, 'filepath': filepath, 'stats': stats}, f,
+                  ensure_ascii=False)
+    os.replace(f'{done_path}.tmp', done_path)
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return meta, filename, filepath, stats
+
+
+def cleanup_expired_sessions(sessions_dir, max_age=SESSION_EXPIRE_SECONDS):
+    """清理长时间未活动的上传会话"""
+    if not os.path.isdir(sessions_dir):
+        return
+
+    now = time.time()
+    for name in os.listdir(sessions_dir):
+        path = os.path.join(sessions_dir, name)
+        if not os.path.isdir(path):
+            # 会话锁和已完成会话的结果文件
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            # 以分块目录的修改时间作为最近活动时间
+            last_active = os.path.getmtime(os.path.join(path, 'chunks'))
+        except OSError:
+            last_active = os.path.getmtime(path) if os.path.exists(path) else now
+        if now - last_active > max_age:
+            shutil.rmtree(path, ignore_errors=True)
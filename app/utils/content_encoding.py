@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+压缩请求体支持
+
+客户端可以用 Content-Encoding: gzip（安装 zstandard 后也支持 zstd）上传压缩后的请求体。
+中间件在 WSGI 层把输入流替换为边读边解压的流，应用和表单解析器看到的是解压后的数据，
+上传内容仍然直接流式写入暂存区，不会在内存中展开整个文件。
+
+解压后的长度事先未知，中间件会去掉 Content-Length 并设置 wsgi.input_terminated，
+由 Flask 按 MAX_CONTENT_LENGTH 对解压后的字节数逐块限制，压缩炸弹在超限时即被中止。
+"""
+import io
+import json
+import zlib
+
+from werkzeug.exceptions import BadRequest
+from werkzeug.wsgi import LimitedStream
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选支持
+    zstandard = None
+
+from app.utils.file_helper import STREAM_CHUNK_SIZE
+
+
+def supported_encodings():
+    """返回支持的 Content-Encoding 列表"""
+    encodings = ['gzip', 'x-gzip', 'deflate']
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+class ZlibDecodingStream(io.RawIOBase):
+    """
+    gzip / deflate 解压流
+
+    每次解压的输出不超过调用方的缓冲区大小，压缩率再高也不会一次性展开大量数据。
+    """
+
+    def __init__(self, raw, wbits):
+        self._raw = raw
+        self._wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+        self._pending = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if not size:
+            return 0
+
+        while True:
+            if not self._pending:
+                if self._eof:
+                    return 0
+                self._pending = self._raw.read(STREAM_CHUNK_SIZE)
+                if not self._pending:
+                    self._eof = True
+                    if not self._decompressor.eof:
+                        raise BadRequest('压缩数据不完整')
+                    return 0
+
+            try:
+                data = self._decompressor.decompress(self._pending, size)
+            except zlib.error as e:
+                raise BadRequest(f'解压请求体失败: {e}')
+
+            if self._decompressor.eof:
+                # 多个 gzip 成员首尾相接时继续解压下一个成员
+                self._pending = self._decompressor.unused_data
+                if self._pending:
+                    self._decompressor = zlib.decompressobj(self._wbits)
+            else:
+                self._pending = self._decompressor.unconsumed_tail
+
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+
+class ZstdDecodingStream(io.RawIOBase):
+    """zstd 解压流（需要安装 zstandard）"""
+
+    def __init__(self, raw):
+        self._reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            return self._reader.readinto(buffer)
+        except zstandard.ZstdError as e:
+            raise BadRequest(f'解压请求体失败: {e}')
+
+
+def open_decoding_stream(raw, encoding):
+    """
+    为输入流创建解压流
+
+    Returns:
+        可读的流，不支持的编码返回 None
+    """
+    if encoding in ('gzip', 'x-gzip'):
+        stream = ZlibDecodingStream(raw, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        stream = ZlibDecodingStream(raw, zlib.MAX_WBITS)
+    elif encoding == 'zstd' and zstandard is not None:
+        stream = ZstdDecodingStream(raw)
+    else:
+        return None
+    return io.BufferedReader(stream, STREAM_CHUNK_SIZE)
+
+
+class DecompressMiddleware:
+    """
+    WSGI 中间件：解压带 Content-Encoding 的请求体
+
+    不支持的编码直接返回 415，不进入应用。压缩的请求体没有 Content-Length 时，
+    只有服务器保证输入流在请求体结束处终止（wsgi.input_terminated）才读取到流末尾，
+    否则返回 411，不会把请求体当成空内容交给应用。
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return self.wsgi_app(environ, start_response)
+
+        if encoding not in supported_encodings():
+            message = f'不支持的Content-Encoding: {encoding}，支持: {", ".join(supported_encodings())}'
+            return error_response(start_response, '415 Unsupported Media Type', message)
+
+        raw = environ['wsgi.input']
+        content_length = environ.get('CONTENT_LENGTH')
+        if content_length and content_length.isdigit():
+            # 压缩数据本身仍按 Content-Length 截止
+            raw = LimitedStream(raw, int(content_length))
+        elif not environ.get('wsgi.input_terminated'):
+            # 无法判断请求体在哪里结束，读取原始流可能一直阻塞
+            return error_response(start_response, '411 Length Required',
+                                  '压缩的请求体需要提供Content-Length')
+
+        environ['wsgi.input'] = open_decoding_stream(raw, encoding)
+        environ['wsgi.input_terminated'] = True
+        environ.pop('CONTENT_LENGTH', None)
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        return self.wsgi_app(environ, start_response)
+
+
+def error_response(start_response, status, message):
+    """直接返回 JSON 错误响应，不进入应用"""
+    body = json.dumps({'success': False, 'message': message, 'error': message},
+                      ensure_ascii=False).encode('utf-8')
+    start_response(status, [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(body)))
+    ])
+    return [body]
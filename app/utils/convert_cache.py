@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+格式转换结果缓存
+
+同一个PDF再次转换时 Calibre 要从头再跑一遍，大书要几分钟。这里把转换结果保存在磁盘上：
+- 按 (输入文件内容的 SHA-256, 转换器版本, 转换选项) 索引，任何一项变化都视为不同的结果
+- 结果先写临时文件再原子重命名，其他进程不会读到写了一半的文件
+- 缓存总大小超过上限时按最近使用时间（文件修改时间）删除最久未用的结果
+- single_flight(key) 保证同一个键同时只有一个转换在运行（进程内用线程锁，进程间用文件锁），
+  重复的请求等它完成后直接使用缓存
+
+未调用 configure_convert_cache() 时不使用缓存。
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from app.utils.file_store import file_sha256
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 默认缓存上限（字节）
+CONVERT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# 超过这个时间（秒）的临时文件视为写入中断遗留，清理时删除
+STALE_TEMP_AGE = 3600
+
+_SUFFIX = '.result'
+
+
+class ConvertCache:
+    """一个缓存目录"""
+
+    def __init__(self, directory, max_bytes=CONVERT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def content_digest(self, file_path):
+        """文件内容的 SHA-256（按路径、大小和修改时间记住结果）"""
+        stat = os.stat(file_path)
+        memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is None:
+            digest = file_sha256(file_path)
+            with self._lock:
+                if len(self._digests) >= 1024:
+                    self._digests.clear()
+                self._digests[memo_key] = digest
+        return digest
+
+    def key(self, input_path, version, options):
+        """
+        缓存键
+
+        Args:
+            input_path: 输入文件
+            version: 转换器版本
+            options: 转换选项（可JSON序列化）
+        """
+        material = json.dumps([self.content_digest(input_path), version, options], ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def fetch(self, key, output_path):
+        """
+        把缓存的结果放到 output_path（硬链接，不支持时复制）并标记为最近使用
+
+        Returns:
+            str: output_path，未缓存时返回 None
+        """
+        path = self._path(key)
+        temp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            try:
+                os.link(path, temp_path)
+            except FileNotFoundError:
+                return None
+            except OSError:
+                shutil.copyfile(path, temp_path)
+            os.replace(temp_path, output_path)
+        except FileNotFoundError:
+            # 复制时被其他进程淘汰
+            _remove(temp_path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return str(output_path)
+
+    def publish(self, key, result_path):
+        """把转换结果加入缓存（原子发布），失败（如磁盘已满）时只放弃缓存"""
+        if os.path.getsize(result_path) > self.max_bytes:
+            return
+        temp_path = os.path.join(self.directory, f'{key}.{uuid.uuid4().hex}.tmp')
+        try:
+            try:
+                os.link(result_path, temp_path)
+            except OSError:
+                shutil.copyfile(result_path, temp_path)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            _remove(temp_path)
+            return
+        self.evict()
+
+    @contextmanager
+    def single_flight(self, key):
+        """同一个键同时只允许一个持有者（进程内和进程间），其他调用方阻塞等待"""
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                lock_file = None
+                if fcntl is not None:
+                    lock_file = open(os.path.join(self.directory, key + '.lock'), 'a+b')
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # 标记为正在使用，清理时不会删除
+                    os.utime(lock_file.name)
+                try:
+                    yield
+                finally:
+                    if lock_file is not None:
+                        lock_file.close()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._key_locks.pop(key, None)
+
+    def evict(self):
+        """删除最久未用的结果，使缓存总大小不超过上限"""
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(_SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            elif now - stat.st_mtime > STALE_TEMP_AGE:
+                # 遗留的临时文件和长时间未用的锁文件
+                _remove(path)
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_convert_cache(directory, max_bytes=CONVERT_CACHE_SIZE):
+    """设置缓存目录和上限，max_bytes 为 0 时不使用缓存"""
+    global _cache
+    with _cache_lock:
+        if not max_bytes:
+            _cache = None
+        elif _cache is None or _cache.directory != directory or _cache.max_bytes != max_bytes:
+            _cache = ConvertCache(directory, max_bytes)
+
+
+def get_convert_cache():
+    """返回进程内共享的缓存，未配置时返回 None"""
+    return _cache
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+格式转换工作池
+
+ebook-convert 很占CPU和内存，每个请求直接启动一个 Calibre 进程时，同时转换的数量没有上限，
+十个PDF同时转换就会让4核的容器卡死。这里把转换交给专门的线程池：
+- 同时运行的转换数不超过 workers（默认为可用CPU数）。槽位是 slot_dir 下的文件锁（flock），
+  所有 gunicorn 工作进程共用，整台机器同时运行的转换数也不超过 workers
+- 等待槽位的转换数有上限（max_queue），排队已满时立即抛出 ConversionQueueFull，由调用方返回503或稍后重试
+- 转换线程降低调度优先级（nice），Calibre 子进程继承这个优先级，请求处理线程不受影响
+- stats() 返回排队和运行中的转换数
+
+未调用 configure_convert_pool() 时使用默认配置，且不做跨进程限制。
+"""
+import os
+import time
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 默认同时运行的转换数（可用CPU数）
+CONVERT_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+# 默认每个进程最多排队等待的转换数
+CONVERT_QUEUE_SIZE = 16
+
+# 默认转换线程（及其启动的 Calibre 进程）的 nice 值
+CONVERT_NICENESS = 10
+
+# 没有空闲槽位时重新尝试的间隔（秒）
+SLOT_POLL_INTERVAL = 0.2
+
+
+class ConversionQueueFull(Exception):
+    """转换排队已满"""
+
+
+class SlotLocks:
+    """slot_dir 下 count 个文件锁，持有其中一个才能运行转换"""
+
+    def __init__(self, slot_dir, count):
+        self.slot_dir = slot_dir
+        self.count = count
+        os.makedirs(slot_dir, exist_ok=True)
+
+    def try_acquire(self):
+        """尝试获取一个空闲槽位，返回打开的锁文件，没有空闲槽位时返回 None"""
+        for index in range(self.count):
+            f = open(os.path.join(self.slot_dir, f'slot-{index}.lock'), 'a+b')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    def acquire(self):
+        """等待并获取一个槽位"""
+        while True:
+            slot = self.try_acquire()
+            if slot is not None:
+                return slot
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    @staticmethod
+    def release(slot):
+        # 关闭文件即释放 flock
+        slot.close()
+
+
+class ConversionPool:
+    """限制并发、带排队上限的转换线程池"""
+
+    def __init__(self, workers=CONVERT_WORKERS, max_queue=CONVERT_QUEUE_SIZE, niceness=CONVERT_NICENESS,
+                 slot_dir=None):
+        self.workers = max(int(workers), 1)
+        self.max_queue = max_queue
+        self.niceness = niceness
+        self.slot_dir = slot_dir
+        self._slots = SlotLocks(slot_dir, self.workers) if slot_dir and fcntl is not None else None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='convert',
+                                            initializer=self._lower_priority)
+
+    def _lower_priority(self):
+        """
+        降低当前线程的调度优先级
+
+        Linux 下每个线程有独立的 nice 值，从该线程启动的子进程继承它；不支持时忽略
+        """
+        if not self.niceness:
+            return
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+        except (AttributeError, OSError):
+            pass
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        提交一个转换
+
+        Returns:
+            concurrent.futures.Future: fn 的返回值
+
+        Raises:
+            ConversionQueueFull: 排队的转换数已达上限
+        """
+        with self._lock:
+            if self._queued + self._running >= self.workers + self.max_queue:
+                raise ConversionQueueFull(f'转换任务过多（{self._queued}个正在排队），请稍后重试')
+            self._queued += 1
+        try:
+            return self._executor.submit(self._run, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        """提交一个转换并等待结果"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _run(self, fn, args, kwargs):
+        slot = self._slots.acquire() if self._slots is not None else None
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if slot is not None:
+                self._slots.release(slot)
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def stats(self):
+        """本进程排队和运行中的转换数"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self._completed
+            }
+
+    def close(self, wait=True):
+        """停止接受新的转换，已提交的转换会继续完成"""
+        self._executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def configure_convert_pool(slot_dir, workers=0, max_queue=CONVERT_QUEUE_SIZE, niceness=CONVERT_NICENESS):
+    """
+    设置转换池，配置不变时保留现有的池
+
+    Args:
+        slot_dir: 跨进程槽位锁文件所在目录
+        workers: 同时运行的转换数，0 为可用CPU数
+    """
+    global _pool, _pool_pid
+    workers = workers or CONVERT_WORKERS
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid() and \
+                (_pool.slot_dir, _pool.workers, _pool.max_queue, _pool.niceness) == \
+                (slot_dir, workers, max_queue, niceness):
+            return _pool
+        old = _pool if _pool_pid == os.getpid() else None
+        _pool = ConversionPool(workers, max_queue, niceness, slot_dir)
+        _pool_pid = os.getpid()
+    if old is not None:
+        old.close(wait=False)
+    return _pool
+
+
+def get_convert_pool():
+    """
+    返回本进程的转换池
+
+    线程不会被fork继承，按进程号判断：gunicorn fork出的工作进程按父进程的配置重新创建
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConversionPool()
+        elif _pool_pid != os.getpid():
+            _pool = ConversionPool(_pool.workers, _pool.max_queue, _pool.niceness, _pool.slot_dir)
+        _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown_convert_pool():
+    """停止本进程的转换池"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close(wait=False)
+        _pool = None
+
+
+atexit.register(shutdown_convert_pool)
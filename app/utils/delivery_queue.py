@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久化的发送队列（SQLite，WAL 模式）
+
+待发送的文件记录在 deliveries 表中，所有 gunicorn 工作进程共用同一个数据库文件：
+- 工作线程通过租约（lease）领取任务，领取在 BEGIN IMMEDIATE 事务中完成，同一任务不会被重复领取
+- 进程崩溃或容器重启后，租约过期的任务会被其他工作线程重新领取；尝试次数已用尽的直接进入 dead 状态
+- 处理耗时较长（转换、合并发送）时，领取者需在租约到期前调用 renew 续租
+- 临时性的SMTP错误按指数退避（带随机抖动）重试，超过最大次数后进入 dead 状态
+
+同一Kindle邮箱的多个到期任务可以一次领取，合并成少量邮件发送（见 claim_batch）
+
+状态：pending（等待发送/重试）→ leased（发送中）→ sent / dead
+      任务被取消时：pending → cancelled，leased → cancelled（由执行者在转换被中止后标记）
+"""
+import os
+import time
+import random
+import socket
+import sqlite3
+import threading
+
+
+# 最大尝试次数（含第一次发送）
+MAX_ATTEMPTS = 6
+
+# 重试退避：第 n 次失败后等待约 BACKOFF_BASE * 2^(n-1) 秒，不超过 BACKOFF_MAX
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+
+# 租约时长（秒），超过该时间仍未完成的任务视为领取者已退出
+LEASE_SECONDS = 900
+
+# 处理过程中续租的最小间隔（秒），续租后租约至少还剩 LEASE_SECONDS - LEASE_RENEW_INTERVAL 秒
+LEASE_RENEW_INTERVAL = 60
+
+# 租约过期且尝试次数用尽时记录的错误
+EXPIRED_ERROR = '多次处理未完成（处理线程退出或租约过期），不再重试'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT,
+    filepath TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    kindle_email TEXT NOT NULL,
+    convert_pdf INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_deliveries_ready ON deliveries (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_deliveries_job ON deliveries (job_id);
+'''
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+
+def connect(db_path):
+    """打开队列数据库（首次打开时启用 WAL 并创建表）"""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA busy_timeout = 30000')
+    with _init_lock:
+        if db_path not in _initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_SCHEMA)
+            _initialized.add(db_path)
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+def lease_owner():
+    """当前线程的租约标识"""
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def backoff_delay(attempts, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """第 attempts 次失败后的等待时间（一半固定、一半随机，避免多个任务同时重试）"""
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def enqueue(db_path, filepath, filename, kindle_email, convert_pdf=False, job_id=None,
+            max_attempts=MAX_ATTEMPTS):
+    """
+    加入发送队列
+
+    Returns:
+        int: 队列记录ID
+    """
+    now = time.time()
+    conn = connect(db_path)
+    try:
+        cursor = conn.execute(
+            'INSERT INTO deliveries (job_id, filepath, filename, kindle_email, convert_pdf, '
+            'max_attempts, next_attempt_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, filepath, filename, kindle_email, int(bool(convert_pdf)),
+             max_attempts, now, now, now)
+        )
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def claim(db_path, owner=None, lease_seconds=LEASE_SECONDS, on_dead=None):
+    """
+    领取一个到期的任务（包括租约已过期的任务）
+
+    Returns:
+        dict: 任务记录，没有可领取的任务时返回 None
+    """
+    deliveries = claim_batch(db_path, owner, lease_seconds, limit=1, on_dead=on_dead)
+    return deliveries[0] if deliveries else None
+
+
+def claim_batch(db_path, owner=None, lease_seconds=LEASE_SECONDS, limit=1, on_dead=None):
+    """
+    领取最早到期的任务，以及同一Kindle邮箱的其他到期任务（最多 limit 个），用于合并成少量邮件发送
+
+    租约已过期且尝试次数已用尽的任务（领取者反复在处理中退出）不再领取，直接进入 dead 状态
+
+    Args:
+        on_dead: 回调 on_dead(任务记录)，对每个因此进入 dead 状态的任务调用一次（可选）
+
+    Returns:
+        list: 任务记录列表，没有可领取的任务时为空列表
+    """
+    owner = owner or lease_owner()
+    now = time.time()
+    ready = ("((status = 'pending' AND next_attempt_at <= ?) "
+             " OR (status = 'leased' AND lease_expires_at <= ?))")
+    conn = connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        dead = conn.execute(
+            "SELECT * FROM deliveries WHERE status = 'leased' AND lease_expires_at <= ? "
+            "AND attempts >= max_attempts",
+            (now,)
+        ).fetchall()
+        if dead:
+            conn.executemany(
+                "UPDATE deliveries SET status = 'dead', lease_owner = NULL, lease_expires_at = NULL, "
+                "last_error = ?, updated_at = ? WHERE id = ?",
+                [(EXPIRED_ERROR, now, row['id']) for row in dead]
+            )
+        first = conn.execute(
+            f"SELECT * FROM deliveries WHERE {ready} ORDER BY next_attempt_at LIMIT 1",
+            (now, now)
+        ).fetchone()
+        if first is None:
+            conn.execute('COMMIT')
+            _report_dead(dead, on_dead)
+            return []
+        rows = [first]
+        if limit > 1:
+            rows += conn.execute(
+                f"SELECT * FROM deliveries WHERE {ready} AND kindle_email = ? AND id != ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (now, now, first['kindle_email'], first['id'], limit - 1)
+            ).fetchall()
+        conn.executemany(
+            "UPDATE deliveries SET status = 'leased', lease_owner = ?, lease_expires_at = ?, "
+            "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            [(owner, now + lease_seconds, now, row['id']) for row in rows]
+        )
+        conn.execute('COMMIT')
+        _report_dead(dead, on_dead)
+        deliveries = []
+        for row in rows:
+            delivery = dict(row)
+            delivery.update(status='leased', lease_owner=owner, attempts=row['attempts'] + 1)
+            deliveries.append(delivery)
+        return deliveries
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _report_dead(rows, on_dead):
+    """通知调用方租约过期后进入 dead 状态的任务"""
+    if on_dead is None:
+        return
+    for row in rows:
+        delivery = dict(row)
+        delivery.update(status='dead', lease_owner=None, lease_expires_at=None, last_error=EXPIRED_ERROR)
+        on_dead(delivery)
+
+
+def renew(db_path, delivery_ids, owner, lease_seconds=LEASE_SECONDS):
+    """
+    延长任务的租约
+
+    租约已过期但尚未被其他领取者领取的任务仍可续租
+
+    Returns:
+        set: 仍由 owner 持有（已续租）的任务ID
+    """
+    now = time.time()
+    conn = connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        held = set()
+        for delivery_id in delivery_ids:
+            cursor = conn.execute(
+                "UPDATE deliveries SET lease_expires_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (now + lease_seconds, now, delivery_id, owner)
+            )
+            if cursor.rowcount == 1:
+                held.add(delivery_id)
+        conn.execute('COMMIT')
+        return held
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _finish(db_path, delivery_id, owner, sql, params):
+    """只有仍持有租约的领取者才能更新任务"""
+    conn = connect(db_path)
+    try:
+        cursor = conn.execute(
+            sql + " WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+            params + (delivery_id, owner)
+        )
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def mark_sent(db_path, delivery_id, owner):
+    """发送成功"""
+    return _finish(db_path, delivery_id, owner,
+                   "UPDATE deliveries SET status = 'sent', lease_owner = NULL, "
+                   "lease_expires_at = NULL, last_error = NULL, updated_at = ?",
+                   (time.time(),))
+
+
+def mark_failed(db_path, delivery, error, transient=True, filepath=None, kindle_email=None):
+    """
+    发送失败：临时性错误安排重试，否则（或次数用尽）进入 dead 状态
+
+    Args:
+        delivery: claim() 返回的任务记录
+        error: 错误信息
+        transient: 是否为可重试的错误
+        filepath: 重试时使用的文件（如已转换好的EPUB，避免重复转换）
+        kindle_email: 重试时的收件邮箱（如只重试发送失败的Kindle邮箱）
+
+    Returns:
+        float: 下次重试时间，进入 dead 状态时返回 None
+    """
+    now = time.time()
+    if transient and delivery['attempts'] < delivery['max_attempts']:
+        next_attempt = now + backoff_delay(delivery['attempts'])
+        _finish(db_path, delivery['id'], delivery['lease_owner'],
+                "UPDATE deliveries SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, "
+                "next_attempt_at = ?, last_error = ?, filepath = ?, convert_pdf = ?, kindle_email = ?, "
+                "updated_at = ?",
+                (next_attempt, error, filepath or delivery['filepath'],
+                 0 if filepath else delivery['convert_pdf'], kindle_email or delivery['kindle_email'], now))
+        return next_attempt
+
+    _finish(db_path, delivery['id'], delivery['lease_owner'],
+            "UPDATE deliveries SET status = 'dead', lease_owner = NULL, lease_expires_at = NULL, "
+            "last_error = ?, updated_at = ?",
+            (error, now))
+    return None
+
+
+def defer(db_path, delivery, until, filepath=None):
+    """
+    推迟发送（如发件账号达到速率限制），放回队列且不计入尝试次数
+
+    Args:
+        delivery: claim() 返回的任务记录
+        until: 最早的重新领取时间
+        filepath: 之后使用的文件（如已转换好的EPUB）
+
+    Returns:
+        bool: 是否仍持有租约并已放回队列
+    """
+    return _finish(db_path, delivery['id'], delivery['lease_owner'],
+                   "UPDATE deliveries SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, "
+                   "attempts = MAX(attempts - 1, 0), next_attempt_at = ?, filepath = ?, convert_pdf = ?, "
+                   "updated_at = ?",
+                   (until, filepath or delivery['filepath'], 0 if filepath else delivery['convert_pdf'],
+                    time.time()))
+
+
+def mark_cancelled(db_path, delivery, error):
+    """执行中的任务被取消"""
+    return _finish(db_path, delivery['id'], delivery['lease_owner'],
+                   "UPDATE deliveries SET status = 'cancelled', lease_owner = NULL, lease_expires_at = NULL, "
+                   "last_error = ?, updated_at = ?",
+                   (error, time.time()))
+
+
+def cancel_pending(db_path, job_id):
+    """
+    取消某个后台任务还在等待中的发送
+
+    Returns:
+        int: 取消的记录数（已被领取的记录不受影响）
+    """
+    conn = connect(db_path)
+    try:
+        cursor = conn.execute(
+            "UPDATE deliveries SET status = 'cancelled', last_error = ?, updated_at = ? "
+            "WHERE job_id = ? AND status = 'pending'",
+            ('任务已取消', time.time(), job_id)
+        )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def get_delivery(db_path, delivery_id):
+    """读取任务记录"""
+    conn = connect(db_path)
+    try:
+        row = conn.execute('SELECT * FROM deliveries WHERE id = ?', (delivery_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
@@ -5,9 +5,14 @@
 """
 import os
 import re
+import time
 from datetime import datetime
 
 
+# 流式写盘时每次读取的缓冲区大小（1MB），内存中最多只保留这一块数据
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
 def safe_filename(filename):
     """
     生成安全的文件名，保留中文和基本字符
@@ -112,4 +117,56 @@ def extract_original_filename(saved_filename):
         return match.group(1)
     
     # 如果没有匹配的时间戳格式，返回原文件名
-    return saved_filename
\ No newline at end of file
+    return saved_filename
+
+
+def stream_to_file(stream, filepath, chunk_size=STREAM_CHUNK_SIZE, hasher=None):
+    """
+    将输入流分块写入磁盘，不在内存中缓存完整内容
+    
+    使用固定大小的缓冲区循环 readinto，内存占用与文件大小无关。
+    
+    Args:
+        stream: 可读的二进制流（如上传文件的 stream）
+        filepath: 目标文件路径
+        chunk_size: 缓冲区大小（字节）
+        hasher: hashlib 哈希对象（可选），写入的同时计算摘要
+    
+    Returns:
+        dict: 写入统计 {'bytes': 字节数, 'seconds': 耗时, 'speed_mb_s': 速度}，
+              传入 hasher 时额外包含 'sha256'
+    """
+    start = time.time()
+    total = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    readinto = getattr(stream, 'readinto', None)
+    
+    with open(filepath, 'wb') as f:
+        while True:
+            if readinto is not None:
+                n = readinto(view)
+                if not n:
+                    break
+                f.write(view[:n])
+                if hasher is not None:
+                    hasher.update(view[:n])
+            else:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                n = len(chunk)
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+            total += n
+    
+    seconds = time.time() - start
+    stats = {
+        'bytes': total,
+        'seconds': seconds,
+        'speed_mb_s': (total / 1024 / 1024) / seconds if seconds > 0 else 0.0
+    }
+    if hasher is not None:
+        stats['sha256'] = hasher.hexdigest()
+    return stats
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内容寻址的上传文件存储
+
+文件内容按 SHA-256 摘要保存在上传目录下的 .store 中：
+    uploads/.store/ab/abcdef...   文件内容（blob）
+    uploads/20250811_110457_书名.pdf   可读文件名，硬链接到对应 blob
+
+相同内容的文件只占用一份磁盘空间，重复上传时只新增一个硬链接。
+摘要在流式写盘的同时计算，不需要再读一遍文件。
+
+表单解析时上传内容直接写入 .store/tmp（SpooledUpload），与 blob 位于同一文件系统，
+保存时只需一次原子重命名，不再经过系统临时目录复制第二遍。
+"""
+import os
+import re
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+
+from app.utils.file_helper import generate_unique_filename, stream_to_file, STREAM_CHUNK_SIZE
+from app.utils.upload_guard import UploadRejected, SNIFF_SIZE
+
+
+STORE_DIRNAME = '.store'
+
+_DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_store_dir(upload_dir):
+    """返回内容存储目录"""
+    return os.path.join(upload_dir, STORE_DIRNAME)
+
+
+def blob_path(upload_dir, digest):
+    """返回摘要对应的 blob 路径（按前两位分目录）"""
+    if not digest or not _DIGEST_PATTERN.match(digest):
+        raise ValueError('无效的SHA-256摘要')
+    return os.path.join(get_store_dir(upload_dir), digest[:2], digest)
+
+
+def find_blob(upload_dir, digest):
+    """
+    查找已存储的内容
+
+    Returns:
+        str: blob 路径，不存在时返回 None
+    """
+    path = blob_path(upload_dir, digest)
+    return path if os.path.exists(path) else None
+
+
+def file_sha256(filepath, chunk_size=STREAM_CHUNK_SIZE):
+    """计算已有文件的 SHA-256 摘要"""
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def new_temp_path(upload_dir):
+    """在存储目录内生成临时文件路径（与 blob 同一文件系统，可直接重命名）"""
+    tmp_dir = os.path.join(get_store_dir(upload_dir), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    return os.path.join(tmp_dir, f'{uuid.uuid4().hex}.part')
+
+
+def copy_across_filesystems(src_path, dest_path):
+    """
+    跨文件系统复制文件（重命名失败时的退路）
+
+    优先使用内核态复制 os.copy_file_range / os.sendfile，避免数据经过用户态缓冲区。
+    先复制到目标目录内的临时文件，再原子重命名到目标路径。
+    """
+    tmp_dest = f'{dest_path}.{uuid.uuid4().hex}.tmp'
+    size = os.path.getsize(src_path)
+
+    try:
+        with open(src_path, 'rb') as src, open(tmp_dest, 'wb') as dst:
+            copied = 0
+            copy_file_range = getattr(os, 'copy_file_range', None)
+            sendfile = getattr(os, 'sendfile', None)
+            while copied < size:
+                count = min(size - copied, 64 * 1024 * 1024)
+                try:
+                    if copy_file_range is not None:
+                        n = copy_file_range(src.fileno(), dst.fileno(), count)
+                    elif sendfile is not None:
+                        n = sendfile(dst.fileno(), src.fileno(), copied, count)
+                    else:
+                        # 内核态复制都不可用时使用普通复制
+                        src.seek(copied)
+                        dst.seek(copied)
+                        shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+                        break
+                except OSError as e:
+                    if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP):
+                        raise
+                    # 当前方式不被支持，依次降级到下一种
+                    if copy_file_range is not None:
+                        copy_file_range = None
+                    else:
+                        sendfile = None
+                    dst.seek(copied)
+                    continue
+                if not n:
+                    break
+                copied += n
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_dest, dest_path)
+    except Exception:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+
+    os.remove(src_path)
+
+
+def move_file(src_path, dest_path):
+    """原子移动文件，跨文件系统时退化为内核态复制"""
+    try:
+        os.replace(src_path, dest_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_across_filesystems(src_path, dest_path)
+
+
+def commit_blob(upload_dir, tmp_path, digest):
+    """
+    将临时文件提交为 blob
+
+    Args:
+        upload_dir: 上传目录
+        tmp_path: 已写完的临时文件
+        digest: 文件的 SHA-256 摘要
+
+    Returns:
+        tuple: (blob路径, 是否为重复内容)
+    """
+    path = blob_path(upload_dir, digest)
+
+    if os.path.exists(path):
+        # 内容已存在，丢弃临时文件
+        os.remove(tmp_path)
+        return path, True
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    move_file(tmp_path, path)
+    return path, False
+
+
+def link_blob(blob, dest_path):
+    """为 blob 创建可读文件名（硬链接，不支持时退化为复制）"""
+    try:
+        os.link(blob, dest_path)
+    except OSError:
+        shutil.copyfile(blob, dest_path)
+
+
+def link_to_name(upload_dir, blob, original_filename):
+    """
+    为 blob 生成唯一的可读文件名
+
+    Returns:
+        tuple: (保存的文件名, 文件路径)
+    """
+    filename = generate_unique_filename(original_filename, upload_dir)
+    filepath = os.path.join(upload_dir, filename)
+    link_blob(blob, filepath)
+    return filename, filepath
+
+
+def store_stream(stream, upload_dir, original_filename):
+    """
+    流式保存上传内容，写盘的同时计算 SHA-256
+
+    Args:
+        stream: 上传文件流
+        upload_dir: 上传目录
+        original_filename: 原始文件名
+
+    Returns:
+        tuple: (保存的文件名, 文件路径, 写入统计)
+               统计中包含 'sha256' 和 'deduplicated'
+    """
+    tmp_path = new_temp_path(upload_dir)
+    try:
+        stats = stream_to_file(stream, tmp_path, hasher=hashlib.sha256())
+        blob, deduplicated = commit_blob(upload_dir, tmp_path, stats['sha256'])
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    filename, filepath = link_to_name(upload_dir, blob, original_filename)
+    stats['deduplicated'] = deduplicated
+    return filename, filepath, stats
+
+
+def store_file(src_path, upload_dir, original_filename, digest=None):
+    """
+    将上传目录所在文件系统上的已有文件移入存储（用于分块上传完成时）
+
+    Args:
+        src_path: 已写完的文件，会被移动或删除
+        upload_dir: 上传目录
+        original_filename: 原始文件名
+        digest: 已知的 SHA-256 摘要（可选）
+
+    Returns:
+        tuple: (保存的文件名, 文件路径, 统计)
+    """
+    size = os.path.getsize(src_path)
+    digest = digest or file_sha256(src_path)
+    blob, deduplicated = commit_blob(upload_dir, src_path, digest)
+    filename, filepath = link_to_name(upload_dir, blob, original_filename)
+    return filename, filepath, {'bytes': size, 'sha256': digest, 'deduplicated': deduplicated}
+
+
+class SpooledUpload:
+    """
+    表单解析用的上传文件容器
+
+    作为 Werkzeug 的 stream_factory 返回值，解析器把上传内容写入这里：
+    数据直接落在 .store/tmp 中，同时累计字节数并计算 SHA-256。
+    commit() 把文件重命名为 blob；未提交的文件在 close() 时删除。
+
+    validator 在收到文件开头 SNIFF_SIZE 字节后调用一次，用于检查魔数；
+    超过 max_bytes 时立即中止，不再继续接收请求体。
+    """
+
+    def __init__(self, upload_dir, validator=None, max_bytes=None):
+        self.upload_dir = upload_dir
+        self.name = new_temp_path(upload_dir)
+        self._file = open(self.name, 'w+b')
+        self._hasher = hashlib.sha256()
+        self._started = time.time()
+        self._committed = False
+        self._validator = validator
+        self._head = bytearray()
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+
+    def _check_head(self):
+        validator, self._validator = self._validator, None
+        try:
+            validator(bytes(self._head))
+        except UploadRejected:
+            # 解析中途被拒绝时文件不会进入 request.files，需要自行清理
+            self.close()
+            raise
+        self._head = None
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.max_bytes is not None and self.bytes_written > self.max_bytes:
+            self.close()
+            raise UploadRejected(f'文件超过大小限制 {self.max_bytes / 1024 / 1024:.1f}MB', code=413)
+
+        if self._validator is not None:
+            self._head += data[:SNIFF_SIZE - len(self._head)]
+            if len(self._head) >= SNIFF_SIZE:
+                self._check_head()
+
+        self._hasher.update(data)
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self._validator is not None and self.bytes_written:
+            # 解析器写完一个文件后会回到开头，小于 SNIFF_SIZE 的文件在这里检查
+            self._check_head()
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        return self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def commit(self, original_filename):
+        """
+        将已写完的上传内容提交到存储
+
+        Returns:
+            tuple: (保存的文件名, 文件路径, 写入统计)
+        """
+        if self._validator is not None:
+            # 文件小于 SNIFF_SIZE 时在这里检查
+            self._check_head()
+        self._file.close()
+        digest = self._hasher.hexdigest()
+        blob, deduplicated = commit_blob(self.upload_dir, self.name, digest)
+        self._committed = True
+
+        seconds = time.time() - self._started
+        filename, filepath = link_to_name(self.upload_dir, blob, original_filename)
+        stats = {
+            'bytes': self.bytes_written,
+            'seconds': seconds,
+            'speed_mb_s': (self.bytes_written / 1024 / 1024) / seconds if seconds > 0 else 0.0,
+            'sha256': digest,
+            'deduplicated': deduplicated
+        }
+        return filename, filepath, stats
+
+    def close(self):
+        self._file.close()
+        if not self._committed and os.path.exists(self.name):
+            os.remove(self.name)
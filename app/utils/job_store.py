@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台发送任务的状态存储
+
+每个任务的状态保存为任务目录下的一个 JSON 文件（<job_id>.json），
+写入时先写临时文件再原子替换，多个 gunicorn 工作进程都可以查询任意任务的状态。
+更新（读取-修改-写入）时持有该任务的文件锁（<job_id>.lock），取消请求和执行线程的进度更新
+同时发生时不会丢失对方写入的字段；已取消的任务不会再被改回其他状态。
+
+取消请求记录为单独的标记文件（<job_id>.cancel），执行任务的线程（可能在其他工作进程中）
+在转换过程中定期检查它。
+
+任务状态：
+    status: queued / running / retrying / succeeded / failed / cancelled
+    stage:  queued / throttled / converting / sending / done
+    progress: 0-100
+"""
+import os
+import re
+import json
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# 超过该时间未更新的任务会被清理（秒）
+JOB_EXPIRE_SECONDS = 24 * 3600
+
+_JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _job_path(jobs_dir, job_id):
+    """返回任务状态文件路径，job_id 不合法时抛出 ValueError"""
+    if not job_id or not _JOB_ID_PATTERN.match(job_id):
+        raise ValueError('无效的任务ID')
+    return os.path.join(jobs_dir, f'{job_id}.json')
+
+
+def _cancel_path(jobs_dir, job_id):
+    """返回取消标记文件路径"""
+    return _job_path(jobs_dir, job_id)[:-len('.json')] + '.cancel'
+
+
+@contextmanager
+def _job_lock(jobs_dir, job_id):
+    """持有任务的文件锁（跨线程和工作进程），不支持 flock 的系统上不加锁"""
+    if fcntl is None:
+        yield
+        return
+    with open(_job_path(jobs_dir, job_id)[:-len('.json')] + '.lock', 'a+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _write_job(jobs_dir, job):
+    path = _job_path(jobs_dir, job['job_id'])
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def create_job(jobs_dir, filename, **extra):
+    """
+    创建任务
+
+    Args:
+        jobs_dir: 任务状态目录
+        filename: 要发送的文件名（原始文件名）
+        extra: 附加信息（如 sent_to）
+
+    Returns:
+        dict: 任务状态
+    """
+    os.makedirs(jobs_dir, exist_ok=True)
+    cleanup_expired_jobs(jobs_dir)
+
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'filename': filename,
+        'status': 'queued',
+        'stage': 'queued',
+        'progress': 0,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'timings': {},
+        'result': None,
+        'error': None
+    }
+    job.update(extra)
+    _write_job(jobs_dir, job)
+    return job
+
+
+def load_job(jobs_dir, job_id):
+    """
+    读取任务状态
+
+    Returns:
+        dict: 任务状态，不存在时返回 None
+    """
+    path = _job_path(jobs_dir, job_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def update_job(jobs_dir, job_id, **fields):
+    """
+    更新任务状态
+
+    执行线程和取消请求可能同时更新同一任务，读取、修改和写入在任务的文件锁内完成。
+    任务已取消后不再改变状态（执行线程稍后写入的进度等字段仍会记录）。
+
+    Returns:
+        dict: 更新后的任务状态
+    """
+    with _job_lock(jobs_dir, job_id):
+        job = load_job(jobs_dir, job_id)
+        if job is None:
+            raise ValueError('任务不存在')
+        timings = fields.pop('timings', None)
+        if job['status'] == 'cancelled':
+            fields.pop('status', None)
+        job.update(fields)
+        if timings:
+            job['timings'].update(timings)
+        _write_job(jobs_dir, job)
+        return job
+
+
+def request_cancel(jobs_dir, job_id):
+    """记录取消请求"""
+    with open(_cancel_path(jobs_dir, job_id), 'w') as f:
+        f.write(str(time.time()))
+
+
+def cancel_requested(jobs_dir, job_id):
+    """任务是否已被要求取消"""
+    try:
+        return os.path.exists(_cancel_path(jobs_dir, job_id))
+    except ValueError:
+        return False
+
+
+def cleanup_expired_jobs(jobs_dir, max_age=JOB_EXPIRE_SECONDS):
+    """清理超过保留时间未更新的任务"""
+    if not os.path.isdir(jobs_dir):
+        return
+
+    now = time.time()
+    for name in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
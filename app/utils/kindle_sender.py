@@ -5,12 +5,62 @@ Kindle邮件发送工具
 """
 import smtplib
 import os
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 from pathlib import Path
 
+from app.utils.smtp_pool import get_smtp_pool
+from app.utils.mime_stream import (
+    build_message_frame,
+    build_multi_message_frame,
+    send_message_stream,
+    estimate_encoded_size,
+    attachment_size,
+    supports_binary,
+    remember_binary_support,
+    binary_supported
+)
+
+# Kindle邮件大小限制（整封邮件，附件按实际传输编码计算：base64编码后或二进制原始大小）
+KINDLE_EMAIL_SIZE_LIMIT = 50 * 1024 * 1024
+
+# 邮件头、正文等附件以外部分预留的空间
+MESSAGE_OVERHEAD = 16 * 1024
+
+# 每个附件的MIME头（含较长的UTF-8文件名）和分隔行预留的空间
+ATTACHMENT_OVERHEAD = 1024
+
+# Send to Kindle 每封邮件最多接受的附件数
+MAX_ATTACHMENTS_PER_EMAIL = 25
+
+def max_attachment_size(limit=KINDLE_EMAIL_SIZE_LIMIT, binary=False):
+    """
+    返回在邮件大小限制内可发送的最大附件（原始字节数）
+    
+    Args:
+        binary: 按二进制传输（BDAT + BINARYMIME）计算，否则按base64编码后计算
+    """
+    budget = limit - MESSAGE_OVERHEAD
+    if binary:
+        return budget
+    # 每57字节原始数据编码为一行78字节（76字符+CRLF）
+    size = budget // 78 * 57
+    while estimate_encoded_size(size + 1) <= budget:
+        size += 1
+    return size
+
+def transfer_is_binary(smtp_server, smtp_port):
+    """
+    连接前估计发送时是否会使用二进制传输
+    
+    还没有连接过该服务器时按支持处理（只用于连接前的大小检查，连接后按服务器实际支持的方式再检查）
+    """
+    return binary_supported(smtp_server, smtp_port) is not False
+
+def choose_transfer_mode(server, smtp_server, smtp_port):
+    """检查已登录连接支持的传输方式并记录，返回是否使用二进制传输"""
+    binary = supports_binary(server)
+    remember_binary_support(smtp_server, smtp_port, binary)
+    return binary
+
 def send_to_kindle(
     kindle_email,
     sender_email,
@@ -18,7 +68,9 @@ def send_to_kindle(
     file_path,
     smtp_server="smtp.163.com",
     smtp_port=465,
-    subject="convert"
+    subject="convert",
+    progress_callback=None,
+    raise_on_error=False
 ):
     """
     发送文件到Kindle邮箱
@@ -31,6 +83,8 @@ def send_to_kindle(
         smtp_server: SMTP服务器
         smtp_port: SMTP端口
         subject: 邮件主题（convert会自动转换格式）
+        progress_callback: 发送进度回调 progress_callback(已发送字节数, 邮件总字节数)（可选）
+        raise_on_error: 发送出错时抛出原始异常而不是返回False（供发送队列判断是否重试）
     
     Returns:
         bool: 是否发送成功
@@ -46,79 +100,42 @@ def send_to_kindle(
         print(f"[KINDLE-SEND] 错误: 文件不存在 - {file_path}")
         return False
     
-    # 检查文件大小（邮件限制50MB）
-    file_size_mb = file_path.stat().st_size / 1024 / 1024
-    print(f"[KINDLE-SEND] 文件大小: {file_size_mb:.1f}MB")
+    # 检查文件大小（邮件限制50MB，按传输编码后的大小计算：服务器支持时为原始大小，否则为base64编码后）
+    file_size = file_path.stat().st_size
+    file_size_mb = file_size / 1024 / 1024
+    encoded_size_mb = estimate_encoded_size(file_size) / 1024 / 1024
+    print(f"[KINDLE-SEND] 文件大小: {file_size_mb:.1f}MB（base64编码后约 {encoded_size_mb:.1f}MB）")
     
-    if file_size_mb > 50:
-        print(f"[KINDLE-SEND] 警告: 文件大小 {file_size_mb:.1f}MB 超过50MB限制")
+    if file_size > max_attachment_size(binary=transfer_is_binary(smtp_server, smtp_port)):
+        print(f"[KINDLE-SEND] 警告: 文件编码后 {encoded_size_mb:.1f}MB 超过50MB邮件限制")
         return False
     
     print(f"[KINDLE-SEND] 准备发送: {file_path.name} ({file_size_mb:.1f}MB)")
     print(f"[KINDLE-SEND] 发送到: {kindle_email}")
     
     try:
-        # 创建邮件
+        # 创建邮件（附件内容在发送时才逐块读取编码）
         print(f"[KINDLE-SEND] 创建邮件...")
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = kindle_email
-        msg['Subject'] = subject
         print(f"[KINDLE-SEND] 邮件主题: {subject}")
-        
-        # 添加邮件正文
-        body = f"Sending {file_path.name} to Kindle\n\nKindle Transfer App"
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        
-        # 添加附件
         print(f"[KINDLE-SEND] 添加附件: {file_path.name}")
-        with open(file_path, 'rb') as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-        print(f"[KINDLE-SEND] 附件加载完成")
-        
-        encoders.encode_base64(part)
-        
-        # 处理文件名编码
-        filename = file_path.name
-        part.add_header(
-            'Content-Disposition',
-            'attachment',
-            filename=('utf-8', '', filename)
-        )
-        msg.attach(part)
-        print(f"[KINDLE-SEND] 邮件构建完成")
         
-        # 连接SMTP服务器
-        print(f"[KINDLE-SEND] 连接SMTP服务器: {smtp_server}:{smtp_port}")
-        
-        if smtp_port == 465:
-            # SSL连接
-            print(f"[KINDLE-SEND] 使用SSL连接")
-            server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        else:
-            # TLS连接
-            print(f"[KINDLE-SEND] 使用TLS连接")
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-        
-        print(f"[KINDLE-SEND] SMTP服务器连接成功")
-        
-        # 登录
-        print(f"[KINDLE-SEND] 登录邮箱: {sender_email}")
-        server.login(sender_email, sender_password)
-        print(f"[KINDLE-SEND] 邮箱登录成功")
-        
-        # 发送邮件
+        # 发送邮件（使用连接池中已登录的连接）
         print(f"[KINDLE-SEND] 发送邮件...")
         print(f"[KINDLE-SEND] 发件人: {sender_email}")
         print(f"[KINDLE-SEND] 收件人: {kindle_email}")
         
-        text = msg.as_string()
-        print(f"[KINDLE-SEND] 邮件大小: {len(text) / 1024:.1f}KB")
+        def deliver(server):
+            # 服务器支持时附件以二进制发送，大小限制按实际使用的编码检查
+            binary = choose_transfer_mode(server, smtp_server, smtp_port)
+            if file_size > max_attachment_size(binary=binary):
+                raise ValueError(f'{file_path.name} 编码后 {encoded_size_mb:.1f}MB 超过50MB邮件限制')
+            frame = build_message_frame(sender_email, kindle_email, subject, file_path, file_size,
+                                        binary=binary)
+            print(f"[KINDLE-SEND] 邮件构建完成（{'二进制' if binary else 'base64'}）")
+            print(f"[KINDLE-SEND] 邮件大小: {frame.size / 1024:.1f}KB")
+            send_message_stream(server, sender_email, kindle_email, frame, progress_callback)
         
-        server.sendmail(sender_email, kindle_email, text)
-        server.quit()
+        get_smtp_pool().run(smtp_server, smtp_port, sender_email, sender_password, deliver)
         
         print(f"[KINDLE-SEND] 发送成功！")
         print(f"[KINDLE-SEND] ========== 发送完成 ==========")
@@ -128,16 +145,251 @@ def send_to_kindle(
         print(f"[KINDLE-SEND] 错误: 邮箱认证失败，请检查邮箱和密码/授权码")
         print(f"[KINDLE-SEND] 详细错误: {e}")
         print(f"[KINDLE-SEND] ========== 发送失败 ==========")
+        if raise_on_error:
+            raise
         return False
     except smtplib.SMTPException as e:
         print(f"[KINDLE-SEND] SMTP错误: {e}")
         print(f"[KINDLE-SEND] ========== 发送失败 ==========")
+        if raise_on_error:
+            raise
         return False
     except Exception as e:
         print(f"[KINDLE-SEND] 发送失败: {e}")
         print(f"[KINDLE-SEND] ========== 发送失败 ==========")
+        if raise_on_error:
+            raise
         return False
 
+def send_to_kindle_recipients(
+    kindle_emails,
+    sender_email,
+    sender_password,
+    file_path,
+    smtp_server="smtp.163.com",
+    smtp_port=465,
+    subject="convert",
+    progress_callback=None,
+    raise_on_error=False
+):
+    """
+    把同一个文件发送到多个Kindle邮箱
+    
+    在一个SMTP事务中逐个 RCPT TO，附件只读取编码、传输一次，由服务器分发给各收件人。
+    
+    Args:
+        kindle_emails: Kindle邮箱地址列表
+        raise_on_error: 整封邮件发送失败时抛出原始异常（否则记为每个收件人的错误）
+        其余参数同 send_to_kindle
+    
+    Returns:
+        dict: Kindle邮箱 -> 发送成功为 None，失败为异常对象
+    """
+    print(f"[KINDLE-SEND] ========== 开始发送文件到 {len(kindle_emails)} 个Kindle邮箱 ==========")
+    print(f"[KINDLE-SEND] 文件路径: {file_path}")
+    print(f"[KINDLE-SEND] Kindle邮箱: {', '.join(kindle_emails)}")
+    
+    file_path = Path(file_path)
+    try:
+        if not file_path.exists():
+            raise FileNotFoundError(f'文件不存在: {file_path}')
+        file_size = file_path.stat().st_size
+        if file_size > max_attachment_size(binary=transfer_is_binary(smtp_server, smtp_port)):
+            raise ValueError(f'{file_path.name} 编码后超过50MB邮件限制')
+        
+        def deliver(server):
+            binary = choose_transfer_mode(server, smtp_server, smtp_port)
+            if file_size > max_attachment_size(binary=binary):
+                raise ValueError(f'{file_path.name} 编码后超过50MB邮件限制')
+            frame = build_message_frame(sender_email, kindle_emails, subject, file_path, file_size,
+                                        binary=binary)
+            print(f"[KINDLE-SEND] 邮件大小: {frame.size / 1024:.1f}KB")
+            return send_message_stream(server, sender_email, kindle_emails, frame, progress_callback)
+        
+        refused = get_smtp_pool().run(smtp_server, smtp_port, sender_email, sender_password, deliver)
+    except Exception as e:
+        print(f"[KINDLE-SEND] 发送失败: {e}")
+        print(f"[KINDLE-SEND] ========== 发送失败 ==========")
+        if raise_on_error:
+            raise
+        return {kindle_email: e for kindle_email in kindle_emails}
+    
+    results = {}
+    for kindle_email in kindle_emails:
+        if kindle_email in refused:
+            print(f"[KINDLE-SEND] 收件人被拒绝: {kindle_email} {refused[kindle_email]}")
+            results[kindle_email] = smtplib.SMTPRecipientsRefused({kindle_email: refused[kindle_email]})
+        else:
+            results[kindle_email] = None
+    print(f"[KINDLE-SEND] ========== 发送完成: {len(kindle_emails) - len(refused)}/{len(kindle_emails)} 个收件人 ==========")
+    return results
+
+def pack_attachments(sizes, limit=KINDLE_EMAIL_SIZE_LIMIT, max_count=MAX_ATTACHMENTS_PER_EMAIL, binary=False):
+    """
+    把多个附件装进尽量少的邮件（首次适应递减算法）
+    
+    附件按传输编码后的大小从大到小依次放入第一封放得下的邮件，放不下时新开一封。
+    单个超过限制的附件单独成一封（由调用方拒绝）。
+    
+    Args:
+        sizes: 各附件的原始字节数
+        limit: 每封邮件的大小限制
+        max_count: 每封邮件最多的附件数
+        binary: 按二进制传输计算附件大小，否则按base64编码后计算
+    
+    Returns:
+        list: 每封邮件包含的附件下标列表（按原顺序排列）
+    """
+    capacity = limit - MESSAGE_OVERHEAD
+    weights = [attachment_size(size, binary) + ATTACHMENT_OVERHEAD for size in sizes]
+    order = sorted(range(len(sizes)), key=lambda i: weights[i], reverse=True)
+    
+    bins = []       # [[剩余空间, [下标]]]
+    for index in order:
+        for slot in bins:
+            if weights[index] <= slot[0] and len(slot[1]) < max_count:
+                slot[0] -= weights[index]
+                slot[1].append(index)
+                break
+        else:
+            bins.append([capacity - weights[index], [index]])
+    return [sorted(indexes) for _, indexes in bins]
+
+def estimate_send_volume(sizes):
+    """
+    估算发送一组附件需要的邮件封数和总字节数（用于发送速率限制）
+    
+    Returns:
+        tuple: (邮件封数, 总字节数)
+    """
+    messages = len(pack_attachments(sizes))
+    nbytes = messages * MESSAGE_OVERHEAD + sum(
+        estimate_encoded_size(size) + ATTACHMENT_OVERHEAD for size in sizes)
+    return messages, nbytes
+
+def plan_messages(file_paths, binary=False):
+    """
+    检查文件并把它们分配到各封邮件中
+    
+    Args:
+        binary: 按二进制传输计算大小限制
+    
+    Returns:
+        tuple: (Path列表, 文件大小列表, 结果列表, 每封邮件的文件下标列表)，
+               结果列表中不存在或超过大小限制的文件为对应的异常，其余为 None
+    """
+    paths = [Path(file_path) for file_path in file_paths]
+    results = [None] * len(paths)
+    sizes = []
+    for index, file_path in enumerate(paths):
+        try:
+            sizes.append(file_path.stat().st_size)
+        except OSError as e:
+            print(f"[KINDLE-SEND] 错误: 文件不存在 - {file_path}")
+            results[index] = e
+            sizes.append(0)
+    
+    groups = group_attachments(paths, sizes, results, list(range(len(paths))), binary)
+    return paths, sizes, results, groups
+
+def group_attachments(paths, sizes, results, indexes, binary=False):
+    """
+    把 indexes 中的文件装进各封邮件，超过大小限制的文件在 results 中记为错误
+    
+    连接后发现服务器支持的传输方式与计划不同时，用实际的方式重新分组尚未发送的文件
+    
+    Returns:
+        list: 每封邮件的文件下标列表
+    """
+    limit = max_attachment_size(binary=binary)
+    groups = []
+    for group in pack_attachments([sizes[index] for index in indexes], binary=binary):
+        valid = []
+        for position in group:
+            index = indexes[position]
+            if results[index] is not None:
+                continue
+            if sizes[index] > limit:
+                print(f"[KINDLE-SEND] 警告: {paths[index].name} 编码后超过50MB邮件限制")
+                results[index] = ValueError(f'{paths[index].name} 编码后超过50MB邮件限制')
+                continue
+            valid.append(index)
+        if valid:
+            groups.append(valid)
+    return groups
+
+def send_files_to_kindle(
+    kindle_email,
+    sender_email,
+    sender_password,
+    file_paths,
+    smtp_server="smtp.163.com",
+    smtp_port=465,
+    subject="convert"
+):
+    """
+    把多个文件合并成尽量少的邮件发送到同一个Kindle邮箱
+    
+    所有邮件使用连接池中的同一个已登录连接依次发送；某封邮件失败不影响其他邮件。
+    
+    Args:
+        file_paths: 文件路径列表
+        其余参数同 send_to_kindle
+    
+    Returns:
+        list: 与 file_paths 一一对应，发送成功为 None，失败为异常对象
+    """
+    print(f"[KINDLE-SEND] ========== 开始批量发送 {len(file_paths)} 个文件到Kindle ==========")
+    print(f"[KINDLE-SEND] Kindle邮箱: {kindle_email}")
+    
+    planned = transfer_is_binary(smtp_server, smtp_port)
+    paths, sizes, results, groups = plan_messages(file_paths, binary=planned)
+    print(f"[KINDLE-SEND] 合并为 {len(groups)} 封邮件")
+    
+    sent = set()
+    plan = {'binary': planned, 'groups': groups}
+    
+    def deliver(server):
+        binary = choose_transfer_mode(server, smtp_server, smtp_port)
+        if binary != plan['binary']:
+            pending = [index for group in plan['groups'] for index in group
+                       if index not in sent and results[index] is None]
+            plan.update(binary=binary, groups=group_attachments(paths, sizes, results, pending, binary))
+        
+        # 某封邮件被拒绝时记录错误后继续发送下一封；
+        # 连接断开时连接池换新连接重新调用，已发送和已失败的邮件跳过
+        for group in plan['groups']:
+            if group[0] in sent or results[group[0]] is not None:
+                continue
+            frame = build_multi_message_frame(
+                sender_email, kindle_email, subject,
+                [(paths[index], sizes[index]) for index in group],
+                binary=binary
+            )
+            print(f"[KINDLE-SEND] 发送邮件: {len(group)} 个附件，{frame.size / 1024:.1f}KB")
+            try:
+                send_message_stream(server, sender_email, kindle_email, frame)
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code == 421:
+                    raise
+                for index in group:
+                    results[index] = e
+                continue
+            sent.update(group)
+    
+    try:
+        get_smtp_pool().run(smtp_server, smtp_port, sender_email, sender_password, deliver)
+    except Exception as e:
+        print(f"[KINDLE-SEND] 发送失败: {e}")
+        for group in plan['groups']:
+            for index in group:
+                if index not in sent and results[index] is None:
+                    results[index] = e
+    
+    failed = sum(1 for error in results if error is not None)
+    print(f"[KINDLE-SEND] ========== 批量发送完成: {len(paths) - failed}/{len(paths)} 成功 ==========")
+    return results
+
 def get_smtp_config(email):
     """
     根据邮箱类型返回SMTP配置
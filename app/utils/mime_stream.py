@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式邮件发送
+
+邮件头、正文和附件的MIME头仍由 email 包生成（保证编码方式与原来一致），
+附件内容不进入 email 包：发送时按块读取文件、逐行 base64 编码后直接写入 SMTP 数据连接。
+无论附件多大，内存中只保留一个读取块及其编码结果。
+配置了 part_cache 时，编码好的附件部分（附件头 + 内容）保存在磁盘上，再次发送同一文件时直接写入连接。
+
+服务器支持 CHUNKING 和 BINARYMIME（RFC 3030）时，附件不做 base64 编码，以原始字节通过 BDAT 分块发送，
+邮件小约四分之一，也不需要编码附件。
+"""
+import os
+import base64
+import socket
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email import policy
+
+from app.utils.part_cache import get_part_cache
+
+# 每次读取的原始字节数，57字节恰好编码为一行76个字符
+READ_BLOCK_SIZE = 57 * 16 * 1024
+
+# 附件内容在邮件模板中的占位符
+_PLACEHOLDER = 'KINDLE-TRANSFER-ATTACHMENT-PAYLOAD'
+
+# 每个 BDAT 命令发送的最大字节数（每块等待一次服务器响应）
+BDAT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 按 (服务器, 端口) 记录最近一次连接时是否支持二进制传输，用于连接前估算可发送的附件大小
+_binary_servers = {}
+
+
+class MessageFrame:
+    """
+    不含附件内容的邮件模板
+
+    segments[0] + 附件1 + segments[1] + 附件2 + ... + segments[-1] 即为完整邮件（CRLF换行），
+    每个附件部分为 headers[i]（附件的MIME头）加 base64 编码内容；
+    binary 为 True 时附件为原始字节（只能通过 BDAT 发送，模板不做点填充）
+    """
+
+    def __init__(self, segments, files, headers=None, binary=False):
+        self.segments = segments
+        self.files = files      # [(文件路径, 文件大小)]
+        self.headers = headers if headers is not None else [b''] * len(files)
+        self.binary = binary
+
+    @property
+    def size(self):
+        """完整邮件的字节数"""
+        return (sum(len(segment) for segment in self.segments)
+                + sum(len(header) for header in self.headers)
+                + sum(attachment_size(size, self.binary) for _, size in self.files))
+
+
+def estimate_encoded_size(size):
+    """
+    估算附件base64编码后的大小
+    
+    base64每3字节编码为4字符，每76字符一行，行尾为CRLF
+    """
+    encoded = (size + 2) // 3 * 4
+    lines = (encoded + 75) // 76
+    return encoded + lines * 2
+
+
+def attachment_size(size, binary=False):
+    """附件在邮件中占用的字节数（二进制传输时为原始大小，否则为base64编码后的大小）"""
+    return size if binary else estimate_encoded_size(size)
+
+
+def supports_binary(server):
+    """已登录的 smtplib 连接是否支持 BDAT 二进制传输（CHUNKING + BINARYMIME）"""
+    server.ehlo_or_helo_if_needed()
+    return bool(server.has_extn('chunking') and server.has_extn('binarymime'))
+
+
+def remember_binary_support(smtp_server, smtp_port, binary):
+    """记录服务器是否支持二进制传输"""
+    _binary_servers[(smtp_server, smtp_port)] = bool(binary)
+
+
+def binary_supported(smtp_server, smtp_port):
+    """最近一次连接该服务器时是否支持二进制传输（还没有连接过时返回 None）"""
+    return _binary_servers.get((smtp_server, smtp_port))
+
+
+def build_message_frame(sender_email, recipient, subject, file_path, file_size, body=None, binary=False):
+    """
+    生成单个附件的邮件模板
+
+    Args:
+        sender_email: 发件人
+        recipient: 收件人（多个收件人时为列表）
+        subject: 邮件主题
+        file_path: 附件路径（Path）
+        file_size: 附件大小
+        body: 邮件正文（可选）
+        binary: 附件使用二进制传输（服务器需支持 CHUNKING 和 BINARYMIME）
+
+    Returns:
+        MessageFrame
+    """
+    return build_multi_message_frame(sender_email, recipient, subject, [(file_path, file_size)], body, binary)
+
+
+def build_multi_message_frame(sender_email, recipient, subject, files, body=None, binary=False):
+    """
+    生成包含多个附件的邮件模板
+
+    Args:
+        files: [(附件路径（Path）, 附件大小)]
+        binary: 附件使用二进制传输
+
+    Returns:
+        MessageFrame
+    """
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient if isinstance(recipient, str) else ', '.join(recipient)
+    msg['Subject'] = subject
+
+    if body is None:
+        names = ', '.join(file_path.name for file_path, _ in files)
+        body = f"Sending {names} to Kindle\n\nKindle Transfer App"
+    msg.attach(MIMEText(body, 'plain', 'utf-8'))
+
+    headers = []
+    for index, (file_path, _) in enumerate(files):
+        part = MIMEBase('application', 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'binary' if binary else 'base64'
+        part.add_header(
+            'Content-Disposition',
+            'attachment',
+            filename=('utf-8', '', file_path.name)
+        )
+        part.set_payload(f'{_PLACEHOLDER}-{index}')
+        msg.attach(part)
+        # 附件头与附件内容一起缓存
+        headers.append(part.as_bytes(policy=policy.SMTP).split(f'{_PLACEHOLDER}-{index}'.encode('ascii'))[0])
+
+    text = msg.as_bytes(policy=policy.SMTP)
+    segments = []
+    for index in range(len(files)):
+        segment, text = text.split(f'{_PLACEHOLDER}-{index}'.encode('ascii'), 1)
+        if segment.endswith(headers[index]):
+            segment = segment[:-len(headers[index])]
+        else:
+            headers[index] = b''
+        segments.append(segment)
+        # 占位符后面原有的换行由编码内容的最后一行提供（原始字节不一定以换行结尾，保留）
+        if not binary and text.startswith(b'\r\n'):
+            text = text[2:]
+    if not text.endswith(b'\r\n'):
+        text += b'\r\n'
+    segments.append(text)
+    if binary:
+        return MessageFrame(segments, files, headers, binary=True)
+    return MessageFrame([dot_stuff(segment) for segment in segments], files, headers)
+
+
+def dot_stuff(data):
+    """SMTP DATA 中以 . 开头的行需要再加一个 .（base64内容不会以 . 开头，无需处理）"""
+    if data.startswith(b'.'):
+        data = b'.' + data
+    return data.replace(b'\r\n.', b'\r\n..')
+
+
+def iter_encoded_file(file_path, block_size=READ_BLOCK_SIZE):
+    """按块读取文件并生成 base64 编码的行（CRLF换行）"""
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield base64.encodebytes(block).replace(b'\n', b'\r\n')
+
+
+def iter_parts(frame):
+    """
+    按顺序生成邮件内容：bytes 为要写入连接的数据，文件对象为已缓存的附件部分（附件头 + 编码内容）
+
+    未缓存的附件边编码边写入缓存，全部生成完才保存；调用方中途停止（关闭生成器）时丢弃。
+    二进制传输时附件就是原文件，直接生成打开的原文件
+    """
+    cache = get_part_cache()
+    for segment, header, (file_path, size) in zip(frame.segments, frame.headers, frame.files):
+        yield segment
+        if frame.binary:
+            yield header
+            with open(file_path, 'rb') as f:
+                yield f
+            continue
+        if cache is None:
+            yield header
+            yield from iter_encoded_file(file_path)
+            continue
+
+        key = cache.key(file_path, header)
+        cached = cache.open(key)
+        if cached is not None:
+            with cached:
+                yield cached
+            continue
+
+        writer = cache.writer(key, len(header) + estimate_encoded_size(size))
+        try:
+            writer.write(header)
+            yield header
+            for chunk in iter_encoded_file(file_path):
+                writer.write(chunk)
+                yield chunk
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+    yield frame.segments[-1]
+
+
+def iter_message(frame, block_size=READ_BLOCK_SIZE):
+    """按块生成完整邮件"""
+    for item in iter_parts(frame):
+        if isinstance(item, bytes):
+            yield item
+            continue
+        while True:
+            chunk = item.read(block_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def send_message_stream(server, sender_email, recipient, frame, progress_callback=None):
+    """
+    在已登录的连接上发送邮件，附件边编码边写入连接
+
+    Args:
+        recipient: 收件人，多个收件人时为列表（同一个事务中逐个 RCPT TO，邮件内容只传输一次）
+        progress_callback: progress_callback(已发送字节数, 邮件总字节数)，每写入一块调用一次
+
+    Returns:
+        dict: 被拒绝的收件人 {收件人: (响应码, 内容)}，全部接受时为空
+
+    出错时抛出与 smtplib.sendmail 相同的异常（所有收件人都被拒绝时抛出 SMTPRecipientsRefused）。
+    二进制模板（frame.binary）使用 BDAT 发送，调用方需先用 supports_binary() 确认服务器支持
+    """
+    server.ehlo_or_helo_if_needed()
+
+    options = []
+    if server.has_extn('size'):
+        options.append(f'SIZE={frame.size}')
+    if frame.binary:
+        options.append('BODY=BINARYMIME')
+
+    code, resp = server.mail(sender_email, options)
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPSenderRefused(code, resp, sender_email)
+
+    recipients = [recipient] if isinstance(recipient, str) else list(recipient)
+    refused = {}
+    for address in recipients:
+        code, resp = server.rcpt(address)
+        if code not in (250, 251):
+            refused[address] = (code, resp)
+        if code == 421:
+            break
+    if len(refused) == len(recipients) or code == 421:
+        _reset(server, code)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    if frame.binary:
+        _send_chunked(server, frame, progress_callback)
+        return refused
+
+    code, resp = server.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+
+    sent = 0
+    parts = iter_parts(frame)
+    try:
+        for item in parts:
+            if isinstance(item, bytes):
+                server.send(item)
+                sent += len(item)
+            elif isinstance(getattr(server, 'sock', None), socket.socket):
+                # 缓存的附件部分直接从文件写入连接，不经过Python缓冲区
+                try:
+                    sent += server.sock.sendfile(item)
+                except OSError as e:
+                    server.close()
+                    raise smtplib.SMTPServerDisconnected(str(e)) from e
+            else:
+                while True:
+                    chunk = item.read(READ_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    server.send(chunk)
+                    sent += len(chunk)
+            if progress_callback is not None:
+                progress_callback(sent, frame.size)
+    finally:
+        parts.close()
+    server.send(b'.\r\n')
+
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _send_chunked(server, frame, progress_callback=None):
+    """
+    用 BDAT 分块发送邮件内容（不需要点填充）
+
+    小段的邮件头和分隔行攒起来与后面的附件内容放在同一块中，附件按 BDAT_CHUNK_SIZE 分块，
+    每块等待一次服务器响应；最后一块带 LAST
+    """
+    sent = 0
+    pending = b''
+
+    def chunk(data, f=None, count=0, last=False):
+        nonlocal sent
+        size = len(data) + count
+        server.send(f"BDAT {size}{' LAST' if last else ''}\r\n".encode('ascii'))
+        if data:
+            server.send(data)
+        if count:
+            _send_file_range(server, f, count)
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        sent += size
+        if progress_callback is not None:
+            progress_callback(sent, frame.size)
+
+    parts = iter_parts(frame)
+    try:
+        for item in parts:
+            if isinstance(item, bytes):
+                pending += item
+                continue
+            remaining = os.fstat(item.fileno()).st_size - item.tell()
+            while remaining > 0:
+                count = min(remaining, max(BDAT_CHUNK_SIZE - len(pending), READ_BLOCK_SIZE))
+                chunk(pending, item, count)
+                pending = b''
+                remaining -= count
+        chunk(pending, last=True)
+    finally:
+        parts.close()
+
+
+def _send_file_range(server, f, count):
+    """从文件当前位置发送 count 字节（真实连接使用 socket.sendfile）"""
+    if isinstance(getattr(server, 'sock', None), socket.socket):
+        try:
+            server.sock.sendfile(f, f.tell(), count)
+        except OSError as e:
+            server.close()
+            raise smtplib.SMTPServerDisconnected(str(e)) from e
+        return
+    while count > 0:
+        block = f.read(min(READ_BLOCK_SIZE, count))
+        if not block:
+            raise OSError('文件在发送过程中被截断')
+        server.send(block)
+        count -= len(block)
+
+
+def _reset(server, code):
+    """命令被拒绝后清除事务状态（421表示服务器即将断开，无需RSET）"""
+    if code == 421:
+        server.close()
+    else:
+        server.rset()
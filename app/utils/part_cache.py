@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+已编码附件的磁盘缓存
+
+同一个文件（如热门文档）重复发送时，每次都要把整个文件 base64 编码一遍，30-50MB 的PDF要花不少CPU。
+这里把可以直接写入 SMTP 数据连接的 MIME 附件部分（附件头 + base64 内容，CRLF换行）保存在磁盘上：
+- 按文件内容的 SHA-256 和附件头（包含文件名）索引，内容或文件名不同的附件互不影响
+- 第一次发送时边编码边写入缓存，发送中断时丢弃不完整的缓存
+- 缓存总大小超过上限时按最近使用时间（文件修改时间）删除最久未用的部分
+- 命中缓存时返回打开的缓存文件，发送方可以直接把它写入连接（socket.sendfile）
+
+缓存目录可以被多个工作进程共用：先写临时文件再原子重命名，已打开的缓存文件被删除后仍可读完。
+未调用 configure_part_cache() 时不使用缓存。
+"""
+import os
+import time
+import hashlib
+import threading
+
+# 默认缓存上限（字节）
+PART_CACHE_SIZE = 512 * 1024 * 1024
+
+# 计算内容摘要时每次读取的字节数
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# 超过这个时间（秒）的临时文件视为写入中断遗留，清理时删除
+STALE_TEMP_AGE = 3600
+
+_SUFFIX = '.part'
+
+
+class PartCache:
+    """一个缓存目录"""
+
+    def __init__(self, directory, max_bytes=PART_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def content_digest(self, file_path):
+        """文件内容的 SHA-256（按路径、大小和修改时间记住结果，同一个文件多次发送只计算一次）"""
+        stat = os.stat(file_path)
+        memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is not None:
+            return digest
+
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                sha.update(block)
+        digest = sha.digest()
+        with self._lock:
+            if len(self._digests) >= 1024:
+                self._digests.clear()
+            self._digests[memo_key] = digest
+        return digest
+
+    def key(self, file_path, header):
+        """缓存键：文件内容摘要 + 附件头（含文件名）"""
+        return hashlib.sha256(self.content_digest(file_path) + header).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def open(self, key):
+        """
+        打开缓存的附件部分并标记为最近使用
+
+        Returns:
+            file: 以二进制只读方式打开的缓存文件，未缓存时返回 None
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return f
+
+    def writer(self, key, expected_size):
+        """
+        写入一个附件部分，全部写完后调用 commit()，中途放弃时调用 discard()
+
+        超过缓存上限的附件不缓存（返回的写入器忽略所有数据）
+        """
+        if expected_size > self.max_bytes:
+            return PartWriter(self, key, enabled=False)
+        return PartWriter(self, key)
+
+    def _commit(self, key, temp_path):
+        os.replace(temp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """删除最久未用的部分，使缓存总大小不超过上限"""
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(_SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            elif now - stat.st_mtime > STALE_TEMP_AGE:
+                _remove(path)
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+class PartWriter:
+    """边发送边写入缓存；写入失败（如磁盘已满）只放弃缓存，不影响发送"""
+
+    def __init__(self, cache, key, enabled=True):
+        self.cache = cache
+        self.key = key
+        self.file = None
+        self.temp_path = None
+        if enabled:
+            self.temp_path = os.path.join(
+                cache.directory, f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+            try:
+                self.file = open(self.temp_path, 'wb')
+            except OSError:
+                self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            return
+        try:
+            self.file.write(data)
+        except OSError:
+            self.discard()
+
+    def commit(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+            self.file = None
+            self.cache._commit(self.key, self.temp_path)
+        except OSError:
+            self.discard()
+
+    def discard(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        if self.temp_path is not None:
+            _remove(self.temp_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_part_cache(directory, max_bytes=PART_CACHE_SIZE):
+    """设置缓存目录和上限，max_bytes 为 0 时不使用缓存"""
+    global _cache
+    with _cache_lock:
+        if not max_bytes:
+            _cache = None
+        elif _cache is None or _cache.directory != directory or _cache.max_bytes != max_bytes:
+            _cache = PartCache(directory, max_bytes)
+
+
+def get_part_cache():
+    """返回进程内共享的缓存，未配置时返回 None"""
+    return _cache
@@ -3,12 +3,105 @@
 """
 PDF转换工具 - 使用Calibre转换PDF到EPUB
 注意：当前配置默认不转换PDF，直接发送原始PDF文件到Kindle
+
+ebook-convert 在独立的进程组中运行，受 ConversionLimits 限制：
+- 总耗时（墙钟时间）超过 timeout 或调用方要求取消时，终止整个进程组（先 SIGTERM，稍后 SIGKILL）
+- CPU时间（RLIMIT_CPU）和地址空间（RLIMIT_AS）由内核限制，进程启动后立即用 prlimit 设置
+  （不使用 preexec_fn：它在多线程的工作进程中 fork 后执行Python代码，可能死锁）
+转换结束后也会清理进程组中残留的子进程。
+
+get_converter() 在每个进程中只查找一次 ebook-convert（gunicorn 预加载时在主进程中查找，
+工作进程直接继承结果），并记录版本和支持的输入格式；只有缓存的程序文件不存在或被替换时才重新查找。
 """
 import os
+import time
+import signal
 import subprocess
+import threading
 from pathlib import Path
 import platform
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ebook-convert 的转换选项（也是转换结果缓存键的一部分）
+EPUB_OPTIONS = [
+    "--enable-heuristics",  # 启用启发式处理
+    "--margin-top", "20",
+    "--margin-bottom", "20",
+    "--margin-left", "20",
+    "--margin-right", "20",
+    "--pretty-print",  # 美化输出
+    "--insert-blank-line",  # 段落间插入空行
+    "--language", "zh-CN",  # 设置语言为中文
+]
+
+# 默认单次转换的最长耗时（秒）
+CONVERT_TIMEOUT = 600
+
+# 默认单次转换的CPU时间上限（秒）
+CONVERT_CPU_LIMIT = 900
+
+# 默认转换进程的地址空间上限（字节）
+CONVERT_MEMORY_LIMIT = 4 * 1024 * 1024 * 1024
+
+# 检查超时和取消的间隔（秒）
+SUPERVISE_INTERVAL = 0.5
+
+# SIGTERM 后等待进程退出的时间（秒），超过后 SIGKILL
+KILL_GRACE = 5
+
+# Calibre 支持的输入格式（无法通过 calibre-debug 查询时使用）
+DEFAULT_INPUT_FORMATS = [
+    'azw', 'azw3', 'azw4', 'cb7', 'cbc', 'cbr', 'cbz', 'chm', 'djvu', 'docx', 'epub', 'fb2', 'fbz',
+    'html', 'htmlz', 'lit', 'lrf', 'mobi', 'odt', 'pdb', 'pdf', 'pml', 'prc', 'rb', 'rtf', 'snb',
+    'tcr', 'txt', 'txtz'
+]
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+_converter = None
+_converter_stat = None
+_converter_lock = threading.Lock()
+
+
+class ConversionCancelled(Exception):
+    """转换被调用方取消"""
+
+
+class ConversionTimeout(Exception):
+    """转换超过最长耗时"""
+
+
+class ConversionLimits:
+    """单次转换的资源限制，值为0或None的项不限制"""
+
+    def __init__(self, timeout=CONVERT_TIMEOUT, cpu_seconds=CONVERT_CPU_LIMIT, memory_bytes=CONVERT_MEMORY_LIMIT):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+
+    def apply(self, pid):
+        """
+        为已启动的转换进程设置 rlimit（之后启动的子进程继承该限制）
+
+        只在支持 prlimit 的系统（Linux）上生效，其他系统只受 timeout 限制
+        """
+        if resource is None or not hasattr(resource, 'prlimit'):
+            return
+        try:
+            if self.cpu_seconds:
+                # 到达软限制时收到 SIGXCPU，忽略它的进程在硬限制时被 SIGKILL
+                resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds + KILL_GRACE))
+            if self.memory_bytes:
+                resource.prlimit(pid, resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+        except ProcessLookupError:
+            # 进程已经结束
+            pass
+
 def find_calibre():
     """查找Calibre安装路径"""
     possible_paths = []
@@ -60,16 +153,203 @@ def find_calibre():
     
     return None
 
-def convert_pdf_to_epub(pdf_path, output_dir=None):
+def converter_version(calibre_path):
+    """
+    ebook-convert 的版本信息（每个路径只查询一次）
+    
+    Returns:
+        str: `ebook-convert --version` 输出的第一行，查询失败时返回 None
+    """
+    with _versions_lock:
+        if calibre_path in _versions:
+            return _versions[calibre_path]
+    try:
+        result = subprocess.run([calibre_path, "--version"], capture_output=True, text=True, timeout=30)
+        version = result.stdout.strip().splitlines()[0] if result.returncode == 0 and result.stdout.strip() else None
+    except Exception:
+        version = None
+    with _versions_lock:
+        _versions[calibre_path] = version
+    return version
+
+def input_formats(calibre_path):
+    """
+    Calibre 支持的输入格式（通过同目录下的 calibre-debug 查询）
+    
+    Returns:
+        list: 小写的扩展名，查询失败时返回 DEFAULT_INPUT_FORMATS
+    """
+    real_path = Path(os.path.realpath(calibre_path))
+    debug_path = real_path.with_name('calibre-debug' + real_path.suffix)
+    code = ("from calibre.customize.ui import available_input_formats; "
+            "print(' '.join(sorted(available_input_formats())))")
+    try:
+        result = subprocess.run([str(debug_path), '-c', code], capture_output=True, text=True, timeout=30)
+        formats = result.stdout.split() if result.returncode == 0 else []
+    except Exception:
+        formats = []
+    return sorted(f.lower() for f in formats) or list(DEFAULT_INPUT_FORMATS)
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def probe_converter():
+    """
+    查找 ebook-convert 并查询版本和支持的输入格式
+    
+    Returns:
+        dict: ready（是否可以转换）、path、version、input_formats、probed_at
+    """
+    calibre_path = find_calibre()
+    info = {'ready': False, 'path': calibre_path, 'version': None, 'input_formats': [], 'probed_at': time.time()}
+    if calibre_path:
+        with _versions_lock:
+            _versions.pop(calibre_path, None)
+        info.update(ready=True, version=converter_version(calibre_path),
+                    input_formats=input_formats(calibre_path))
+    return info
+
+def get_converter(refresh=False):
+    """
+    本进程缓存的转换器信息（格式同 probe_converter）
+    
+    第一次调用时查找，之后只检查缓存的 ebook-convert 是否还在（一次 stat），
+    程序文件不存在或被替换（如升级 Calibre）时重新查找。未找到 Calibre 的结果也会缓存，
+    安装 Calibre 后需要重启服务或调用 get_converter(refresh=True)。
+    """
+    global _converter, _converter_stat
+    info = _converter
+    if info is not None and not refresh:
+        if not info['ready'] or _file_stat(info['path']) == _converter_stat:
+            return info
+    with _converter_lock:
+        if _converter is info:
+            if info is not None and info['ready'] and not refresh:
+                print(f"ebook-convert 已变化，重新查找: {info['path']}")
+            _converter = probe_converter()
+            _converter_stat = _file_stat(_converter['path']) if _converter['ready'] else None
+        return _converter
+
+def converter_ready():
+    """是否找到了可用的 ebook-convert"""
+    return get_converter()['ready']
+
+def epub_output_path(pdf_path, output_dir=None):
+    """转换结果的路径：默认与PDF同目录同名，指定输出目录时放在输出目录中"""
+    pdf_path = Path(pdf_path)
+    if output_dir:
+        return Path(output_dir) / f"{pdf_path.stem}.epub"
+    return pdf_path.with_suffix('.epub')
+
+def terminate_group(proc, graceful=True):
+    """
+    结束转换进程所在的整个进程组
+    
+    Args:
+        graceful: 先发送 SIGTERM 并等待 KILL_GRACE 秒，仍未退出时再 SIGKILL；为 False 时直接 SIGKILL
+    """
+    if os.name != 'posix':
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        return
+    
+    def kill_group(sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+    
+    if graceful and proc.poll() is None:
+        kill_group(signal.SIGTERM)
+        try:
+            proc.wait(KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            pass
+    kill_group(signal.SIGKILL)
+    proc.wait()
+
+def run_converter(cmd, limits=None, should_cancel=None):
+    """
+    在独立的进程组中运行转换命令，超时或取消时终止整个进程组
+    
+    Args:
+        cmd: 命令
+        limits: ConversionLimits，默认使用模块的默认限制
+        should_cancel: 无参数的函数，返回 True 时取消转换（定期调用）
+    
+    Returns:
+        tuple: (退出码, 标准错误输出)
+    
+    Raises:
+        ConversionTimeout: 超过最长耗时
+        ConversionCancelled: 被取消
+    """
+    limits = limits or ConversionLimits()
+    if should_cancel is not None and should_cancel():
+        raise ConversionCancelled('转换已取消')
+    
+    posix = os.name == 'posix'
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        start_new_session=posix
+    )
+    try:
+        limits.apply(proc.pid)
+    except Exception:
+        terminate_group(proc, graceful=False)
+        raise
+    deadline = time.monotonic() + limits.timeout if limits.timeout else None
+    finished = False
+    try:
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=SUPERVISE_INTERVAL)
+                finished = True
+                return proc.returncode, stderr
+            except subprocess.TimeoutExpired:
+                pass
+            if proc.poll() is not None:
+                # 转换进程已退出，但残留的子进程仍占用输出管道
+                finished = True
+                terminate_group(proc, graceful=False)
+                _, stderr = proc.communicate()
+                return proc.returncode, stderr
+            if should_cancel is not None and should_cancel():
+                raise ConversionCancelled('转换已取消')
+            if deadline is not None and time.monotonic() > deadline:
+                raise ConversionTimeout(f'转换超过 {limits.timeout} 秒，已终止')
+    finally:
+        # 正常结束时只清理残留的子进程；超时、取消或出错时终止整个进程组
+        terminate_group(proc, graceful=not finished)
+        if not finished:
+            proc.communicate()
+
+def convert_pdf_to_epub(pdf_path, output_dir=None, limits=None, should_cancel=None, converter=None):
     """
     转换PDF到EPUB格式
     
     Args:
         pdf_path: PDF文件路径
         output_dir: 输出目录（可选）
+        limits: 转换的资源限制 ConversionLimits（可选）
+        should_cancel: 返回 True 时取消转换的函数（可选）
+        converter: get_converter() 返回的转换器信息（可选，默认每次查找Calibre）
     
     Returns:
         EPUB文件路径或None
+    
+    Raises:
+        ConversionCancelled: 转换被取消
     """
     pdf_path = Path(pdf_path)
     
@@ -78,7 +358,7 @@ def convert_pdf_to_epub(pdf_path, output_dir=None):
         return None
     
     # 查找Calibre
-    calibre_path = find_calibre()
+    calibre_path = converter['path'] if converter is not None else find_calibre()
     
     if not calibre_path:
         print("警告: Calibre未安装，无法转换PDF")
@@ -88,46 +368,40 @@ def convert_pdf_to_epub(pdf_path, output_dir=None):
     
     # 设置输出路径
     if output_dir:
-        output_dir = Path(output_dir)
-        output_dir.mkdir(parents=True, exist_ok=True)
-        epub_path = output_dir / f"{pdf_path.stem}.epub"
-    else:
-        epub_path = pdf_path.with_suffix('.epub')
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    epub_path = epub_output_path(pdf_path, output_dir)
     
     # 构建转换命令
-    cmd = [
-        calibre_path,
-        str(pdf_path),
-        str(epub_path),
-        "--enable-heuristics",  # 启用启发式处理
-        "--margin-top", "20",
-        "--margin-bottom", "20",
-        "--margin-left", "20",
-        "--margin-right", "20",
-        "--pretty-print",  # 美化输出
-        "--insert-blank-line",  # 段落间插入空行
-        "--language", "zh-CN",  # 设置语言为中文
-    ]
+    cmd = [calibre_path, str(pdf_path), str(epub_path)] + EPUB_OPTIONS
+    
+    # 删除之前的转换结果，避免转换失败时误把旧文件当作结果（也可能是转换缓存的硬链接，不能覆盖写入）
+    try:
+        os.remove(epub_path)
+    except FileNotFoundError:
+        pass
     
     print(f"开始转换: {pdf_path.name} -> {epub_path.name}")
     
     try:
         # 执行转换
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            errors='replace'
-        )
+        returncode, stderr = run_converter(cmd, limits, should_cancel)
         
-        if result.returncode == 0 and epub_path.exists():
+        if returncode == 0 and epub_path.exists():
             print(f"转换成功: {epub_path}")
             return str(epub_path)
+        elif returncode == -getattr(signal, 'SIGXCPU', 0) or returncode == -signal.SIGKILL:
+            print(f"转换失败: CPU时间超过限制或进程被终止（退出码 {returncode}）")
+            return None
         else:
-            print(f"转换失败: {result.stderr if result.stderr else '未知错误'}")
+            print(f"转换失败: {stderr if stderr else '未知错误'}")
             return None
-            
+    
+    except ConversionCancelled:
+        print(f"转换已取消: {pdf_path.name}")
+        raise
+    except ConversionTimeout as e:
+        print(f"转换失败: {e}")
+        return None
     except Exception as e:
         print(f"转换出错: {e}")
         return None
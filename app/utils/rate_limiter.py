@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发件账号的发送速率限制（令牌桶，SQLite 共享）
+
+163、QQ等邮箱短时间内发送过多邮件会被限流甚至锁定账号。每个发件账号有两个令牌桶：
+- messages: 每分钟邮件数，桶容量即每分钟上限，允许短暂的突发
+- bytes:    每小时发送字节数（按邮件编码后的大小计算）
+
+桶的状态保存在 SQLite 数据库中，所有 gunicorn 工作进程共用，取令牌在 BEGIN IMMEDIATE 事务中完成。
+令牌不足时不扣减，返回需要等待的秒数，由调用方推迟发送（队列任务推迟领取，同步请求等待）。
+"""
+import time
+import sqlite3
+import threading
+
+
+# 默认每个账号每分钟最多发送的邮件数
+MESSAGES_PER_MINUTE = 10
+
+# 默认每个账号每小时最多发送的字节数（编码后）
+BYTES_PER_HOUR = 1024 * 1024 * 1024
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (account, kind)
+);
+'''
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA busy_timeout = 30000')
+    with _init_lock:
+        if db_path not in _initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_SCHEMA)
+            _initialized.add(db_path)
+    return conn
+
+
+class RateLimits:
+    """发件账号的速率限制"""
+
+    def __init__(self, messages_per_minute=MESSAGES_PER_MINUTE, bytes_per_hour=BYTES_PER_HOUR):
+        self.messages_per_minute = messages_per_minute
+        self.bytes_per_hour = bytes_per_hour
+
+    def buckets(self):
+        """返回 [(桶名称, 容量, 每秒补充的令牌数)]，限制为0或None的桶不启用"""
+        buckets = []
+        if self.messages_per_minute:
+            buckets.append(('messages', float(self.messages_per_minute), self.messages_per_minute / 60.0))
+        if self.bytes_per_hour:
+            buckets.append(('bytes', float(self.bytes_per_hour), self.bytes_per_hour / 3600.0))
+        return buckets
+
+
+def reserve(db_path, account, messages, nbytes, limits=None):
+    """
+    为即将发送的邮件取令牌
+
+    Args:
+        db_path: 数据库文件
+        account: 发件账号
+        messages: 邮件封数
+        nbytes: 邮件总字节数
+        limits: RateLimits（默认使用模块默认值）
+
+    Returns:
+        float: 0 表示已取得令牌可以立即发送，否则为需要等待的秒数（未扣减令牌）
+    """
+    limits = limits or RateLimits()
+    need = {'messages': messages, 'bytes': nbytes}
+    account = account.lower()
+    now = time.time()
+
+    conn = _connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        levels = {}
+        wait = 0.0
+        for kind, capacity, rate in limits.buckets():
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_buckets WHERE account = ? AND kind = ?',
+                (account, kind)
+            ).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row['tokens'] + max(now - row['updated_at'], 0) * rate)
+            # 超过桶容量的请求（如单封大邮件）在桶满时放行
+            required = min(need[kind], capacity)
+            if tokens < required:
+                wait = max(wait, (required - tokens) / rate)
+            levels[kind] = tokens - need[kind]
+
+        if wait == 0:
+            conn.executemany(
+                'INSERT OR REPLACE INTO rate_buckets (account, kind, tokens, updated_at) VALUES (?, ?, ?, ?)',
+                [(account, kind, tokens, now) for kind, tokens in levels.items()]
+            )
+        conn.execute('COMMIT')
+        return wait
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMTP连接池
+
+按 (服务器, 端口, 账号) 保存已登录的SMTP连接，发送完成后放回池中，
+下一封邮件直接复用，省去TLS握手和AUTH的时间。
+
+- 取出空闲连接时先发送 RSET 检查连接是否可用并清除上次的事务状态
+- 空闲超过 IDLE_TIMEOUT 的连接直接关闭（服务器通常会断开长时间空闲的连接）
+- 复用的连接在发送中途发现已断开时，自动换新连接重试一次
+- 每个账号同时打开的连接数不超过 MAX_CONNECTIONS_PER_ACCOUNT，超出时等待
+- 所有连接共用一个 SSLContext，并保存每个服务器最近的TLS会话，新连接用会话票据恢复，省去完整握手
+- prewarm() 预先建立并登录连接（gunicorn 工作进程启动时调用）
+"""
+import ssl
+import time
+import atexit
+import smtplib
+import threading
+
+
+# 每个账号最多同时打开的连接数
+MAX_CONNECTIONS_PER_ACCOUNT = 2
+
+# 空闲连接保留时间（秒）
+IDLE_TIMEOUT = 60
+
+# 等待可用连接的最长时间（秒）
+ACQUIRE_TIMEOUT = 120
+
+# 连接/读写超时（秒）
+SOCKET_TIMEOUT = 60
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    建立TLS连接时自动带上同一服务器上次保存的会话（session ticket），服务器接受时只需简短握手
+
+    smtplib（wrap_socket）和 asyncio（wrap_bio）都通过 context 建立TLS连接，在这里统一处理
+    """
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = _tls_sessions.get(server_hostname)
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = _tls_sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, *args, server_hostname=server_hostname,
+                                session=session, **kwargs)
+
+
+_ssl_context = None
+_tls_sessions = {}      # 服务器 -> 最近的 ssl.SSLSession
+_tls_lock = threading.Lock()
+
+
+def get_ssl_context():
+    """进程内共享的 SSLContext（CA证书只加载一次，保存的TLS会话只能在同一个 context 中恢复）"""
+    global _ssl_context
+    with _tls_lock:
+        if _ssl_context is None:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            _ssl_context = context
+        return _ssl_context
+
+
+def remember_tls_session(smtp_server, ssl_object):
+    """
+    保存连接的TLS会话供下次连接恢复
+
+    TLS 1.3 的会话票据在握手之后才由服务器发送，需要在读取过服务器响应（如登录完成）后调用
+    """
+    session = getattr(ssl_object, 'session', None)
+    if isinstance(session, ssl.SSLSession):
+        _tls_sessions[smtp_server] = session
+
+
+def open_smtp_connection(smtp_server, smtp_port, timeout=SOCKET_TIMEOUT):
+    """建立SMTP连接（465端口使用SSL，其余端口使用STARTTLS）"""
+    if smtp_port == 465:
+        server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=timeout, context=get_ssl_context())
+    else:
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+        server.starttls(context=get_ssl_context())
+    return server
+
+
+def is_stale_error(error):
+    """判断异常是否表示连接已被服务器关闭（换新连接重试即可）"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def is_transient_error(error):
+    """
+    判断发送错误是否值得稍后重试
+
+    网络错误、连接断开和 4xx 临时性响应可以重试；认证失败和 5xx 永久性错误重试也不会成功
+    """
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+def close_quietly(server):
+    """关闭连接，忽略已断开等错误"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+class SMTPPool:
+    """进程内共享的SMTP连接池（线程安全）"""
+
+    def __init__(self, max_per_account=MAX_CONNECTIONS_PER_ACCOUNT, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_account = max_per_account
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = {}      # key -> [(连接, 放回时间)]
+        self._open = {}      # key -> 已打开的连接数（含使用中）
+
+    def _take_idle(self, key):
+        """取出一个空闲连接，超时的连接关闭后继续找；必须持有锁"""
+        idle = self._idle.get(key)
+        expired = []
+        server = None
+        while idle:
+            candidate, released_at = idle.pop()
+            if time.time() - released_at > self.idle_timeout:
+                expired.append(candidate)
+                continue
+            server = candidate
+            break
+        self._open[key] = self._open.get(key, 0) - len(expired)
+        return server, expired
+
+    def acquire(self, smtp_server, smtp_port, email, password, timeout=ACQUIRE_TIMEOUT):
+        """
+        取得一个已登录的连接
+
+        Returns:
+            tuple: (连接, 是否为复用的连接)
+        """
+        key = (smtp_server, smtp_port, email)
+        deadline = time.time() + timeout
+
+        while True:
+            with self._cond:
+                while True:
+                    server, expired = self._take_idle(key)
+                    if server is not None or self._open.get(key, 0) < self.max_per_account:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError(f'等待SMTP连接超时: {email}@{smtp_server}')
+                    self._cond.wait(remaining)
+                if server is None:
+                    # 先占用名额，再在锁外建立连接
+                    self._open[key] = self._open.get(key, 0) + 1
+
+            for stale in expired:
+                close_quietly(stale)
+
+            if server is None:
+                try:
+                    server = open_smtp_connection(smtp_server, smtp_port)
+                    server.login(email, password)
+                    remember_tls_session(smtp_server, server.sock)
+                except Exception:
+                    if server is not None:
+                        close_quietly(server)
+                    self._forget(key)
+                    raise
+                return server, False
+
+            # 复用前检查连接，同时清除上次事务的状态
+            try:
+                code, _ = server.rset()
+                if code == 250:
+                    return server, True
+            except Exception:
+                pass
+            close_quietly(server)
+            self._forget(key)
+
+    def release(self, smtp_server, smtp_port, email, server):
+        """发送成功后把连接放回池中"""
+        key = (smtp_server, smtp_port, email)
+        with self._cond:
+            self._idle.setdefault(key, []).append((server, time.time()))
+            self._cond.notify()
+
+    def discard(self, smtp_server, smtp_port, email, server):
+        """关闭出错的连接，不再放回池中"""
+        close_quietly(server)
+        self._forget((smtp_server, smtp_port, email))
+
+    def _forget(self, key):
+        with self._cond:
+            self._open[key] = max(self._open.get(key, 0) - 1, 0)
+            self._cond.notify()
+
+    def run(self, smtp_server, smtp_port, email, password, operation):
+        """
+        用池中的连接执行操作
+
+        Args:
+            operation: operation(server) 在连接上发送邮件，返回值原样返回
+
+        复用的连接已被服务器断开时，换新连接重试一次。
+        """
+        while True:
+            server, reused = self.acquire(smtp_server, smtp_port, email, password)
+            try:
+                result = operation(server)
+            except Exception as e:
+                self.discard(smtp_server, smtp_port, email, server)
+                if reused and is_stale_error(e):
+                    print(f"[SMTP-POOL] 复用的连接已断开，重新连接: {e}")
+                    continue
+                raise
+            self.release(smtp_server, smtp_port, email, server)
+            return result
+
+    def prewarm(self, smtp_server, smtp_port, email, password):
+        """预先建立并登录一个连接放入池中（同时保存TLS会话），之后的发送直接复用"""
+        server, _ = self.acquire(smtp_server, smtp_port, email, password)
+        self.release(smtp_server, smtp_port, email, server)
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+            for key, servers in idle.items():
+                self._open[key] = max(self._open.get(key, 0) - len(servers), 0)
+            self._cond.notify_all()
+        for servers in idle.values():
+            for server, _ in servers:
+                close_quietly(server)
+
+
+_pool = SMTPPool()
+atexit.register(_pool.close_all)
+
+
+def get_smtp_pool():
+    """返回进程内共享的连接池"""
+    return _pool
+
+
+def reset_smtp_pool():
+    """关闭所有空闲连接（测试或配置变更后使用）"""
+    _pool.close_all()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TXT转换工具 - 不依赖Calibre，直接把纯文本转换为EPUB
+
+按块（整行）流式处理，内存占用与文件大小无关：
+- 从文件开头分块检测编码（BOM、UTF-8，否则按 GB18030 即 GBK 的超集处理）
+- 按常见的中英文章节标题（第X章、Chapter X 等）分章，每章一个XHTML文件，
+  过长的章节再按大小拆分（不进入目录）
+- 每块文本整体转义、段落整体拼接后写入，避免逐行调用的开销
+- 各章边读边写入ZIP流，最后写入目录（nav.xhtml、toc.ncx）和 content.opf
+- 每处理一块检查一次 should_cancel，取消时抛出 ConversionCancelled 并删除未完成的文件
+
+用法与 convert_pdf_to_epub 相同：convert_txt_to_epub(txt_path, output_dir=None, should_cancel=None)
+返回EPUB路径或None。
+"""
+import os
+import re
+import uuid
+import codecs
+import zipfile
+from html import escape
+from pathlib import Path
+
+from app.utils.pdf_converter import epub_output_path, ConversionCancelled
+
+# 编码检测最多读取的字节数
+DETECT_BYTES = 256 * 1024
+
+# 单个XHTML文件的最大文本量（字节），超过后在段落边界拆分
+MAX_CHAPTER_BYTES = 256 * 1024
+
+# 每次从文件读取并处理的文本量（字符，按整行读取）
+READ_BLOCK_CHARS = 64 * 1024
+
+# 压缩级别：文本用最快的级别压缩率也只差几个百分点，速度快数倍
+COMPRESS_LEVEL = 1
+
+# 超过这个长度的行不可能是章节标题，不做匹配
+MAX_HEADING_LENGTH = 40
+
+_NUMBER_WORDS = (r'(?:(?:twenty|thirty|forty|fifty|sixty|seventy|eighty|ninety)-)?'
+                 r'(?:one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|thirteen|fourteen|'
+                 r'fifteen|sixteen|seventeen|eighteen|nineteen|twenty|thirty|forty|fifty|sixty|seventy|'
+                 r'eighty|ninety|hundred)')
+_NUMBER = rf'(?:[0-9]+|[ivxlc]+|{_NUMBER_WORDS})'
+
+# 章节标题：第X章/回/卷…、序章/楔子…、Chapter X、Part/Book X、Prologue…
+CHAPTER_PATTERN = re.compile(
+    r'^(?:'
+    r'第[0-9０-９零〇一二两三四五六七八九十百千万壹贰叁肆伍陆柒捌玖拾佰仟]+[章节回卷部集篇](?:\s.*|[：:·.、].*)?'
+    r'|(?:序章|序言|序|楔子|引子|前言|后记|尾声|终章|番外)(?:\s.*|[：:·.、].*)?'
+    rf'|chapter\s+{_NUMBER}(?:\s.*|[:.\-—].*)?'
+    rf'|(?:part|book)\s+{_NUMBER}(?:\s*[:.\-—].*)?'
+    r'|(?:prologue|epilogue|preface|introduction|afterword)(?:\s*[:.\-—].*)?'
+    r')$',
+    re.IGNORECASE
+)
+
+_CJK = re.compile('[一-鿿]')
+
+# XML中不允许出现的控制字符
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+_CSS = '''body { margin: 0 5%; line-height: 1.6; }
+h1 { font-size: 1.4em; text-align: center; margin: 1.5em 0 1em; }
+p { text-indent: 2em; margin: 0.3em 0; }
+'''
+
+
+def detect_encoding(txt_path, max_bytes=DETECT_BYTES):
+    """
+    检测文本文件的编码
+
+    先看BOM；否则把开头的 max_bytes 字节分块送入 UTF-8 增量解码器，
+    出现非法字节时判定为 GB18030（兼容 GBK/GB2312）。
+
+    Returns:
+        str: 编码名称
+    """
+    with open(txt_path, 'rb') as f:
+        head = f.read(4)
+        if head.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+            return 'utf-16'
+
+        f.seek(0)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        remaining = max_bytes
+        while remaining > 0:
+            chunk = f.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            try:
+                decoder.decode(chunk, final=False)
+            except UnicodeDecodeError:
+                return 'gb18030'
+    return 'utf-8'
+
+
+def is_chapter_heading(line):
+    """判断一行（已去除首尾空白）是否为章节标题"""
+    return 0 < len(line) <= MAX_HEADING_LENGTH and CHAPTER_PATTERN.match(line) is not None
+
+
+def _xhtml_head(title, language):
+    """XHTML文件头（title 为已转义的文本）"""
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<!DOCTYPE html>\n'
+            f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+            f'lang="{language}" xml:lang="{language}">\n'
+            f'<head><meta charset="UTF-8"/><title>{title}</title>'
+            f'<link rel="stylesheet" type="text/css" href="style.css"/></head>\n<body>\n')
+
+
+class _EpubWriter:
+    """把章节依次写入ZIP流，记录目录和书脊（标题和段落都是已转义的文本）"""
+
+    def __init__(self, archive, title, language):
+        self.archive = archive
+        self.title = escape(title)
+        self.language = language
+        self.items = []      # 书脊中的文件名
+        self.toc = []        # (文件名, 章节标题)
+        self._stream = None
+        self._size = 0
+        self._chapter_title = None
+
+    def start(self, heading=None):
+        """开始新的一章；heading 为 None 时是正文开头或过长章节的续篇"""
+        self.finish()
+        name = f'text{len(self.items) + 1:05d}.xhtml'
+        self.items.append(name)
+        if heading is not None:
+            self._chapter_title = heading
+            self.toc.append((name, heading))
+        self._stream = self.archive.open(f'OEBPS/{name}', 'w')
+        self._size = 0
+        self._write(_xhtml_head(heading or self._chapter_title or self.title, self.language))
+        if heading is not None:
+            self._write(f'<h1>{heading}</h1>\n')
+
+    def paragraphs(self, lines):
+        """写入一组段落，当前文件过大时先开始续篇"""
+        if not lines:
+            return
+        if self._stream is None or self._size > MAX_CHAPTER_BYTES:
+            self.start()
+        self._write('<p>' + '</p>\n<p>'.join(lines) + '</p>\n')
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self._size += len(data)
+        self._stream.write(data)
+
+    def finish(self):
+        if self._stream is not None:
+            self._write('</body>\n</html>\n')
+            self._stream.close()
+            self._stream = None
+
+
+def _write_package(archive, writer, book_id):
+    """写入 content.opf、nav.xhtml 和 toc.ncx"""
+    title = writer.title
+    toc = writer.toc or [(writer.items[0], writer.title)]
+
+    manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+                '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+                '<item id="css" href="style.css" media-type="text/css"/>']
+    manifest += [f'<item id="t{i}" href="{name}" media-type="application/xhtml+xml"/>'
+                 for i, name in enumerate(writer.items)]
+    spine = ''.join(f'<itemref idref="t{i}"/>' for i in range(len(writer.items)))
+    archive.writestr('OEBPS/content.opf', (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="book-id">urn:uuid:{book_id}</dc:identifier>'
+        f'<dc:title>{title}</dc:title><dc:language>{writer.language}</dc:language>'
+        '<meta property="dcterms:modified">2000-01-01T00:00:00Z</meta></metadata>\n'
+        f'<manifest>{"".join(manifest)}</manifest>\n'
+        f'<spine toc="ncx">{spine}</spine>\n'
+        '</package>\n'
+    ))
+
+    nav_items = ''.join(f'<li><a href="{name}">{heading}</a></li>\n' for name, heading in toc)
+    archive.writestr('OEBPS/nav.xhtml', (
+        _xhtml_head(writer.title, writer.language) +
+        f'<nav epub:type="toc" id="toc"><h1>目录</h1><ol>\n{nav_items}</ol></nav>\n</body>\n</html>\n'
+    ))
+
+    nav_points = ''.join(
+        f'<navPoint id="p{i}" playOrder="{i}"><navLabel><text>{heading}</text></navLabel>'
+        f'<content src="{name}"/></navPoint>\n'
+        for i, (name, heading) in enumerate(toc, 1)
+    )
+    archive.writestr('OEBPS/toc.ncx', (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'<head><meta name="dtb:uid" content="urn:uuid:{book_id}"/></head>\n'
+        f'<docTitle><text>{title}</text></docTitle>\n'
+        f'<navMap>\n{nav_points}</navMap>\n</ncx>\n'
+    ))
+
+
+def build_epub(txt_path, epub_path, title=None, encoding=None, should_cancel=None):
+    """
+    把TXT文件写成EPUB
+
+    Args:
+        txt_path: 文本文件
+        epub_path: 输出的EPUB文件（直接写入，调用方负责原子替换）
+        title: 书名（默认为文件名）
+        encoding: 文本编码（默认自动检测）
+        should_cancel: 无参数的函数，返回 True 时取消转换（每块检查一次）
+
+    Returns:
+        int: 章节数（目录项数）
+
+    Raises:
+        ConversionCancelled: 转换被取消
+    """
+    encoding = encoding or detect_encoding(txt_path)
+    title = title or Path(txt_path).stem
+
+    with open(txt_path, 'r', encoding=encoding, errors='replace') as source:
+        sample = source.read(4096)
+        language = 'zh-CN' if _CJK.search(sample) else 'en'
+        source.seek(0)
+
+        with zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+            # mimetype 必须是第一个文件且不压缩
+            archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            archive.writestr('META-INF/container.xml', _CONTAINER_XML)
+            archive.writestr('OEBPS/style.css', _CSS)
+
+            writer = _EpubWriter(archive, title, language)
+            try:
+                while True:
+                    if should_cancel is not None and should_cancel():
+                        raise ConversionCancelled('转换已取消')
+                    block = source.read(READ_BLOCK_CHARS)
+                    if not block:
+                        break
+                    block += source.readline()
+                    paragraphs = []
+                    block = _INVALID_XML_CHARS.sub('', block)
+                    for line in escape(block, quote=False).split('\n'):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        if is_chapter_heading(line):
+                            writer.paragraphs(paragraphs)
+                            paragraphs = []
+                            writer.start(line)
+                        else:
+                            paragraphs.append(line)
+                    writer.paragraphs(paragraphs)
+                if not writer.items:
+                    writer.start()
+            finally:
+                # 取消或出错时也要关闭正在写入的章节，否则ZIP无法关闭，原来的异常会被掩盖
+                writer.finish()
+
+            _write_package(archive, writer, uuid.uuid4())
+    return len(writer.toc)
+
+
+def convert_txt_to_epub(txt_path, output_dir=None, should_cancel=None):
+    """
+    转换TXT到EPUB格式
+
+    Args:
+        txt_path: TXT文件路径
+        output_dir: 输出目录（可选，默认与TXT同目录）
+        should_cancel: 无参数的函数，返回 True 时取消转换（可选）
+
+    Returns:
+        EPUB文件路径或None
+
+    Raises:
+        ConversionCancelled: 转换被取消
+    """
+    txt_path = Path(txt_path)
+
+    if not txt_path.exists():
+        print(f"错误: 文件不存在 - {txt_path}")
+        return None
+
+    if output_dir:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    epub_path = epub_output_path(txt_path, output_dir)
+
+    print(f"开始转换: {txt_path.name} -> {epub_path.name}")
+    temp_path = epub_path.with_name(f'.{epub_path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        chapters = build_epub(txt_path, temp_path, should_cancel=should_cancel)
+        os.replace(temp_path, epub_path)
+    except Exception as e:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        if isinstance(e, ConversionCancelled):
+            print(f"转换已取消: {txt_path.name}")
+            raise
+        print(f"转换出错: {e}")
+        return None
+
+    print(f"转换成功: {epub_path}（{chapters}章）")
+    return str(epub_path)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上传预检工具
+
+在读取请求体之前/刚开始读取时拒绝不合格的上传：
+- 按 Content-Length 检查是否超过可发送的大小
+- 按文件名检查扩展名
+- 按文件开头的魔数确认内容与扩展名一致
+"""
+from werkzeug.exceptions import HTTPException
+
+
+# 魔数检查需要的文件头长度（PDF 允许在前 1024 字节内出现文件头）
+SNIFF_SIZE = 1024
+
+# multipart 边界、其他表单字段等占用的空间
+MULTIPART_OVERHEAD = 64 * 1024
+
+_ZIP_MAGIC = b'PK\x03\x04'
+_OLE_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+_TEXT_BOMS = (b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff')
+
+
+class UploadRejected(HTTPException):
+    """上传在预检阶段被拒绝"""
+    code = 400
+    description = '不支持的文件格式'
+
+    def __init__(self, description=None, code=None):
+        super().__init__(description)
+        if code is not None:
+            self.code = code
+
+
+def get_extension(filename):
+    """返回小写扩展名（不含点），没有扩展名时返回空字符串"""
+    if not filename or '.' not in filename:
+        return ''
+    return filename.rsplit('.', 1)[1].lower()
+
+
+def check_magic(extension, head):
+    """
+    检查文件开头是否与扩展名对应的格式一致
+
+    Args:
+        extension: 小写扩展名
+        head: 文件开头的字节（最多 SNIFF_SIZE）
+
+    Returns:
+        bool: 是否一致（未知扩展名返回 True）
+    """
+    if extension == 'pdf':
+        return b'%PDF-' in head
+    if extension in ('epub', 'docx'):
+        return head.startswith(_ZIP_MAGIC)
+    if extension == 'mobi':
+        return head[60:68] in (b'BOOKMOBI', b'TEXtREAd')
+    if extension == 'doc':
+        return head.startswith(_OLE_MAGIC)
+    if extension == 'txt':
+        # 带BOM的UTF-16文本会含有NUL，其余文本文件不应出现NUL
+        return head.startswith(_TEXT_BOMS) or b'\x00' not in head
+    return True
+
+
+def magic_validator(filename):
+    """
+    返回文件头校验函数，供 SpooledUpload 在收到文件开头后调用
+
+    校验失败时抛出 UploadRejected（415），中止请求体的读取
+    """
+    extension = get_extension(filename)
+
+    def validate(head):
+        if not check_magic(extension, head):
+            raise UploadRejected(f'文件内容与扩展名 .{extension} 不符', code=415)
+
+    return validate
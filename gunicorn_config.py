@@ -35,4 +35,24 @@ preload_app = True
 # 限制请求头大小
 limit_request_line = 8190
 limit_request_fields = 100
-limit_request_field_size = 8190
\ No newline at end of file
+limit_request_field_size = 8190
+
+# 工作进程启动钩子
+def post_fork(server, worker):
+    """
+    工作进程启动后立即启动发送线程，继续处理部署或进程重启（max_requests）前队列中未完成的任务；
+    并预先建立发件账号的SMTP连接，减少重启后第一次发送的延迟
+    """
+    from main import start_delivery_workers, prewarm_smtp_connections
+    start_delivery_workers()
+    prewarm_smtp_connections()
+
+# 主进程加载应用后、启动工作进程前的钩子
+def when_ready(server):
+    """预加载时在主进程中查找Calibre（版本、支持的输入格式），工作进程直接继承结果，转换时不再查找"""
+    from app.utils.pdf_converter import get_converter
+    converter = get_converter()
+    if converter['ready']:
+        server.log.info(f"Calibre: {converter['path']} ({converter['version']})")
+    else:
+        server.log.warning("未找到Calibre，PDF转EPUB不可用")
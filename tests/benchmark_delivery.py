@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发送吞吐量测试
+
+在本机启动模拟SMTP服务器（tests/smtp_sink.py），按不同文件大小发送若干封邮件，输出：
+每秒邮件数、每秒MB数、单封耗时的 p50/p95/p99，以及发送进程的峰值内存（RSS）。
+
+每种文件大小在单独的子进程中发送（模拟服务器在父进程中运行），峰值内存只包含发送端。
+
+用法示例：
+    python tests/benchmark_delivery.py --sizes 1,10,45 --messages 20 --concurrency 4
+    python tests/benchmark_delivery.py --latency 0.05 --bandwidth 20 --fail-rate 0.1
+    python tests/benchmark_delivery.py --engine asyncio
+    python tests/benchmark_delivery.py --mode http     # 通过 /api/send-to-kindle 上传并发送
+
+这个文件不以 test_ 开头，不会被 pytest 收集。
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加项目根目录到系统路径
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.smtp_sink import FakeSMTPServer, plain_connections
+
+SENDER = 'bench@163.com'
+PASSWORD = 'secret'
+KINDLE = 'bench@kindle.com'
+
+
+def percentile(values, pct):
+    """按最近秩计算百分位数"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def make_file(directory, size):
+    """生成指定大小的随机内容PDF文件（以PDF文件头开头，通过上传内容校验）"""
+    path = os.path.join(directory, f'bench-{size}.pdf')
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        remaining = size - 9
+        while remaining > 0:
+            block = min(remaining, 1024 * 1024)
+            f.write(os.urandom(block))
+            remaining -= block
+    return path
+
+
+def direct_sender(engine, host, port):
+    """直接调用发送函数，发送失败时抛出异常"""
+    if engine == 'asyncio':
+        from app.utils.async_smtp import get_delivery_engine
+
+        def send(path):
+            error = get_delivery_engine().submit_send(KINDLE, SENDER, PASSWORD, [path], host, port).result()[0]
+            if error is not None:
+                raise error
+        return send
+
+    from app.utils.kindle_sender import send_to_kindle
+
+    def send(path):
+        send_to_kindle(KINDLE, SENDER, PASSWORD, path, smtp_server=host, smtp_port=port, raise_on_error=True)
+    return send
+
+
+def http_sender(host, port, work_dir):
+    """通过 Flask 测试客户端调用 /api/send-to-kindle（包含上传保存和发送）"""
+    import main
+    # 环境变量（包括 .env 中的）优先于配置文件，SMTP_SERVER/SMTP_PORT 未设置时也会使用默认值
+    os.environ.update({'KINDLE_EMAIL': KINDLE, 'SMTP_EMAIL': SENDER, 'SMTP_PASSWORD': PASSWORD,
+                       'SMTP_SERVER': host, 'SMTP_PORT': str(port)})
+    config_file = os.path.join(work_dir, 'config.json')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'kindle_email': KINDLE,
+            'smtp_email': SENDER,
+            'smtp_password': PASSWORD,
+            'smtp_server': host,
+            'smtp_port': str(port),
+            'smtp_messages_per_minute': 0,
+            'smtp_bytes_per_hour': 0,
+        }, f)
+    main.CONFIG_FILE = config_file
+    main.app.config['UPLOAD_FOLDER'] = os.path.join(work_dir, 'uploads')
+    os.makedirs(main.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    client = main.app.test_client()
+
+    def send(path):
+        with open(path, 'rb') as f:
+            response = client.post('/api/send-to-kindle', data={'file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f'HTTP {response.status_code}: {response.get_json()}')
+    return send
+
+
+def run_scenario(options):
+    """
+    在当前进程中发送 options['messages'] 封邮件
+
+    Returns:
+        dict: 发送结果统计
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = make_file(work_dir, options['size'])
+        with plain_connections():
+            if options['mode'] == 'http':
+                send = http_sender(options['host'], options['port'], work_dir)
+            else:
+                send = direct_sender(options['engine'], options['host'], options['port'])
+
+            def timed(_):
+                start = time.perf_counter()
+                try:
+                    send(path)
+                    return time.perf_counter() - start, None
+                except Exception as e:
+                    return time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+            # 发送函数会输出大量日志，统计时不需要
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(options['concurrency']) as executor:
+                    results = list(executor.map(timed, range(options['messages'])))
+                elapsed = time.perf_counter() - start
+
+    durations = [duration for duration, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    return {
+        'size': options['size'],
+        'messages': len(durations),
+        'failed': len(errors),
+        'errors': sorted(set(errors))[:5],
+        'seconds': elapsed,
+        'messages_per_second': len(durations) / elapsed if elapsed else 0.0,
+        'mb_per_second': len(durations) * options['size'] / 1024 / 1024 / elapsed if elapsed else 0.0,
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'p99': percentile(durations, 99),
+        # Linux 下 ru_maxrss 单位为KB
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_in_subprocess(options):
+    """在子进程中运行一种场景，返回统计结果"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(options)],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(sizes, messages=10, concurrency=1, latency=0, bandwidth=None, fail_rate=0,
+                  drop_rate=0, binary=False, engine='threads', mode='direct', seed=None):
+    """
+    启动模拟SMTP服务器，依次测试每种文件大小
+
+    Args:
+        sizes: 文件大小列表（字节）
+        bandwidth: 服务器接收速率上限（字节/秒），None 为不限制
+        其余参数见命令行说明
+
+    Returns:
+        list: 每种文件大小的统计结果
+    """
+    server = FakeSMTPServer(latency=latency, bandwidth=bandwidth, fail_rate=fail_rate,
+                            drop_rate=drop_rate, binary=binary, keep_messages=False, seed=seed)
+    try:
+        results = []
+        for size in sizes:
+            results.append(run_in_subprocess({
+                'host': server.host, 'port': server.port, 'size': size, 'messages': messages,
+                'concurrency': concurrency, 'engine': engine, 'mode': mode,
+            }))
+        return results
+    finally:
+        server.close()
+
+
+def format_report(results):
+    """结果表格"""
+    lines = [f"{'大小(MB)':>9} {'成功':>5} {'失败':>5} {'封/秒':>8} {'MB/秒':>8} "
+             f"{'p50(s)':>8} {'p95(s)':>8} {'p99(s)':>8} {'峰值RSS(MB)':>12}"]
+    for r in results:
+        lines.append(f"{r['size'] / 1024 / 1024:>9.1f} {r['messages']:>5} {r['failed']:>5} "
+                     f"{r['messages_per_second']:>8.2f} {r['mb_per_second']:>8.2f} "
+                     f"{r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f} {r['peak_rss_mb']:>12.1f}")
+        for error in r['errors']:
+            lines.append(f"          错误: {error}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='发送吞吐量测试（本机模拟SMTP服务器）')
+    parser.add_argument('--sizes', default='1,10,45', help='文件大小（MB），逗号分隔')
+    parser.add_argument('--messages', type=int, default=10, help='每种大小发送的邮件数')
+    parser.add_argument('--concurrency', type=int, default=1, help='同时发送数')
+    parser.add_argument('--latency', type=float, default=0, help='服务器每个响应的延迟（秒）')
+    parser.add_argument('--bandwidth', type=float, default=0, help='服务器接收速率上限（MB/秒，0为不限制）')
+    parser.add_argument('--fail-rate', type=float, default=0, help='邮件被拒收（4xx/5xx）的概率')
+    parser.add_argument('--drop-rate', type=float, default=0, help='发送中途断开连接的概率')
+    parser.add_argument('--binary', action='store_true', help='服务器支持 CHUNKING/BINARYMIME')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='SMTP发送方式')
+    parser.add_argument('--mode', choices=('direct', 'http'), default='direct',
+                        help='direct 直接调用发送函数，http 通过 /api/send-to-kindle')
+    parser.add_argument('--seed', type=int, help='错误注入的随机种子')
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_scenario(json.loads(args.worker))))
+        return
+
+    sizes = [int(float(size) * 1024 * 1024) for size in args.sizes.split(',') if size]
+    results = run_benchmark(
+        sizes, messages=args.messages, concurrency=args.concurrency, latency=args.latency,
+        bandwidth=args.bandwidth * 1024 * 1024 or None, fail_rate=args.fail_rate,
+        drop_rate=args.drop_rate, binary=args.binary, engine=args.engine, mode=args.mode, seed=args.seed
+    )
+    print(json.dumps(results, indent=2) if args.json else format_report(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内的模拟SMTP服务器（测试和性能测试用）
+
+在独立线程的 asyncio 事件循环中运行，不需要外部服务，也不使用TLS（发送端需用明文连接，见 plain_connections）：
+- EHLO（SIZE，可选 CHUNKING/BINARYMIME）、AUTH PLAIN/LOGIN、MAIL、RCPT、DATA、BDAT、RSET、NOOP、QUIT
+- latency：每个响应前的延迟（秒）
+- bandwidth：接收邮件内容的速率上限（字节/秒）
+- users：{账号: 密码}，为 None 时接受任意账号
+- fail_rate / fail_codes：按概率在邮件内容接收完后返回错误响应（如 451、552）
+- drop_rate：按概率在接收邮件内容的中途断开连接
+- keep_messages：为 False 时只统计字节数，不保存邮件内容（性能测试时避免占用内存）
+"""
+import base64
+import random
+import asyncio
+import smtplib
+import threading
+from contextlib import contextmanager
+from unittest.mock import patch
+
+# 每次从连接读取的字节数
+READ_SIZE = 64 * 1024
+
+
+class _Connection:
+    """带缓冲区的读取（邮件内容结束后剩余的字节留给下一条命令）"""
+
+    def __init__(self, reader, server):
+        self.reader = reader
+        self.server = server
+        self.buffer = b''
+
+    async def _fill(self):
+        chunk = await self.reader.read(READ_SIZE)
+        if not chunk:
+            raise ConnectionResetError('客户端断开连接')
+        await self.server._throttle(len(chunk))
+        self.buffer += chunk
+
+    async def readline(self):
+        while b'\r\n' not in self.buffer:
+            await self._fill()
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    async def readexactly(self, size, on_chunk):
+        """读取 size 字节，按块交给 on_chunk"""
+        while size > 0:
+            if not self.buffer:
+                await self._fill()
+            chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+            size -= len(chunk)
+            on_chunk(chunk)
+
+    async def read_data(self, on_chunk):
+        """读取 DATA 内容直到 <CRLF>.<CRLF>，按块交给 on_chunk（含最后的CRLF，不含结束行）"""
+        previous = b'\r\n'
+        while True:
+            end = (previous + self.buffer).find(b'\r\n.\r\n')
+            if end >= 0:
+                end -= len(previous)
+                if end >= 0:
+                    on_chunk(self.buffer[:end + 2])
+                self.buffer = self.buffer[end + 5:]
+                return
+            if len(self.buffer) > 4:
+                # 保留最后4个字节，结束标记可能跨两次读取
+                on_chunk(self.buffer[:-4])
+                previous, self.buffer = b'', self.buffer[-4:]
+            await self._fill()
+
+
+class FakeSMTPServer:
+    """在独立线程中运行的模拟SMTP服务器，记录收到的邮件"""
+
+    def __init__(self, latency=0, bandwidth=None, users=None, fail_rate=0, fail_codes=(451, 552),
+                 drop_rate=0, binary=False, keep_messages=True, seed=None, host='127.0.0.1'):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.users = users
+        self.fail_rate = fail_rate
+        self.fail_codes = fail_codes
+        self.drop_rate = drop_rate
+        self.binary = binary
+        self.keep_messages = keep_messages
+        self.close_after_message = False
+        self.random = random.Random(seed)
+
+        self.messages = []
+        self.message_count = 0
+        self.bytes_received = 0
+        self.injected_errors = 0
+        self.drops = 0
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-smtp', daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, host, 0), self.loop).result()
+        self.host = host
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _throttle(self, size):
+        if self.bandwidth:
+            await asyncio.sleep(size / self.bandwidth)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        conn = _Connection(reader, self)
+        user = None
+        chunks = []
+
+        async def reply(text):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            writer.write(text.encode('ascii') + b'\r\n')
+            await writer.drain()
+
+        def collect(chunk):
+            self.bytes_received += len(chunk)
+            if self.keep_messages:
+                chunks.append(chunk)
+
+        async def finish_message():
+            """邮件内容接收完：按概率注入错误，否则记录邮件"""
+            data = b''.join(chunks)
+            chunks.clear()
+            if self.fail_rate and self.random.random() < self.fail_rate:
+                self.injected_errors += 1
+                code = self.random.choice(self.fail_codes)
+                await reply(f'{code} injected failure')
+                return
+            self.message_count += 1
+            if self.keep_messages:
+                self.messages.append((user, data))
+            await reply('250 queued')
+
+        def should_drop():
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.drops += 1
+                return True
+            return False
+
+        try:
+            await reply('220 fake ESMTP')
+            while True:
+                command = (await conn.readline()).decode('utf-8')
+                verb = command.split(' ')[0].upper()
+                if verb in ('EHLO', 'HELO'):
+                    lines = ['250-fake', '250-SIZE 52428800']
+                    if self.binary:
+                        lines += ['250-CHUNKING', '250-BINARYMIME']
+                    lines.append('250 AUTH PLAIN LOGIN')
+                    await reply('\r\n'.join(lines))
+                elif verb == 'AUTH':
+                    user = await self._authenticate(command, conn, reply)
+                elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                    chunks.clear()
+                    await reply('250 ok')
+                elif verb == 'DATA':
+                    await reply('354 go ahead')
+                    if should_drop():
+                        break
+                    await conn.read_data(collect)
+                    if self.keep_messages and chunks:
+                        # 去掉点填充
+                        data = b''.join(chunks)
+                        data = data[1:] if data.startswith(b'..') else data
+                        chunks[:] = [data.replace(b'\r\n..', b'\r\n.')]
+                    await finish_message()
+                    if self.close_after_message:
+                        break
+                elif verb == 'BDAT':
+                    size = int(command.split(' ')[1])
+                    if size and should_drop():
+                        break
+                    await conn.readexactly(size, collect)
+                    if command.upper().endswith(' LAST'):
+                        await finish_message()
+                        if self.close_after_message:
+                            break
+                    else:
+                        await reply('250 ok')
+                elif verb == 'QUIT':
+                    await reply('221 bye')
+                    break
+                else:
+                    await reply('502 unknown')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def _authenticate(self, command, conn, reply):
+        """AUTH PLAIN（含初始响应）或 AUTH LOGIN，返回登录的账号，失败时返回 None"""
+        parts = command.split(' ')
+        if parts[1].upper() == 'PLAIN':
+            token = parts[2] if len(parts) > 2 else None
+            if token is None:
+                await reply('334 ')
+                token = (await conn.readline()).decode('ascii')
+            _, user, password = base64.b64decode(token).decode('utf-8').split('\0')
+        else:
+            await reply('334 VXNlcm5hbWU6')
+            user = base64.b64decode(await conn.readline()).decode('utf-8')
+            await reply('334 UGFzc3dvcmQ6')
+            password = base64.b64decode(await conn.readline()).decode('utf-8')
+
+        if self.users is not None and self.users.get(user) != password:
+            await reply('535 authentication failed')
+            return None
+        await reply('235 ok')
+        return user
+
+    def close(self):
+        """停止监听并断开所有连接，然后停止事件循环、等待线程退出"""
+        if self.loop.is_closed():
+            return
+
+        async def shutdown():
+            self.server.close()
+            # 取消仍在处理的连接，避免循环停止后残留的任务在其他测试中被唤醒
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+@contextmanager
+def plain_connections():
+    """让 smtplib 连接池和 asyncio 引擎都使用明文连接（模拟服务器不支持TLS）"""
+    def open_plain(smtp_server, smtp_port, timeout=60):
+        return smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+
+    with patch('app.utils.smtp_pool.open_smtp_connection', side_effect=open_plain), \
+            patch('app.utils.async_smtp.tls_mode', return_value=None):
+        yield
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多发件账号选择测试文件
+"""
+import unittest
+import os
+import sys
+import smtplib
+import tempfile
+import shutil
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.rate_limiter import RateLimits
+from app.utils.account_pool import (
+    classify_error,
+    choose_account,
+    get_health,
+    sending,
+    record_success,
+    record_failure,
+    THROTTLE_COOLDOWN
+)
+
+
+def make_account(email, messages_per_minute=10):
+    """测试用的发件账号"""
+    return {
+        'smtp_email': email,
+        'smtp_password': 'secret',
+        'smtp_server': 'smtp.163.com',
+        'smtp_port': 465,
+        'limits': RateLimits(messages_per_minute=messages_per_minute, bytes_per_hour=0)
+    }
+
+
+class TestAccountPool(unittest.TestCase):
+    """测试账号的健康状态、负载均衡和故障切换"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, 'ratelimit.db')
+        self.a = make_account('a@163.com')
+        self.b = make_account('b@qq.com')
+
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _choose(self, accounts=None, exclude=()):
+        return choose_account(self.db_path, accounts or [self.a, self.b], 1, 1000, exclude)
+
+    def test_classify_error(self):
+        """测试区分账号引起的错误"""
+        self.assertEqual(classify_error(smtplib.SMTPAuthenticationError(535, b'auth failed')), 'auth')
+        self.assertEqual(classify_error(smtplib.SMTPSenderRefused(451, b'rate limited', 'a@163.com')), 'throttle')
+        self.assertEqual(classify_error(smtplib.SMTPDataError(421, b'too many')), 'throttle')
+        self.assertIsNone(classify_error(smtplib.SMTPDataError(552, b'too large')))
+        self.assertIsNone(classify_error(smtplib.SMTPRecipientsRefused({'k@kindle.com': (450, b'busy')})))
+        self.assertIsNone(classify_error(ConnectionResetError()))
+
+    def test_least_loaded(self):
+        """测试优先选择正在发送数量少、平均延迟低的账号"""
+        with sending(self.a):
+            self.assertIs(self._choose()[0], self.b)
+        self.assertIs(self._choose()[0], self.a)
+
+        record_success(self.db_path, self.a, 5.0)
+        record_success(self.db_path, self.b, 1.0)
+        self.assertIs(self._choose()[0], self.b)
+
+    def test_quota_spills_over(self):
+        """测试账号配额用完后使用其他账号，全部用完时返回等待时间"""
+        a = make_account('a@163.com', messages_per_minute=1)
+        b = make_account('b@qq.com', messages_per_minute=1)
+        self.assertIs(self._choose([a, b])[0], a)
+        self.assertIs(self._choose([a, b])[0], b)
+
+        account, wait = self._choose([a, b])
+        self.assertIsNone(account)
+        self.assertAlmostEqual(wait, 60, delta=1)
+
+    def test_throttle_cooldown(self):
+        """测试被限流的账号进入冷却，冷却时间随连续失败翻倍"""
+        error = smtplib.SMTPSenderRefused(450, b'too frequent', 'a@163.com')
+        self.assertEqual(record_failure(self.db_path, self.a, error), 'throttle')
+        self.assertIs(self._choose()[0], self.b)
+
+        # 只剩冷却中的账号时返回剩余冷却时间
+        account, wait = self._choose(exclude={'b@qq.com'})
+        self.assertIsNone(account)
+        self.assertAlmostEqual(wait, THROTTLE_COOLDOWN, delta=1)
+
+        record_failure(self.db_path, self.a, error)
+        state = get_health(self.db_path, [self.a])['a@163.com']
+        self.assertEqual(state['failures'], 2)
+        self.assertEqual(state['last_error'], str(error))
+
+        with patch('app.utils.account_pool.time.time', return_value=state['cooldown_until'] - 1):
+            self.assertIsNone(self._choose(exclude={'b@qq.com'})[0])
+        with patch('app.utils.account_pool.time.time', return_value=state['cooldown_until'] + 1):
+            self.assertIs(self._choose(exclude={'b@qq.com'})[0], self.a)
+
+    def test_auth_failure_deprioritized(self):
+        """测试认证失败的账号排到最后，没有其他账号时仍可使用，发送成功后恢复"""
+        record_failure(self.db_path, self.a, smtplib.SMTPAuthenticationError(535, b'auth failed'))
+        self.assertIs(self._choose()[0], self.b)
+        self.assertIs(self._choose(exclude={'b@qq.com'})[0], self.a)
+
+        record_success(self.db_path, self.a, 1.0)
+        state = get_health(self.db_path, [self.a])['a@163.com']
+        self.assertEqual(state['auth_failed'], 0)
+        self.assertEqual(state['failures'], 0)
+
+    def test_unrelated_error_not_recorded(self):
+        """测试与账号无关的错误不影响健康状态"""
+        self.assertIsNone(record_failure(self.db_path, self.a, smtplib.SMTPDataError(552, b'too large')))
+        self.assertEqual(get_health(self.db_path, [self.a]), {})
+
+    def test_latency_average(self):
+        """测试延迟按指数移动平均更新"""
+        record_success(self.db_path, self.a, 2.0)
+        record_success(self.db_path, self.a, 12.0)
+        state = get_health(self.db_path, [self.a])['a@163.com']
+        self.assertAlmostEqual(state['latency'], 5.0)
+        self.assertEqual(state['sends'], 2)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
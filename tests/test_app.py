@@ -8,13 +8,19 @@ import json
 import os
 import tempfile
 import shutil
+import time
+import threading
+import zipfile
+from io import BytesIO
 from pathlib import Path
 import sys
 
 # 添加项目根目录到系统路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import app, load_config, save_config, allowed_file
+# app/ 包与 app.py 同名，和 wsgi.py 一样通过 main 导入应用
+from main import app, load_config, save_config, allowed_file, run_conversion
+from app.utils.convert_pool import get_convert_pool, CONVERT_QUEUE_SIZE
 from unittest.mock import patch, MagicMock
 
 
@@ -48,16 +54,26 @@ class TestKindleTransferApp(unittest.TestCase):
             json.dump(self.test_config, f)
         
         # 补丁配置文件路径
-        self.config_patcher = patch('app.CONFIG_FILE', self.config_file)
+        self.config_patcher = patch('main.CONFIG_FILE', self.config_file)
         self.config_patcher.start()
+        
+        # 不使用本机 .env 中的发送配置（环境变量优先于配置文件）
+        self.env_patcher = patch.dict(os.environ)
+        self.env_patcher.start()
+        for key in ('KINDLE_EMAIL', 'SMTP_EMAIL', 'SMTP_PASSWORD', 'SMTP_SERVER', 'SMTP_PORT'):
+            os.environ.pop(key, None)
     
     def tearDown(self):
         """测试后的清理"""
         self.config_patcher.stop()
+        self.env_patcher.stop()
         
-        # 清理临时目录
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
+        # 清理临时目录（后台发送线程可能正在轮询队列数据库，删除期间会新建 -wal/-shm 文件，重试几次）
+        for _ in range(5):
+            shutil.rmtree(self.test_dir, ignore_errors=True)
+            if not os.path.exists(self.test_dir):
+                break
+            time.sleep(0.1)
     
     def test_index_route(self):
         """测试主页路由"""
@@ -159,7 +175,7 @@ class TestKindleTransferApp(unittest.TestCase):
     
     def test_upload_invalid_extension(self):
         """测试上传文件 - 无效扩展名"""
-        data = {'file': (b'test content', 'test.exe')}
+        data = {'file': (BytesIO(b'test content'), 'test.exe')}
         response = self.client.post('/api/upload',
                                    data=data,
                                    content_type='multipart/form-data')
@@ -172,8 +188,8 @@ class TestKindleTransferApp(unittest.TestCase):
     def test_upload_valid_file(self):
         """测试上传文件 - 有效文件"""
         # 创建测试文件内容
-        test_content = b'This is a test PDF content'
-        data = {'file': (test_content, 'test.pdf')}
+        test_content = b'%PDF-1.4\nThis is a test PDF content'
+        data = {'file': (BytesIO(test_content), 'test.pdf')}
         
         response = self.client.post('/api/upload',
                                    data=data,
@@ -186,8 +202,8 @@ class TestKindleTransferApp(unittest.TestCase):
         self.assertEqual(result['message'], '文件上传成功')
         self.assertEqual(result['file']['name'], 'test.pdf')
         
-        # 验证文件已保存
-        saved_files = os.listdir(self.upload_dir)
+        # 验证文件已保存（忽略 .store 等内部目录）
+        saved_files = [f for f in os.listdir(self.upload_dir) if not f.startswith('.')]
         self.assertEqual(len(saved_files), 1)
         self.assertIn('test.pdf', saved_files[0])
     
@@ -231,6 +247,93 @@ class TestKindleTransferApp(unittest.TestCase):
         self.assertEqual(data['converted_path'], test_txt)
         self.assertEqual(data['format'], 'TXT')
     
+    @patch('main.convert_pdf_to_epub')
+    def test_convert_queue_full(self, mock_convert):
+        """测试转换排队已满时返回503，并可查询转换池状态"""
+        test_pdf = os.path.join(self.upload_dir, 'test.pdf')
+        with open(test_pdf, 'wb') as f:
+            f.write(b'PDF content')
+
+        release = threading.Event()
+        started = threading.Event()
+        
+        def hold(path, **kwargs):
+            started.set()
+            return release.wait(5) and path
+        
+        mock_convert.side_effect = hold
+        self.app.config['CONVERT_PDF_TO_EPUB'] = True
+        self.app.config['CONVERT_WORKERS'] = 1
+        self.app.config['CONVERT_QUEUE_SIZE'] = 0
+        # 占用唯一的转换槽位
+        self.client.get('/api/convert/status')
+        running = get_convert_pool().submit(mock_convert, test_pdf)
+        try:
+            # 等占用槽位的转换真正开始后再提交，否则它可能还在排队
+            self.assertTrue(started.wait(5))
+            response = self.client.post('/api/convert',
+                                       data=json.dumps({'filepath': test_pdf}),
+                                       content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], str(self.app.config['CONVERT_RETRY_DELAY']))
+            self.assertFalse(json.loads(response.data)['success'])
+
+            status = json.loads(self.client.get('/api/convert/status').data)
+            self.assertEqual((status['workers'], status['running'], status['queued']), (1, 1, 0))
+            self.assertIn('converter_ready', status)
+            self.assertIn('input_formats', status['converter'])
+        finally:
+            release.set()
+            running.result(5)
+            self.app.config['CONVERT_PDF_TO_EPUB'] = False
+            self.app.config['CONVERT_WORKERS'] = 0
+            self.app.config['CONVERT_QUEUE_SIZE'] = CONVERT_QUEUE_SIZE
+
+    @patch('main.get_converter')
+    @patch('main.convert_pdf_to_epub')
+    def test_conversion_cached(self, mock_convert, mock_converter):
+        """测试同一内容同时转换只运行一次，之后再转换直接使用缓存"""
+        def convert(path, **kwargs):
+            time.sleep(0.2)
+            epub_path = os.path.splitext(path)[0] + '.epub'
+            with open(epub_path, 'wb') as f:
+                f.write(b'EPUB content')
+            return epub_path
+        mock_convert.side_effect = convert
+        converter = {'ready': True, 'path': '/usr/bin/ebook-convert', 'version': 'ebook-convert (calibre 7.0.0)',
+                     'input_formats': ['pdf', 'txt'], 'probed_at': time.time()}
+        mock_converter.return_value = converter
+
+        paths = []
+        for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+            paths.append(os.path.join(self.upload_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'%PDF-1.4 same book')
+        self.client.get('/api/convert/status')
+
+        results = {}
+        threads = [threading.Thread(target=lambda p=p: results.update({p: run_conversion(p)}))
+                   for p in paths[:2]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(mock_convert.call_count, 1)
+        self.assertEqual(mock_convert.call_args[1]['limits'].timeout, self.app.config['CONVERT_TIMEOUT'])
+
+        # 不同文件名、相同内容：直接取缓存，结果放在该文件旁边
+        epub_path = run_conversion(paths[2])
+        self.assertEqual(mock_convert.call_count, 1)
+        self.assertEqual(epub_path, os.path.join(self.upload_dir, 'c.epub'))
+        for path in list(results.values()) + [epub_path]:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'EPUB content')
+
+        # 转换器版本变化时重新转换
+        mock_converter.return_value = dict(converter, version='ebook-convert (calibre 7.1.0)')
+        run_conversion(paths[2])
+        self.assertEqual(mock_convert.call_count, 2)
+
     def test_convert_file_not_exists(self):
         """测试转换不存在的文件"""
         response = self.client.post('/api/convert',
@@ -243,7 +346,7 @@ class TestKindleTransferApp(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], '文件不存在')
     
-    @patch('app.send_to_kindle')
+    @patch('main.send_to_kindle')
     def test_send_to_kindle_api(self, mock_send):
         """测试发送到Kindle"""
         # 创建测试文件
@@ -274,6 +377,125 @@ class TestKindleTransferApp(unittest.TestCase):
             smtp_port=465
         )
     
+    @patch('main.send_to_kindle')
+    def test_send_rate_limited(self, mock_send):
+        """测试发件账号达到速率限制时返回429和Retry-After"""
+        test_file = os.path.join(self.upload_dir, 'test.epub')
+        with open(test_file, 'wb') as f:
+            f.write(b'EPUB content')
+        mock_send.return_value = True
+        
+        with patch.dict(self.app.config, {'SMTP_MESSAGES_PER_MINUTE': 1, 'SEND_RATE_MAX_WAIT': 0}):
+            responses = [self.client.post('/api/send',
+                                          data=json.dumps({'filepath': test_file}),
+                                          content_type='application/json')
+                         for _ in range(2)]
+        
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[1].status_code, 429)
+        self.assertGreater(int(responses[1].headers['Retry-After']), 0)
+        self.assertEqual(mock_send.call_count, 1)
+        
+        # 一键处理（同步）同样返回429
+        from io import BytesIO
+        with patch.dict(self.app.config, {'SMTP_MESSAGES_PER_MINUTE': 1, 'SEND_RATE_MAX_WAIT': 0}):
+            response = self.client.post('/api/process',
+                                       data={'file': (BytesIO(b'plain text'), 'note.txt')},
+                                       content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(mock_send.call_count, 1)
+    
+    @patch('main.send_to_kindle')
+    def test_multi_account_failover(self, mock_send):
+        """测试多个发件账号：认证失败的账号自动换用其他账号，配置接口隐藏各账号密码"""
+        import smtplib
+        from io import BytesIO
+        config = load_config()
+        config['smtp_accounts'] = [
+            {'smtp_email': 'first@163.com', 'smtp_password': 'pass1'},
+            {'smtp_email': 'second@qq.com', 'smtp_password': 'pass2',
+             'smtp_server': 'smtp.qq.com', 'smtp_port': '587'}
+        ]
+        save_config(config)
+        
+        def fake_send(**kwargs):
+            if kwargs['sender_email'] == 'first@163.com':
+                raise smtplib.SMTPAuthenticationError(535, b'auth failed')
+            return True
+        mock_send.side_effect = fake_send
+        
+        response = self.client.post('/api/process',
+                                   data={'file': (BytesIO(b'plain text'), 'book.txt')},
+                                   content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        senders = [c[1]['sender_email'] for c in mock_send.call_args_list]
+        self.assertEqual(senders, ['first@163.com', 'second@qq.com'])
+        self.assertEqual(mock_send.call_args[1]['smtp_server'], 'smtp.qq.com')
+        self.assertEqual(mock_send.call_args[1]['smtp_port'], 587)
+        
+        accounts = {a['smtp_email']: a for a in json.loads(self.client.get('/api/accounts').data)['accounts']}
+        self.assertTrue(accounts['first@163.com']['auth_failed'])
+        self.assertTrue(accounts['second@qq.com']['healthy'])
+        self.assertEqual(accounts['second@qq.com']['sends'], 1)
+        
+        # 认证失败的账号排到最后
+        mock_send.reset_mock()
+        self.client.post('/api/process',
+                         data={'file': (BytesIO(b'plain text 2'), 'book2.txt')},
+                         content_type='multipart/form-data')
+        self.assertEqual(mock_send.call_args_list[0][1]['sender_email'], 'second@qq.com')
+        
+        # 密码不返回给前端，保存网页表单时保留多账号配置
+        data = json.loads(self.client.get('/api/config').data)
+        self.assertEqual([a['smtp_password'] for a in data['smtp_accounts']], ['*' * 8, '*' * 8])
+        form = {key: data[key] for key in ('kindle_email', 'smtp_email', 'smtp_password')}
+        self.client.post('/api/config', data=json.dumps(form), content_type='application/json')
+        self.assertEqual([a['smtp_password'] for a in load_config()['smtp_accounts']], ['pass1', 'pass2'])
+    
+    @patch('main.get_smtp_pool')
+    def test_prewarm_smtp_connections(self, mock_pool):
+        """测试工作进程启动时为每个发件账号预先建立连接，失败的账号不影响其他账号"""
+        import threading
+        from main import prewarm_smtp_connections
+        config = load_config()
+        config['smtp_accounts'] = [
+            {'smtp_email': 'first@163.com', 'smtp_password': 'pass1'},
+            {'smtp_email': 'second@qq.com', 'smtp_password': 'pass2', 'smtp_server': 'smtp.qq.com'}
+        ]
+        save_config(config)
+        mock_pool.return_value.prewarm.side_effect = [OSError('unreachable'), None]
+        
+        prewarm_smtp_connections()
+        for thread in threading.enumerate():
+            if thread.name == 'smtp-prewarm':
+                thread.join(5)
+        
+        calls = [c[0] for c in mock_pool.return_value.prewarm.call_args_list]
+        self.assertEqual(calls, [('smtp.163.com', 465, 'first@163.com', 'pass1'),
+                                 ('smtp.qq.com', 465, 'second@qq.com', 'pass2')])
+    
+    @patch('main.send_to_kindle')
+    @patch('main.get_delivery_engine')
+    def test_asyncio_engine(self, mock_engine, mock_send):
+        """测试SMTP_ENGINE=asyncio时发送提交给事件循环引擎"""
+        from io import BytesIO
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result([None])
+        mock_engine.return_value.submit_send.return_value = future
+        
+        with patch.dict(self.app.config, {'SMTP_ENGINE': 'asyncio'}):
+            response = self.client.post('/api/process',
+                                       data={'file': (BytesIO(b'plain text'), 'book.txt')},
+                                       content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 200)
+        mock_send.assert_not_called()
+        args = mock_engine.return_value.submit_send.call_args[0]
+        self.assertEqual(args[:3], ('test@kindle.com', 'test@163.com', 'testpass123'))
+        self.assertTrue(args[3][0].endswith('book.txt'))
+    
     def test_send_no_kindle_email(self):
         """测试发送到Kindle - 没有配置Kindle邮箱"""
         # 清空Kindle邮箱配置
@@ -316,8 +538,8 @@ class TestKindleTransferApp(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], '请先配置发送邮箱')
     
-    @patch('app.send_to_kindle')
-    @patch('app.convert_pdf_to_epub')
+    @patch('main.send_to_kindle')
+    @patch('main.convert_pdf_to_epub')
     def test_process_file(self, mock_convert, mock_send):
         """测试一键处理功能"""
         # 模拟转换和发送成功
@@ -330,12 +552,13 @@ class TestKindleTransferApp(unittest.TestCase):
             f.write(b'EPUB content')
         
         # 上传PDF文件
-        test_content = b'This is a test PDF content'
-        data = {'file': (test_content, 'test.pdf')}
+        test_content = b'%PDF-1.4\nThis is a test PDF content'
+        data = {'file': (BytesIO(test_content), 'test.pdf')}
         
-        response = self.client.post('/api/process',
-                                   data=data,
-                                   content_type='multipart/form-data')
+        with patch.dict(self.app.config, {'CONVERT_PDF_TO_EPUB': True}):
+            response = self.client.post('/api/process',
+                                       data=data,
+                                       content_type='multipart/form-data')
         
         self.assertEqual(response.status_code, 200)
         
@@ -346,11 +569,33 @@ class TestKindleTransferApp(unittest.TestCase):
         self.assertTrue(result['details']['converted'])
         self.assertEqual(result['details']['sent_to'], 'test@kindle.com')
     
+    @patch('main.send_to_kindle')
+    @patch('main.convert_pdf_to_epub')
+    def test_process_txt_converted(self, mock_convert, mock_send):
+        """测试开启TXT转换时用内置转换器转换为EPUB后发送，不经过Calibre"""
+        from io import BytesIO
+        mock_send.return_value = True
+        content = '第一章 开始\n　　正文\n'.encode('gbk')
+        
+        with patch.dict(self.app.config, {'CONVERT_TXT_TO_EPUB': True}):
+            response = self.client.post('/api/process',
+                                       data={'file': (BytesIO(content), 'novel.txt')},
+                                       content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertTrue(result['details']['converted'])
+        sent_path = mock_send.call_args[1]['file_path']
+        self.assertTrue(sent_path.endswith('.epub'))
+        with zipfile.ZipFile(sent_path) as archive:
+            self.assertIn('第一章 开始', archive.read('OEBPS/nav.xhtml').decode('utf-8'))
+        mock_convert.assert_not_called()
+    
     def test_get_history(self):
         """测试获取历史记录"""
         # 创建几个测试文件
         test_files = ['book1.pdf', 'book2.epub', 'book3.mobi']
-        for filename in test_files:
+        for filename in test_files + ['.delivery.db', '.delivery.db-wal']:
             filepath = os.path.join(self.upload_dir, filename)
             with open(filepath, 'w') as f:
                 f.write('test content')
@@ -372,7 +617,625 @@ class TestKindleTransferApp(unittest.TestCase):
             self.assertIn('name', item)
             self.assertIn('size', item)
             self.assertIn('time', item)
-
+    
+    @patch('main.send_to_kindle')
+    def test_chunked_upload_resume(self, mock_send):
+        """测试分块上传：乱序上传、查询进度、完成后发送"""
+        mock_send.return_value = True
+        content = b'%PDF-1.4\n' + b'x' * (600 * 1024)
+        chunk_size = 256 * 1024
+        
+        response = self.client.post('/api/uploads',
+                                   data=json.dumps({'filename': 'big.pdf',
+                                                    'size': len(content),
+                                                    'chunk_size': chunk_size}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        session = json.loads(response.data)
+        upload_id = session['upload_id']
+        self.assertEqual(session['total_chunks'], 3)
+        
+        # 先上传最后一块，模拟中断
+        response = self.client.put(f'/api/uploads/{upload_id}/chunks/2',
+                                  data=content[2 * chunk_size:])
+        self.assertEqual(response.status_code, 200)
+        
+        # 未上传完时不能完成
+        response = self.client.post(f'/api/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 400)
+        
+        # 查询进度，只上传缺失的分块
+        status = json.loads(self.client.get(f'/api/uploads/{upload_id}').data)
+        self.assertEqual(status['received_chunks'], [2])
+        for index in range(3):
+            if index not in status['received_chunks']:
+                self.client.put(f'/api/uploads/{upload_id}/chunks/{index}',
+                                data=content[index * chunk_size:(index + 1) * chunk_size])
+        
+        response = self.client.post(f'/api/uploads/{upload_id}/complete',
+                                   data=json.dumps({'process': True}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['details']['original_file'], 'big.pdf')
+        
+        # 组装后的文件内容应与原文件一致
+        sent_path = mock_send.call_args[1]['file_path']
+        with open(sent_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        
+        # 重复提交完成请求返回之前的结果，不再发送
+        response = self.client.post(f'/api/uploads/{upload_id}/complete',
+                                   data=json.dumps({'process': True}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertTrue(result['already_finalized'])
+        self.assertEqual(result['file']['path'], sent_path)
+        self.assertEqual(mock_send.call_count, 1)
+    
+    def test_chunked_upload_concurrent_complete(self):
+        """测试并发提交完成请求时只组装一次，都返回同一个文件"""
+        content = b'%PDF-1.4\n' + b'x' * 1000
+        upload_id = json.loads(self.client.post('/api/uploads',
+                                                data=json.dumps({'filename': 'a.pdf', 'size': len(content)}),
+                                                content_type='application/json').data)['upload_id']
+        self.client.put(f'/api/uploads/{upload_id}/chunks/0', data=content)
+        
+        responses = []
+        
+        def complete():
+            responses.append(self.app.test_client().post(f'/api/uploads/{upload_id}/complete'))
+        
+        threads = [threading.Thread(target=complete) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+        results = [json.loads(response.data) for response in responses]
+        self.assertEqual(len({result['file']['path'] for result in results}), 1)
+        self.assertEqual(sum(not result['already_finalized'] for result in results), 1)
+    
+    def test_chunked_upload_invalid_size(self):
+        """测试文件大小或分块大小不是数字时返回400"""
+        for fields in ({'size': 'abc'}, {'size': [1]}, {'size': 1000, 'chunk_size': 'big'}):
+            response = self.client.post('/api/uploads',
+                                       data=json.dumps({'filename': 'a.pdf', **fields}),
+                                       content_type='application/json')
+            self.assertEqual(response.status_code, 400, fields)
+    
+    def test_chunked_upload_wrong_chunk_size(self):
+        """测试分块长度不正确"""
+        response = self.client.post('/api/uploads',
+                                   data=json.dumps({'filename': 'a.pdf',
+                                                    'size': 1000,
+                                                    'chunk_size': 256 * 1024}),
+                                   content_type='application/json')
+        upload_id = json.loads(response.data)['upload_id']
+        
+        response = self.client.put(f'/api/uploads/{upload_id}/chunks/0', data=b'short')
+        self.assertEqual(response.status_code, 400)
+        
+        response = self.client.put(f'/api/uploads/{upload_id}/chunks/5', data=b'x' * 1000)
+        self.assertEqual(response.status_code, 400)
+    
+    def test_upload_duplicate_content(self):
+        """测试重复上传相同内容只保存一份"""
+        from io import BytesIO
+        content = b'%PDF-1.4\nSame book content'
+        
+        results = []
+        for name in ('first.pdf', 'second.pdf'):
+            response = self.client.post('/api/upload',
+                                       data={'file': (BytesIO(content), name)},
+                                       content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+            results.append(json.loads(response.data)['file'])
+        
+        self.assertFalse(results[0]['deduplicated'])
+        self.assertTrue(results[1]['deduplicated'])
+        self.assertEqual(results[0]['sha256'], results[1]['sha256'])
+        
+        # 两个文件名指向同一份内容
+        first, second = results[0]['path'], results[1]['path']
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        
+        # 客户端声明的摘要不能代替上传，未上传分块时无法完成
+        def create_session(name):
+            response = self.client.post('/api/uploads',
+                                       data=json.dumps({'filename': name,
+                                                        'size': len(content),
+                                                        'sha256': results[0]['sha256']}),
+                                       content_type='application/json')
+            session = json.loads(response.data)
+            self.assertNotIn('deduplicated', session)
+            return session['upload_id']
+        
+        upload_id = create_session('third.pdf')
+        response = self.client.post(f'/api/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 400)
+        
+        # 上传的内容与声明的摘要不符时拒绝
+        upload_id = create_session('fake.pdf')
+        forged = b'%PDF-1.4\nOther book content'[:len(content)].ljust(len(content), b'x')
+        self.client.put(f'/api/uploads/{upload_id}/chunks/0', data=forged)
+        response = self.client.post(f'/api/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 400)
+        
+        # 服务端对收到的内容计算摘要后再去重
+        upload_id = create_session('fourth.pdf')
+        self.client.put(f'/api/uploads/{upload_id}/chunks/0', data=content)
+        response = self.client.post(f'/api/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertTrue(result['file']['deduplicated'])
+        with open(result['file']['path'], 'rb') as f:
+            self.assertEqual(f.read(), content)
+    
+    def test_preflight_rejects_oversized_upload(self):
+        """测试Content-Length超过邮件可发送大小时在读取请求体前拒绝"""
+        from io import BytesIO
+        from app.utils.kindle_sender import max_attachment_size
+        
+        response = self.client.post('/api/send-to-kindle',
+                                   data={'file': (BytesIO(b'%PDF-1.4'), 'big.pdf')},
+                                   content_type='multipart/form-data',
+                                   environ_overrides={'CONTENT_LENGTH': str(max_attachment_size() + 1024 * 1024)})
+        
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(json.loads(response.data)['success'])
+    
+    def test_preflight_rejects_wrong_magic(self):
+        """测试文件内容与扩展名不符时拒绝"""
+        from io import BytesIO
+        
+        response = self.client.post('/api/upload',
+                                   data={'file': (BytesIO(b'MZ\x90\x00 not a pdf'), 'fake.pdf')},
+                                   content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 415)
+        result = json.loads(response.data)
+        self.assertFalse(result['success'])
+        
+        # 被拒绝的上传不应留下任何文件
+        saved_files = [f for f in os.listdir(self.upload_dir) if not f.startswith('.')]
+        self.assertEqual(saved_files, [])
+        self.assertEqual(os.listdir(os.path.join(self.upload_dir, '.store', 'tmp')), [])
+    
+    @patch('main.send_to_kindle')
+    def test_batch_process(self, mock_send):
+        """测试批量上传：每个文件单独返回结果，不合格的文件不影响其他文件"""
+        from io import BytesIO
+        mock_send.return_value = True
+        
+        response = self.client.post('/api/batch',
+                                   data={
+                                       'kindle_email': 'other@kindle.com',
+                                       'file': [
+                                           (BytesIO(b'%PDF-1.4\nbook one'), 'one.pdf'),
+                                           (BytesIO(b'not a pdf'), 'fake.pdf'),
+                                           (BytesIO(b'plain text'), 'two.txt'),
+                                           (BytesIO(b'data'), 'bad.exe')
+                                       ]
+                                   },
+                                   content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertFalse(result['success'])
+        self.assertEqual(result['message'], '2/4 个文件已发送到Kindle')
+        
+        items = {item['filename']: item for item in result['results']}
+        self.assertTrue(items['one.pdf']['success'])
+        self.assertTrue(items['two.txt']['success'])
+        self.assertEqual(items['one.pdf']['sent_to'], 'other@kindle.com')
+        self.assertFalse(items['fake.pdf']['success'])
+        self.assertEqual(items['fake.pdf']['stage'], 'upload')
+        self.assertFalse(items['bad.exe']['success'])
+        self.assertEqual(mock_send.call_count, 2)
+        
+        # 被拒绝的文件不应留在暂存区
+        self.assertEqual(os.listdir(os.path.join(self.upload_dir, '.store', 'tmp')), [])
+    
+    @patch('main.send_to_kindle')
+    def test_batch_truncated_body(self, mock_send):
+        """测试批量上传请求体中途截断：已接收的文件照常发送，只有未接收完的文件算作失败"""
+        mock_send.return_value = True
+        body = (b'--XX\r\nContent-Disposition: form-data; name="file"; filename="one.txt"\r\n\r\n'
+                b'plain text\r\n'
+                b'--XX\r\nContent-Disposition: form-data; name="file"; filename="two.txt"\r\n\r\n'
+                b'partial data')
+        
+        response = self.client.post('/api/batch', data=body,
+                                   content_type='multipart/form-data; boundary=XX')
+        
+        self.assertEqual(response.status_code, 400)
+        result = json.loads(response.data)
+        self.assertFalse(result['success'])
+        self.assertIn('请求体解析失败', result['message'])
+        
+        items = {item['filename']: item for item in result['results']}
+        self.assertTrue(items['one.txt']['success'])
+        self.assertEqual(items['one.txt']['sent_to'], 'test@kindle.com')
+        self.assertFalse(items['two.txt']['success'])
+        self.assertEqual(items['two.txt']['stage'], 'upload')
+        self.assertEqual(mock_send.call_count, 1)
+        
+        # 未接收完的文件不应留在暂存区
+        self.assertEqual(os.listdir(os.path.join(self.upload_dir, '.store', 'tmp')), [])
+    
+    def test_gzip_encoded_upload(self):
+        """测试Content-Encoding: gzip的请求体边接收边解压"""
+        import gzip
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import encode_multipart
+        content = '第一章\n'.encode('utf-8') * 10000
+        boundary, body = encode_multipart({'file': FileStorage(BytesIO(content), 'book.txt')})
+        compressed = gzip.compress(body)
+        self.assertLess(len(compressed), len(body) // 10)
+        
+        response = self.client.post('/api/upload',
+                                   data=compressed,
+                                   content_type=f'multipart/form-data; boundary={boundary}',
+                                   headers={'Content-Encoding': 'gzip'})
+        
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        with open(result['file']['path'], 'rb') as f:
+            self.assertEqual(f.read(), content)
+    
+    def test_gzip_bomb_rejected(self):
+        """测试解压后超过MAX_CONTENT_LENGTH时中止读取"""
+        import gzip
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import encode_multipart
+        boundary, body = encode_multipart({'file': FileStorage(BytesIO(b' ' * (4 * 1024 * 1024)), 'bomb.txt')})
+        
+        with patch.dict(self.app.config, {'MAX_CONTENT_LENGTH': 1024 * 1024}):
+            response = self.client.post('/api/upload',
+                                       data=gzip.compress(body),
+                                       content_type=f'multipart/form-data; boundary={boundary}',
+                                       headers={'Content-Encoding': 'gzip'})
+        
+        self.assertEqual(response.status_code, 413)
+        saved_files = [f for f in os.listdir(self.upload_dir) if not f.startswith('.')]
+        self.assertEqual(saved_files, [])
+        self.assertEqual(os.listdir(os.path.join(self.upload_dir, '.store', 'tmp')), [])
+    
+    def test_unsupported_content_encoding(self):
+        """测试不支持的Content-Encoding返回415"""
+        response = self.client.post('/api/upload',
+                                   data=b'data',
+                                   content_type='multipart/form-data; boundary=x',
+                                   headers={'Content-Encoding': 'br'})
+        self.assertEqual(response.status_code, 415)
+    
+    def test_gzip_chunked_upload_without_length(self):
+        """测试没有Content-Length的压缩请求体：服务器保证输入流终止时读到末尾，否则返回411"""
+        import gzip
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import EnvironBuilder, encode_multipart
+        content = b'chunked text\n' * 1000
+        boundary, body = encode_multipart({'file': FileStorage(BytesIO(content), 'book.txt')})
+        compressed = gzip.compress(body)
+        
+        def post(input_terminated):
+            environ = EnvironBuilder(path='/api/upload', method='POST', data=compressed,
+                                     content_type=f'multipart/form-data; boundary={boundary}',
+                                     headers={'Content-Encoding': 'gzip'}).get_environ()
+            # 模拟 Transfer-Encoding: chunked 的请求
+            del environ['CONTENT_LENGTH']
+            if input_terminated:
+                environ['wsgi.input_terminated'] = True
+            statuses = []
+            chunks = self.app.wsgi_app(environ, lambda status, headers: statuses.append(status))
+            return int(statuses[0].split()[0]), json.loads(b''.join(chunks))
+        
+        status, result = post(input_terminated=False)
+        self.assertEqual(status, 411)
+        self.assertFalse(result['success'])
+        
+        status, result = post(input_terminated=True)
+        self.assertEqual(status, 200)
+        with open(result['file']['path'], 'rb') as f:
+            self.assertEqual(f.read(), content)
+    
+    @patch('main.send_to_kindle')
+    def test_async_job_throttled(self, mock_send):
+        """测试后台任务达到速率限制时推迟发送，不计入尝试次数"""
+        from io import BytesIO
+        from app.utils.delivery_queue import get_delivery
+        mock_send.return_value = True
+        
+        with patch.dict(self.app.config, {'SMTP_MESSAGES_PER_MINUTE': 1}):
+            first = json.loads(self.client.post('/api/process?async=true',
+                                                data={'file': (BytesIO(b'plain one'), 'one.txt')},
+                                                content_type='multipart/form-data').data)
+            self.assertEqual(self._wait_for_job(first['job_id'])['status'], 'succeeded')
+            
+            second = json.loads(self.client.post('/api/process?async=true',
+                                                 data={'file': (BytesIO(b'plain two'), 'two.txt')},
+                                                 content_type='multipart/form-data').data)
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                job = json.loads(self.client.get(second['status_url']).data)
+                if job['stage'] == 'throttled':
+                    break
+                time.sleep(0.02)
+        
+        self.assertEqual(job['status'], 'queued')
+        self.assertGreater(job['next_attempt_at'], time.time() + 30)
+        self.assertEqual(mock_send.call_count, 1)
+        
+        row = get_delivery(os.path.join(self.upload_dir, '.delivery.db'), 2)
+        self.assertEqual(row['status'], 'pending')
+        self.assertEqual(row['attempts'], 0)
+    
+    @patch('main.send_to_kindle')
+    @patch('main.send_files_to_kindle')
+    def test_async_batch_merged(self, mock_send_files, mock_send):
+        """测试批量请求async=true时同一批文件放入队列，合并成一次发送"""
+        from io import BytesIO
+        mock_send_files.side_effect = lambda **kwargs: [None] * len(kwargs['file_paths'])
+        
+        response = self.client.post('/api/batch?async=true',
+                                   data={'file': [(BytesIO(b'plain text one'), 'one.txt'),
+                                                  (BytesIO(b'plain text two'), 'two.txt')]},
+                                   content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        result = json.loads(response.data)
+        self.assertTrue(result['success'])
+        
+        for item in result['results']:
+            job = self._wait_for_job(item['job_id'])
+            self.assertEqual(job['status'], 'succeeded')
+        
+        mock_send.assert_not_called()
+        mock_send_files.assert_called_once()
+        self.assertEqual(len(mock_send_files.call_args[1]['file_paths']), 2)
+    
+    def _wait_for_job(self, job_id, timeout=5, statuses=('succeeded', 'failed')):
+        """轮询任务状态直到结束"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = json.loads(self.client.get(f'/api/jobs/{job_id}').data)
+            if job['status'] in statuses:
+                return job
+            time.sleep(0.02)
+        self.fail(f'任务 {job_id} 未在 {timeout} 秒内结束')
+    
+    @patch('main.send_to_kindle')
+    def test_async_process_job(self, mock_send):
+        """测试async=true时立即返回任务ID，后台完成发送"""
+        from io import BytesIO
+        
+        def fake_send(**kwargs):
+            kwargs['progress_callback'](50, 100)
+            kwargs['progress_callback'](100, 100)
+            return True
+        mock_send.side_effect = fake_send
+        
+        response = self.client.post('/api/process?async=true',
+                                   data={'file': (BytesIO(b'%PDF-1.4\nasync'), 'async.pdf')},
+                                   content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        result = json.loads(response.data)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['status_url'], f"/api/jobs/{result['job_id']}")
+        
+        job = self._wait_for_job(result['job_id'])
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['stage'], 'done')
+        self.assertEqual(job['progress'], 100)
+        self.assertEqual(job['filename'], 'async.pdf')
+        self.assertEqual(job['sent_to'], 'test@kindle.com')
+        self.assertIn('send_time', job['timings'])
+        self.assertIn('queue_wait', job['timings'])
+    
+    @patch('main.send_to_kindle')
+    def test_async_job_failure(self, mock_send):
+        """测试后台发送失败时任务状态为failed"""
+        from io import BytesIO
+        mock_send.return_value = False
+        
+        response = self.client.post('/api/send-to-kindle',
+                                   data={'file': (BytesIO(b'%PDF-1.4\nfail'), 'fail.pdf'),
+                                         'async': 'true'},
+                                   content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        
+        job = self._wait_for_job(json.loads(response.data)['job_id'])
+        self.assertEqual(job['status'], 'failed')
+        self.assertFalse(job['success'])
+        self.assertEqual(job['failed_stage'], 'send')
+    
+    @patch('main.send_to_kindle_recipients')
+    def test_send_multiple_kindle_emails(self, mock_send):
+        """测试同时发送到多个Kindle邮箱：返回每个邮箱的结果，后台任务只重试发送失败的邮箱"""
+        import smtplib
+        from io import BytesIO
+        from app.utils.delivery_queue import get_delivery
+        refused = smtplib.SMTPRecipientsRefused({'b@kindle.com': (450, b'mailbox busy')})
+        mock_send.return_value = {'a@kindle.com': None, 'b@kindle.com': refused}
+        
+        test_file = os.path.join(self.upload_dir, 'test.epub')
+        with open(test_file, 'wb') as f:
+            f.write(b'EPUB content')
+        response = self.client.post('/api/send',
+                                   data=json.dumps({'filepath': test_file,
+                                                    'kindle_emails': ['a@kindle.com', 'b@kindle.com', 'A@kindle.com']}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 207)
+        data = json.loads(response.data)
+        self.assertEqual([r['success'] for r in data['recipients']], [True, False])
+        self.assertEqual(mock_send.call_args[1]['kindle_emails'], ['a@kindle.com', 'b@kindle.com'])
+        
+        response = self.client.post('/api/send-to-kindle',
+                                   data={'file': (BytesIO(b'plain text'), 'book.txt'),
+                                         'kindle_email': 'a@kindle.com; b@kindle.com',
+                                         'async': 'true'},
+                                   content_type='multipart/form-data')
+        job = self._wait_for_job(json.loads(response.data)['job_id'], statuses=('retrying', 'failed'))
+        self.assertEqual(job['status'], 'retrying')
+        self.assertIsNone(job['recipients']['a@kindle.com'])
+        self.assertIn('mailbox busy', job['recipients']['b@kindle.com'])
+        self.assertEqual(get_delivery(os.path.join(self.upload_dir, '.delivery.db'), 1)['kindle_email'],
+                         'b@kindle.com')
+    
+    @patch('main.send_to_kindle')
+    def test_async_job_transient_error_retries(self, mock_send):
+        """测试临时性SMTP错误时任务留在队列中等待重试，认证错误直接失败"""
+        import smtplib
+        from io import BytesIO
+        from app.utils.delivery_queue import get_delivery
+        
+        mock_send.side_effect = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        response = self.client.post('/api/process?async=true',
+                                   data={'file': (BytesIO(b'%PDF-1.4\nretry'), 'retry.pdf')},
+                                   content_type='multipart/form-data')
+        job = self._wait_for_job(json.loads(response.data)['job_id'], statuses=('retrying', 'failed'))
+        self.assertEqual(job['status'], 'retrying')
+        self.assertEqual(job['attempts'], 1)
+        self.assertGreater(job['next_attempt_at'], time.time())
+        self.assertEqual(get_delivery(os.path.join(self.upload_dir, '.delivery.db'), 1)['status'], 'pending')
+        
+        mock_send.side_effect = smtplib.SMTPAuthenticationError(535, b'Authentication failed')
+        response = self.client.post('/api/process?async=true',
+                                   data={'file': (BytesIO(b'%PDF-1.4\nauth'), 'auth.pdf')},
+                                   content_type='multipart/form-data')
+        job = self._wait_for_job(json.loads(response.data)['job_id'], statuses=('retrying', 'failed'))
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(get_delivery(os.path.join(self.upload_dir, '.delivery.db'), 2)['status'], 'dead')
+    
+    @patch('main.send_to_kindle')
+    def test_cancel_job(self, mock_send):
+        """测试取消排队中的任务和正在转换的任务，已结束的任务不能取消"""
+        from io import BytesIO
+        from app.utils.delivery_queue import get_delivery
+        from app.utils.pdf_converter import ConversionCancelled
+        mock_send.return_value = True
+        db_path = os.path.join(self.upload_dir, '.delivery.db')
+        
+        # 达到速率限制被推迟的任务在排队中，立即取消
+        with patch.dict(self.app.config, {'SMTP_MESSAGES_PER_MINUTE': 1}):
+            first = json.loads(self.client.post('/api/process?async=true',
+                                                data={'file': (BytesIO(b'plain one'), 'one.txt')},
+                                                content_type='multipart/form-data').data)
+            self._wait_for_job(first['job_id'])
+            second = json.loads(self.client.post('/api/process?async=true',
+                                                 data={'file': (BytesIO(b'plain two'), 'two.txt')},
+                                                 content_type='multipart/form-data').data)
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                if json.loads(self.client.get(second['status_url']).data)['stage'] == 'throttled':
+                    break
+                time.sleep(0.02)
+            
+            response = self.client.post(f"/api/jobs/{second['job_id']}/cancel")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'cancelled')
+        self.assertEqual(json.loads(self.client.get(second['status_url']).data)['status'], 'cancelled')
+        self.assertEqual(get_delivery(db_path, 2)['status'], 'cancelled')
+        self.assertEqual(self.client.post(f"/api/jobs/{second['job_id']}/cancel").status_code, 409)
+        self.assertEqual(self.client.post(f"/api/jobs/{first['job_id']}/cancel").status_code, 409)
+        self.assertEqual(self.client.post(f'/api/jobs/{"0" * 32}/cancel').status_code, 404)
+        
+        # 正在转换的任务：转换被中止，不再发送
+        started = threading.Event()
+        
+        def convert(path, should_cancel=None, **kwargs):
+            started.set()
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                if should_cancel():
+                    raise ConversionCancelled('转换已取消')
+                time.sleep(0.02)
+            return path
+        
+        with patch('main.convert_pdf_to_epub', side_effect=convert), \
+                patch('main.get_convert_cache', return_value=None), \
+                patch.dict(self.app.config, {'CONVERT_PDF_TO_EPUB': True}):
+            third = json.loads(self.client.post('/api/process?async=true',
+                                                data={'file': (BytesIO(b'%PDF-1.4\nslow'), 'slow.pdf')},
+                                                content_type='multipart/form-data').data)
+            self.assertTrue(started.wait(5))
+            response = self.client.post(f"/api/jobs/{third['job_id']}/cancel")
+            self.assertEqual(response.status_code, 202)
+            job = self._wait_for_job(third['job_id'], statuses=('cancelled', 'succeeded', 'failed'))
+        
+        self.assertEqual(job['status'], 'cancelled')
+        self.assertEqual(get_delivery(db_path, 3)['status'], 'cancelled')
+        self.assertEqual(mock_send.call_count, 1)
+    
+    def test_finish_delivery_lease_lost(self):
+        """测试租约被其他线程领取后，原领取者的发送结果不更新队列"""
+        from main import finish_delivery
+        from app.utils.delivery_queue import enqueue, claim, get_delivery
+        db_path = os.path.join(self.upload_dir, '.delivery.db')
+        delivery_id = enqueue(db_path, '/tmp/book.epub', 'book.epub', 'test@kindle.com')
+        stale = claim(db_path, owner='a', lease_seconds=-1)
+        claim(db_path, owner='b')
+        
+        result = {'success': True, 'converted': False, 'format': 'EPUB',
+                  'convert_time': 0.0, 'send_time': 0.0}
+        finish_delivery(db_path, stale, result, time.time())
+        delivery = get_delivery(db_path, delivery_id)
+        self.assertEqual((delivery['status'], delivery['lease_owner']), ('leased', 'b'))
+    
+    @patch('main.smtp_send_files')
+    def test_batch_skips_lost_leases(self, mock_send):
+        """测试合并发送前续租，租约已被其他线程领取的任务不再发送"""
+        from main import process_deliveries
+        from app.utils.delivery_queue import enqueue, claim, claim_batch, get_delivery
+        mock_send.side_effect = lambda account, email, paths, *args: [None] * len(paths)
+        db_path = os.path.join(self.upload_dir, '.delivery.db')
+        paths = []
+        for name in ('one.epub', 'two.epub'):
+            paths.append(os.path.join(self.upload_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'epub')
+            enqueue(db_path, paths[-1], name, 'test@kindle.com')
+        
+        batch = claim_batch(db_path, owner='a', lease_seconds=-1, limit=2)
+        stolen = claim(db_path, owner='b')
+        process_deliveries(db_path, batch)
+        
+        kept = [path for path in paths if path != stolen['filepath']]
+        self.assertEqual(mock_send.call_args[0][2], kept)
+        self.assertEqual(get_delivery(db_path, stolen['id'])['lease_owner'], 'b')
+        statuses = {get_delivery(db_path, delivery['id'])['status'] for delivery in batch
+                    if delivery['id'] != stolen['id']}
+        self.assertEqual(statuses, {'sent'})
+    
+    def test_delivery_error_marks_job_failed(self):
+        """测试处理任务时出现意外错误（文件已被删除）时任务失败，不会一直停在发送中"""
+        import main
+        from app.utils.delivery_queue import enqueue, get_delivery
+        from app.utils.job_store import create_job
+        db_path = os.path.join(self.upload_dir, '.delivery.db')
+        job = create_job(os.path.join(self.upload_dir, '.jobs'), 'gone.epub')
+        delivery_id = enqueue(db_path, os.path.join(self.upload_dir, 'gone.epub'), 'gone.epub',
+                              'test@kindle.com', job_id=job['job_id'])
+        main.ensure_delivery_workers()
+        main._delivery_wakeup.set()
+        
+        job = self._wait_for_job(job['job_id'])
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('gone.epub', job['error'])
+        self.assertEqual(get_delivery(db_path, delivery_id)['status'], 'dead')
+    
+    def test_job_not_found(self):
+        """测试查询不存在的任务"""
+        response = self.client.get(f'/api/jobs/{"0" * 32}')
+        self.assertEqual(response.status_code, 404)
+        
+        response = self.client.get('/api/jobs/not-a-job')
+        self.assertEqual(response.status_code, 400)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio SMTP发送引擎测试文件
+"""
+import unittest
+import os
+import sys
+import email
+import asyncio
+import smtplib
+import tempfile
+import shutil
+import threading
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.async_smtp import DeliveryEngine, AsyncSMTPClient
+from tests.smtp_sink import FakeSMTPServer
+
+
+class TestAsyncSMTP(unittest.TestCase):
+    """测试事件循环中的SMTP发送"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        # 响应延迟使多个发送同时进行
+        self.server = FakeSMTPServer(latency=0.02)
+        self.tls_patcher = patch('app.utils.async_smtp.tls_mode', return_value=None)
+        self.tls_patcher.start()
+        self.engine = DeliveryEngine()
+
+    def tearDown(self):
+        """测试后的清理"""
+        self.engine.close()
+        self.tls_patcher.stop()
+        self.server.close()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _file(self, name, size):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def _send(self, paths, sender='sender@163.com', password='secret', **kwargs):
+        return self.engine.submit_send('test@kindle.com', sender, password, paths,
+                                       '127.0.0.1', self.server.port, **kwargs)
+
+    def test_send_merged_files(self):
+        """测试多个文件合并成一封邮件，附件内容与原文件一致"""
+        paths = [self._file('a.epub', 2 * 1024 * 1024 + 5), self._file('书.pdf', 1000)]
+        progress = []
+        errors = self._send(paths, progress_callback=lambda sent, total: progress.append((sent, total))).result(10)
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(self.server.messages), 1)
+        message = email.message_from_bytes(self.server.messages[0][1])
+        for part, path in zip(message.get_payload()[1:], paths):
+            self.assertEqual(part.get_filename(), os.path.basename(path))
+            with open(path, 'rb') as f:
+                self.assertEqual(part.get_payload(decode=True), f.read())
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+    def test_concurrent_sends_share_one_thread(self):
+        """测试大量并发发送在同一个事件循环线程中同时进行"""
+        path = self._file('book.txt', 10000)
+        threads_before = threading.active_count()
+        futures = [self._send([path], sender=f'user{i}@163.com') for i in range(40)]
+
+        self.assertTrue(all(future.result(30) == [None] for future in futures))
+        self.assertEqual(len(self.server.messages), 40)
+        self.assertGreater(self.server.max_active, 10)
+        # 文件读取使用线程池，线程数不随并发发送数增长
+        self.assertLess(threading.active_count() - threads_before, 40)
+
+    def test_binary_transfer(self):
+        """测试服务器支持BINARYMIME时附件以原始字节通过BDAT发送"""
+        self.server.binary = True
+        content = os.urandom(5 * 1024 * 1024) + b'\r\n.\r\n'
+        path = os.path.join(self.test_dir, 'book.pdf')
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.assertEqual(self._send([path]).result(10), [None])
+
+        message = email.message_from_bytes(self.server.messages[0][1])
+        attachment = message.get_payload()[1]
+        self.assertEqual(attachment['Content-Transfer-Encoding'], 'binary')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+
+    def test_connection_reused(self):
+        """测试同一账号连续发送复用已登录的连接"""
+        path = self._file('book.txt', 100)
+        self.assertEqual(self._send([path]).result(10), [None])
+        self.assertEqual(self._send([path]).result(10), [None])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_stale_connection_reconnects(self):
+        """测试复用的连接已被服务器关闭时自动重新连接"""
+        self.server.close_after_message = True
+        path = self._file('book.txt', 100)
+        self.assertEqual(self._send([path]).result(10), [None])
+        self.assertEqual(self._send([path]).result(10), [None])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_auth_failure(self):
+        """测试认证失败以smtplib异常返回"""
+        self.server.users = {'sender@163.com': 'secret'}
+        path = self._file('book.txt', 100)
+        errors = self._send([path], password='bad').result(10)
+        self.assertIsInstance(errors[0], smtplib.SMTPAuthenticationError)
+        self.assertEqual(errors[0].smtp_code, 535)
+        self.assertEqual(self.server.messages, [])
+
+    def test_missing_file(self):
+        """测试不存在的文件单独报错，其他文件正常发送"""
+        path = self._file('book.txt', 100)
+        errors = self._send([os.path.join(self.test_dir, 'missing.txt'), path]).result(10)
+        self.assertIsInstance(errors[0], OSError)
+        self.assertIsNone(errors[1])
+
+    def test_write_timeout(self):
+        """测试服务器不再接收数据时写入超时，连接被关闭"""
+        class StalledWriter:
+            def write(self, data):
+                pass
+
+            async def drain(self):
+                await asyncio.Event().wait()
+
+            def close(self):
+                pass
+
+        client = AsyncSMTPClient('127.0.0.1', self.server.port, tls=None, timeout=0.05)
+        client.writer = StalledWriter()
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            asyncio.run(client.command('NOOP'))
+        self.assertIsNone(client.writer)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+格式转换结果缓存测试文件
+"""
+import unittest
+import os
+import sys
+import time
+import tempfile
+import shutil
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.convert_cache import ConvertCache, configure_convert_cache, get_convert_cache
+
+
+class TestConvertCache(unittest.TestCase):
+    """测试转换结果缓存的索引、发布、淘汰和单飞"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.test_dir, 'cache')
+        self.cache = ConvertCache(self.cache_dir)
+
+    def tearDown(self):
+        """测试后的清理"""
+        configure_convert_cache(self.cache_dir, 0)
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _file(self, name, content):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _results(self):
+        return sorted(name for name in os.listdir(self.cache_dir) if name.endswith('.result'))
+
+    def test_key(self):
+        """测试缓存键由内容、转换器版本和选项决定，与文件名无关"""
+        a = self._file('a.pdf', b'%PDF same')
+        b = self._file('b.pdf', b'%PDF same')
+        options = ['--language', 'zh-CN']
+        self.assertEqual(self.cache.key(a, '7.0', options), self.cache.key(b, '7.0', options))
+        self.assertNotEqual(self.cache.key(a, '7.0', options), self.cache.key(a, '7.1', options))
+        self.assertNotEqual(self.cache.key(a, '7.0', options), self.cache.key(a, '7.0', ['--language', 'en']))
+
+        with open(b, 'wb') as f:
+            f.write(b'%PDF other')
+        self.assertNotEqual(self.cache.key(a, '7.0', options), self.cache.key(b, '7.0', options))
+
+    def test_publish_and_fetch(self):
+        """测试发布后的结果可以取到指定路径，未发布时返回 None"""
+        output = os.path.join(self.test_dir, 'book.epub')
+        self.assertIsNone(self.cache.fetch('k', output))
+        self.assertFalse(os.path.exists(output))
+
+        result = self._file('converted.epub', b'EPUB content')
+        self.cache.publish('k', result)
+        self.assertEqual(self.cache.fetch('k', output), output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'EPUB content')
+        # 只留下结果文件，没有临时文件
+        self.assertEqual([n for n in os.listdir(self.cache_dir) if not n.endswith('.lock')], ['k.result'])
+
+    def test_lru_eviction(self):
+        """测试超过上限时删除最久未用的结果，超过上限的结果不缓存"""
+        cache = ConvertCache(self.cache_dir, max_bytes=2500)
+        for key in ('a', 'b'):
+            cache.publish(key, self._file(f'{key}.epub', b'x' * 1000))
+        old = time.time() - 100
+        os.utime(os.path.join(self.cache_dir, 'a.result'), (old, old))
+        os.utime(os.path.join(self.cache_dir, 'b.result'), (old + 1, old + 1))
+        cache.fetch('a', os.path.join(self.test_dir, 'out.epub'))
+
+        cache.publish('c', self._file('c.epub', b'x' * 1000))
+        self.assertEqual(self._results(), ['a.result', 'c.result'])
+
+        cache.publish('d', self._file('d.epub', b'x' * 3000))
+        self.assertNotIn('d.result', self._results())
+
+    def test_single_flight(self):
+        """测试同一个键同时只有一个持有者，等待者拿到已发布的结果"""
+        result = self._file('converted.epub', b'EPUB content')
+        calls = []
+
+        def convert(index):
+            output = os.path.join(self.test_dir, f'out{index}.epub')
+            with self.cache.single_flight('k'):
+                if self.cache.fetch('k', output) is None:
+                    calls.append(index)
+                    time.sleep(0.1)
+                    self.cache.publish('k', result)
+                    return
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), b'EPUB content')
+
+        threads = [threading.Thread(target=convert, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache._key_locks, {})
+
+    def test_disabled(self):
+        """测试上限为0时不使用缓存"""
+        configure_convert_cache(self.cache_dir, 0)
+        self.assertIsNone(get_convert_cache())
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
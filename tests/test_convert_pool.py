@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+格式转换工作池测试文件
+"""
+import unittest
+import os
+import sys
+import time
+import tempfile
+import shutil
+import threading
+import subprocess
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.convert_pool import ConversionPool, ConversionQueueFull
+
+
+class TestConvertPool(unittest.TestCase):
+    """测试转换池的并发限制、排队上限和优先级"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.slot_dir = os.path.join(self.test_dir, 'slots')
+        self.pools = []
+
+    def tearDown(self):
+        """测试后的清理"""
+        for pool in self.pools:
+            pool.close()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _pool(self, **kwargs):
+        pool = ConversionPool(**kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_concurrency_limit(self):
+        """测试同时运行的转换数不超过 workers"""
+        pool = self._pool(workers=2, max_queue=10, niceness=0)
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0}
+
+        def convert(index):
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+            return index
+
+        futures = [pool.submit(convert, i) for i in range(6)]
+        self.assertEqual([future.result(5) for future in futures], list(range(6)))
+        self.assertEqual(state['max_active'], 2)
+        self.assertEqual(pool.stats()['completed'], 6)
+
+    def test_queue_full(self):
+        """测试排队已满时立即拒绝，stats 返回排队和运行中的数量"""
+        pool = self._pool(workers=1, max_queue=1, niceness=0)
+        release = threading.Event()
+        started = threading.Event()
+
+        def convert():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        first = pool.submit(convert)
+        started.wait(5)
+        second = pool.submit(convert)
+        with self.assertRaises(ConversionQueueFull):
+            pool.submit(convert)
+        self.assertEqual(pool.stats()['running'], 1)
+        self.assertEqual(pool.stats()['queued'], 1)
+
+        release.set()
+        self.assertEqual(first.result(5), 'done')
+        self.assertEqual(second.result(5), 'done')
+        self.assertEqual(pool.stats()['queued'], 0)
+        # 排队空出后可以继续提交
+        self.assertEqual(pool.run(lambda: 'again'), 'again')
+
+    def test_slots_shared_between_pools(self):
+        """测试共用槽位目录的多个池（多个工作进程）合计不超过 workers"""
+        first = self._pool(workers=1, max_queue=4, niceness=0, slot_dir=self.slot_dir)
+        second = self._pool(workers=1, max_queue=4, niceness=0, slot_dir=self.slot_dir)
+        release = threading.Event()
+        started = threading.Event()
+
+        def hold():
+            started.set()
+            release.wait(5)
+
+        blocker = first.submit(hold)
+        started.wait(5)
+        waiting = second.submit(lambda: 'converted')
+        time.sleep(0.5)
+        self.assertFalse(waiting.done())
+        self.assertEqual(second.stats()['queued'], 1)
+
+        release.set()
+        blocker.result(5)
+        self.assertEqual(waiting.result(5), 'converted')
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), '线程独立的nice值仅在Linux下有效')
+    def test_lower_priority(self):
+        """测试转换线程和它启动的子进程降低优先级，调用线程不受影响"""
+        pool = self._pool(workers=1, niceness=5)
+        before = os.getpriority(os.PRIO_PROCESS, 0)
+        child = pool.run(subprocess.run, [sys.executable, '-c', 'import os; print(os.nice(0))'],
+                         capture_output=True, text=True)
+        self.assertEqual(int(child.stdout), min(before + 5, 19))
+        self.assertEqual(os.getpriority(os.PRIO_PROCESS, threading.get_native_id()), before)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
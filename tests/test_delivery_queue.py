@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发送队列测试文件
+"""
+import unittest
+import os
+import sys
+import time
+import tempfile
+import shutil
+import threading
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.delivery_queue import (
+    enqueue,
+    claim,
+    claim_batch,
+    mark_sent,
+    mark_failed,
+    defer,
+    renew,
+    get_delivery,
+    backoff_delay
+)
+
+
+class TestDeliveryQueue(unittest.TestCase):
+    """测试队列的领取、重试和死信"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, 'delivery.db')
+
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _enqueue(self, **kwargs):
+        return enqueue(self.db_path, '/tmp/book.pdf', 'book.pdf', 'test@kindle.com', **kwargs)
+
+    def test_claim_is_exclusive(self):
+        """测试多个线程同时领取时每个任务只被领取一次"""
+        ids = {self._enqueue() for _ in range(5)}
+        claimed = []
+        lock = threading.Lock()
+
+        def worker(index):
+            while True:
+                delivery = claim(self.db_path, owner=f'worker-{index}')
+                if delivery is None:
+                    return
+                with lock:
+                    claimed.append(delivery['id'])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claimed), sorted(ids))
+
+    def test_mark_sent(self):
+        """测试发送成功后不再被领取"""
+        delivery_id = self._enqueue()
+        delivery = claim(self.db_path, owner='a')
+        self.assertEqual(delivery['attempts'], 1)
+
+        self.assertTrue(mark_sent(self.db_path, delivery_id, 'a'))
+        self.assertEqual(get_delivery(self.db_path, delivery_id)['status'], 'sent')
+        self.assertIsNone(claim(self.db_path, owner='a'))
+
+    def test_expired_lease_is_reclaimed(self):
+        """测试领取者退出后租约过期，任务被重新领取，原领取者不能再更新"""
+        delivery_id = self._enqueue()
+        claim(self.db_path, owner='dead-worker', lease_seconds=-1)
+
+        delivery = claim(self.db_path, owner='b')
+        self.assertEqual(delivery['id'], delivery_id)
+        self.assertEqual(delivery['attempts'], 2)
+
+        self.assertFalse(mark_sent(self.db_path, delivery_id, 'dead-worker'))
+        self.assertTrue(mark_sent(self.db_path, delivery_id, 'b'))
+
+    def test_renew_lease(self):
+        """测试续租后租约不会过期，租约已被他人领取时不能续租"""
+        first = self._enqueue()
+        second = self._enqueue()
+        claim_batch(self.db_path, owner='a', lease_seconds=-1, limit=2)
+
+        # 租约已过期但未被领取，仍可续租
+        self.assertEqual(renew(self.db_path, [first], 'a'), {first})
+        self.assertGreater(get_delivery(self.db_path, first)['lease_expires_at'], time.time())
+
+        # 未续租的任务被其他领取者领取
+        self.assertEqual(claim(self.db_path, owner='b')['id'], second)
+        self.assertEqual(renew(self.db_path, [first, second], 'a'), {first})
+        self.assertFalse(mark_sent(self.db_path, second, 'a'))
+        self.assertTrue(mark_sent(self.db_path, first, 'a'))
+        self.assertEqual(renew(self.db_path, [first], 'a'), set())
+
+    def test_transient_failure_backoff(self):
+        """测试临时性错误按退避时间重试，已转换的文件用于重试"""
+        delivery_id = self._enqueue(convert_pdf=True)
+        delivery = claim(self.db_path, owner='a')
+
+        before = time.time()
+        next_attempt = mark_failed(self.db_path, delivery, '421 try later', transient=True,
+                                   filepath='/tmp/book.epub')
+        self.assertGreaterEqual(next_attempt - before, backoff_delay(1) / 2 - 1)
+
+        row = get_delivery(self.db_path, delivery_id)
+        self.assertEqual(row['status'], 'pending')
+        self.assertEqual(row['filepath'], '/tmp/book.epub')
+        self.assertEqual(row['convert_pdf'], 0)
+        self.assertEqual(row['last_error'], '421 try later')
+
+        # 未到重试时间不会被领取
+        self.assertIsNone(claim(self.db_path, owner='a'))
+        with patch('app.utils.delivery_queue.time.time', return_value=next_attempt + 1):
+            self.assertEqual(claim(self.db_path, owner='a')['id'], delivery_id)
+
+    def test_dead_letter(self):
+        """测试永久性错误和次数用尽时进入dead状态"""
+        permanent_id = self._enqueue()
+        delivery = claim(self.db_path, owner='a')
+        self.assertIsNone(mark_failed(self.db_path, delivery, '535 auth failed', transient=False))
+        self.assertEqual(get_delivery(self.db_path, permanent_id)['status'], 'dead')
+
+        exhausted_id = self._enqueue(max_attempts=1)
+        delivery = claim(self.db_path, owner='a')
+        self.assertIsNone(mark_failed(self.db_path, delivery, 'timeout', transient=True))
+        self.assertEqual(get_delivery(self.db_path, exhausted_id)['status'], 'dead')
+
+    def test_backoff_grows_with_cap(self):
+        """测试退避时间随次数增长且有上限"""
+        for attempts in range(1, 12):
+            delay = backoff_delay(attempts, base=30, cap=3600)
+            expected = min(3600, 30 * 2 ** (attempts - 1))
+            self.assertGreaterEqual(delay, expected / 2)
+            self.assertLessEqual(delay, expected)
+    
+    def test_defer_keeps_attempts(self):
+        """测试推迟发送放回队列，不计入尝试次数"""
+        delivery_id = self._enqueue(convert_pdf=True)
+        delivery = claim(self.db_path, owner='a')
+        
+        until = time.time() + 60
+        self.assertTrue(defer(self.db_path, delivery, until, filepath='/tmp/book.epub'))
+        row = get_delivery(self.db_path, delivery_id)
+        self.assertEqual(row['status'], 'pending')
+        self.assertEqual(row['attempts'], 0)
+        self.assertEqual(row['filepath'], '/tmp/book.epub')
+        self.assertEqual(row['convert_pdf'], 0)
+        
+        self.assertIsNone(claim(self.db_path, owner='a'))
+        with patch('app.utils.delivery_queue.time.time', return_value=until):
+            self.assertEqual(claim(self.db_path, owner='a')['attempts'], 1)
+    
+    def test_expired_lease_without_attempts_left(self):
+        """测试尝试次数用尽后租约过期的任务进入 dead 状态，不再被领取"""
+        delivery_id = self._enqueue(max_attempts=2)
+        claim(self.db_path, owner='a', lease_seconds=-1)
+        claim(self.db_path, owner='b', lease_seconds=-1)
+
+        dead = []
+        self.assertIsNone(claim(self.db_path, owner='c', on_dead=dead.append))
+        self.assertEqual([delivery['id'] for delivery in dead], [delivery_id])
+        delivery = get_delivery(self.db_path, delivery_id)
+        self.assertEqual((delivery['status'], delivery['attempts']), ('dead', 2))
+        self.assertIsNone(delivery['lease_owner'])
+
+    def test_claim_batch_same_recipient(self):
+        """测试批量领取只包含同一Kindle邮箱的到期任务，且不超过上限"""
+        first = self._enqueue()
+        enqueue(self.db_path, '/tmp/other.pdf', 'other.pdf', 'other@kindle.com')
+        same = [self._enqueue() for _ in range(3)]
+        
+        deliveries = claim_batch(self.db_path, owner='a', limit=3)
+        self.assertEqual([d['id'] for d in deliveries], [first] + same[:2])
+        self.assertTrue(all(d['status'] == 'leased' and d['attempts'] == 1 for d in deliveries))
+        
+        # 剩下的任务从其他邮箱中最早到期的开始领取
+        deliveries = claim_batch(self.db_path, owner='b', limit=3)
+        self.assertEqual([d['kindle_email'] for d in deliveries], ['other@kindle.com'])
+        self.assertEqual([d['id'] for d in claim_batch(self.db_path, owner='b', limit=3)], same[2:])
+        self.assertEqual(claim_batch(self.db_path, owner='b', limit=3), [])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
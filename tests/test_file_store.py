@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内容寻址存储测试文件
+"""
+import unittest
+import os
+import sys
+import errno
+import hashlib
+import tempfile
+import shutil
+from io import BytesIO
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.file_store import (
+    SpooledUpload,
+    store_stream,
+    find_blob,
+    move_file,
+    get_store_dir
+)
+
+
+class TestFileStore(unittest.TestCase):
+    """测试上传文件的存储、去重和暂存"""
+    
+    def setUp(self):
+        """测试前的设置"""
+        self.upload_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.upload_dir):
+            shutil.rmtree(self.upload_dir)
+    
+    def test_store_stream_deduplicates(self):
+        """测试相同内容只保存一份"""
+        content = b'Kindle book content' * 1000
+        
+        _, first, stats1 = store_stream(BytesIO(content), self.upload_dir, 'a.epub')
+        _, second, stats2 = store_stream(BytesIO(content), self.upload_dir, 'b.epub')
+        
+        self.assertEqual(stats1['sha256'], hashlib.sha256(content).hexdigest())
+        self.assertFalse(stats1['deduplicated'])
+        self.assertTrue(stats2['deduplicated'])
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertIsNotNone(find_blob(self.upload_dir, stats1['sha256']))
+    
+    def test_spooled_upload_commit(self):
+        """测试暂存文件边写边计算摘要，提交后暂存区为空"""
+        spool = SpooledUpload(self.upload_dir)
+        spool.write(b'part one, ')
+        spool.write(b'part two')
+        spool.seek(0)
+        
+        filename, filepath, stats = spool.commit('书名.txt')
+        spool.close()
+        
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'part one, part two')
+        self.assertEqual(stats['bytes'], 18)
+        self.assertEqual(stats['sha256'], hashlib.sha256(b'part one, part two').hexdigest())
+        self.assertIn('书名', filename)
+        self.assertEqual(os.listdir(os.path.join(get_store_dir(self.upload_dir), 'tmp')), [])
+    
+    def test_spooled_upload_discarded(self):
+        """测试未提交的暂存文件在关闭时删除"""
+        spool = SpooledUpload(self.upload_dir)
+        spool.write(b'rejected upload')
+        spool.close()
+        
+        self.assertFalse(os.path.exists(spool.name))
+    
+    def test_move_file_cross_device(self):
+        """测试跨文件系统时退化为复制"""
+        src = os.path.join(self.upload_dir, 'src.bin')
+        dest = os.path.join(self.upload_dir, 'dest.bin')
+        with open(src, 'wb') as f:
+            f.write(b'x' * 100000)
+        
+        real_replace = os.replace
+        calls = []
+        
+        def fake_replace(a, b):
+            # 第一次重命名模拟跨设备失败，之后的重命名正常执行
+            calls.append((a, b))
+            if len(calls) == 1:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            real_replace(a, b)
+        
+        with patch('os.replace', side_effect=fake_replace):
+            move_file(src, dest)
+        
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(os.path.exists(src))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 100000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台任务状态存储测试文件
+"""
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.job_store import create_job, load_job, update_job
+
+
+class TestJobStore(unittest.TestCase):
+    """测试任务状态的并发更新"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_concurrent_updates_keep_all_fields(self):
+        """测试多个线程同时更新同一任务时不丢失字段"""
+        job = create_job(self.test_dir, 'book.pdf')
+        barrier = threading.Barrier(16)
+
+        def update(index):
+            barrier.wait()
+            for step in range(10):
+                update_job(self.test_dir, job['job_id'], timings={f'worker{index}': step},
+                           **{f'field{index}': step})
+
+        threads = [threading.Thread(target=update, args=(index,)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        saved = load_job(self.test_dir, job['job_id'])
+        for index in range(16):
+            self.assertEqual(saved[f'field{index}'], 9)
+            self.assertEqual(saved['timings'][f'worker{index}'], 9)
+
+    def test_cancelled_status_is_final(self):
+        """测试已取消的任务不会被执行线程稍后的更新改回其他状态"""
+        job = create_job(self.test_dir, 'book.pdf')
+        update_job(self.test_dir, job['job_id'], status='cancelled', error='任务已取消')
+        saved = update_job(self.test_dir, job['job_id'], status='queued', stage='throttled')
+        self.assertEqual((saved['status'], saved['stage']), ('cancelled', 'throttled'))
+
+        with self.assertRaises(ValueError):
+            update_job(self.test_dir, '0' * 32, status='running')
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
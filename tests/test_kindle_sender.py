@@ -16,7 +16,50 @@ from email.mime.multipart import MIMEMultipart
 # 添加项目根目录到系统路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.utils.kindle_sender import send_to_kindle, get_smtp_config
+from app.utils.kindle_sender import (
+    send_to_kindle,
+    send_to_kindle_recipients,
+    send_files_to_kindle,
+    pack_attachments,
+    get_smtp_config,
+    estimate_encoded_size,
+    max_attachment_size,
+    KINDLE_EMAIL_SIZE_LIMIT,
+    MESSAGE_OVERHEAD,
+    ATTACHMENT_OVERHEAD
+)
+from app.utils.smtp_pool import reset_smtp_pool, get_smtp_pool, get_ssl_context, SOCKET_TIMEOUT
+
+
+def mock_smtp_server():
+    """模拟已连接的SMTP服务器，各命令返回成功"""
+    server = MagicMock()
+    server.has_extn.return_value = False
+    server.mail.return_value = (250, b'OK')
+    server.rcpt.return_value = (250, b'OK')
+    server.docmd.return_value = (354, b'End data with <CR><LF>.<CR><LF>')
+    server.getreply.return_value = (250, b'Queued')
+    return server
+
+
+def sent_message(server):
+    """取出通过DATA写入连接的邮件内容"""
+    data = b''.join(c[0][0] for c in server.send.call_args_list)
+    return data.decode('ascii')
+
+
+def chunked_message(server):
+    """取出通过BDAT分块写入连接的邮件内容，返回 (邮件内容, 各块大小)"""
+    data = b''.join(c[0][0] for c in server.send.call_args_list)
+    message = b''
+    chunks = []
+    while data:
+        command, data = data.split(b'\r\n', 1)
+        size = int(command.split()[1])
+        message += data[:size]
+        data = data[size:]
+        chunks.append(size)
+    return message, chunks
 
 
 class TestKindleSender(unittest.TestCase):
@@ -40,9 +83,13 @@ class TestKindleSender(unittest.TestCase):
             'smtp_server': 'smtp.163.com',
             'smtp_port': 465
         }
+        
+        # 每个测试使用空的连接池
+        reset_smtp_pool()
     
     def tearDown(self):
         """测试后的清理"""
+        reset_smtp_pool()
         if os.path.exists(self.test_dir):
             shutil.rmtree(self.test_dir)
     
@@ -92,7 +139,7 @@ class TestKindleSender(unittest.TestCase):
     def test_send_to_kindle_success_ssl(self, mock_smtp_ssl):
         """测试成功发送邮件（SSL连接）"""
         # 设置模拟SMTP服务器
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -107,22 +154,24 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 验证SMTP调用
-        mock_smtp_ssl.assert_called_once_with('smtp.163.com', 465)
+        mock_smtp_ssl.assert_called_once_with('smtp.163.com', 465, timeout=SOCKET_TIMEOUT,
+                                              context=get_ssl_context())
         mock_server.login.assert_called_once_with('sender@163.com', 'test_password')
-        mock_server.sendmail.assert_called_once()
-        mock_server.quit.assert_called_once()
+        mock_server.mail.assert_called_once()
+        # 连接放回池中，不立即断开
+        mock_server.quit.assert_not_called()
         
         # 验证发送参数
-        send_args = mock_server.sendmail.call_args[0]
-        self.assertEqual(send_args[0], 'sender@163.com')  # 发送者
-        self.assertEqual(send_args[1], 'test@kindle.com')  # 接收者
-        self.assertIsInstance(send_args[2], str)  # 邮件内容
+        self.assertEqual(mock_server.mail.call_args[0][0], 'sender@163.com')  # 发送者
+        mock_server.rcpt.assert_called_once_with('test@kindle.com')  # 接收者
+        email_content = sent_message(mock_server)  # 邮件内容
+        self.assertTrue(email_content.endswith('\r\n.\r\n'))
     
     @patch('smtplib.SMTP')
     def test_send_to_kindle_success_tls(self, mock_smtp):
         """测试成功发送邮件（TLS连接）"""
         # 设置模拟SMTP服务器
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp.return_value = mock_server
         
         result = send_to_kindle(
@@ -137,11 +186,11 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 验证SMTP调用
-        mock_smtp.assert_called_once_with('smtp.qq.com', 587)
-        mock_server.starttls.assert_called_once()
+        mock_smtp.assert_called_once_with('smtp.qq.com', 587, timeout=SOCKET_TIMEOUT)
+        mock_server.starttls.assert_called_once_with(context=get_ssl_context())
         mock_server.login.assert_called_once_with('sender@qq.com', 'test_password')
-        mock_server.sendmail.assert_called_once()
-        mock_server.quit.assert_called_once()
+        mock_server.mail.assert_called_once()
+        mock_server.quit.assert_not_called()
     
     def test_send_to_kindle_file_not_exists(self):
         """测试发送不存在的文件"""
@@ -182,7 +231,7 @@ class TestKindleSender(unittest.TestCase):
     def test_send_to_kindle_auth_error(self, mock_smtp_ssl):
         """测试认证失败的情况"""
         # 模拟认证错误
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_server.login.side_effect = smtplib.SMTPAuthenticationError(535, b'Authentication failed')
         mock_smtp_ssl.return_value = mock_server
         
@@ -202,8 +251,8 @@ class TestKindleSender(unittest.TestCase):
     def test_send_to_kindle_smtp_exception(self, mock_smtp_ssl):
         """测试SMTP异常"""
         # 模拟SMTP异常
-        mock_server = MagicMock()
-        mock_server.sendmail.side_effect = smtplib.SMTPException('SMTP error')
+        mock_server = mock_smtp_server()
+        mock_server.mail.side_effect = smtplib.SMTPException('SMTP error')
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -237,7 +286,7 @@ class TestKindleSender(unittest.TestCase):
     @patch('smtplib.SMTP_SSL')
     def test_send_with_custom_subject(self, mock_smtp_ssl):
         """测试自定义邮件主题"""
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -253,8 +302,7 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 验证邮件内容包含自定义主题
-        send_args = mock_server.sendmail.call_args[0]
-        email_content = send_args[2]
+        email_content = sent_message(mock_server)
         self.assertIn('Subject: Custom Subject', email_content)
     
     @patch('smtplib.SMTP_SSL')
@@ -265,7 +313,7 @@ class TestKindleSender(unittest.TestCase):
         with open(chinese_file, 'wb') as f:
             f.write(b'Chinese EPUB content')
         
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -280,18 +328,17 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 验证邮件发送
-        mock_server.sendmail.assert_called_once()
+        mock_server.mail.assert_called_once()
         
         # 验证邮件内容包含文件名
-        send_args = mock_server.sendmail.call_args[0]
-        email_content = send_args[2]
+        email_content = sent_message(mock_server)
         # 中文文件名应该被正确编码
         self.assertIsInstance(email_content, str)
     
     @patch('smtplib.SMTP_SSL')
     def test_send_with_convert_subject(self, mock_smtp_ssl):
         """测试使用convert主题（Kindle自动转换）"""
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -307,14 +354,13 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 验证邮件主题
-        send_args = mock_server.sendmail.call_args[0]
-        email_content = send_args[2]
+        email_content = sent_message(mock_server)
         self.assertIn('Subject: convert', email_content)
     
     @patch('smtplib.SMTP_SSL')
     def test_email_structure(self, mock_smtp_ssl):
         """测试邮件结构"""
-        mock_server = MagicMock()
+        mock_server = mock_smtp_server()
         mock_smtp_ssl.return_value = mock_server
         
         result = send_to_kindle(
@@ -329,8 +375,7 @@ class TestKindleSender(unittest.TestCase):
         self.assertTrue(result)
         
         # 获取发送的邮件内容
-        send_args = mock_server.sendmail.call_args[0]
-        email_content = send_args[2]
+        email_content = sent_message(mock_server)
         
         # 验证邮件头
         self.assertIn('From: sender@163.com', email_content)
@@ -344,6 +389,304 @@ class TestKindleSender(unittest.TestCase):
         # 验证附件
         self.assertIn('test.epub', email_content)
 
+    def test_encoded_size_limit(self):
+        """测试base64编码后的大小估算和可发送的最大附件"""
+        import base64
+        for size in (0, 1, 56, 57, 58, 1000, 123457):
+            encoded = base64.encodebytes(b'x' * size).replace(b'\n', b'\r\n')
+            self.assertEqual(estimate_encoded_size(size), len(encoded))
+        
+        limit = max_attachment_size()
+        self.assertLess(limit, KINDLE_EMAIL_SIZE_LIMIT * 3 // 4)
+        self.assertLessEqual(estimate_encoded_size(limit), KINDLE_EMAIL_SIZE_LIMIT)
+    
+    def _send(self):
+        return send_to_kindle(
+            kindle_email=self.test_config['kindle_email'],
+            sender_email=self.test_config['sender_email'],
+            sender_password=self.test_config['sender_password'],
+            file_path=self.test_file,
+            smtp_server=self.test_config['smtp_server'],
+            smtp_port=self.test_config['smtp_port']
+        )
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_streamed_attachment(self, mock_smtp_ssl):
+        """测试附件分块编码后与原文件一致"""
+        import email
+        mock_server = mock_smtp_server()
+        mock_server.has_extn.side_effect = lambda name: name == 'size'
+        mock_smtp_ssl.return_value = mock_server
+        
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.test_file, 'wb') as f:
+            f.write(content)
+        
+        self.assertTrue(self._send())
+        
+        # 附件按块写入连接，不会一次性生成整封邮件
+        self.assertGreater(mock_server.send.call_count, 3)
+        raw = sent_message(mock_server)
+        self.assertIn(f'SIZE={len(raw) - 3}', mock_server.mail.call_args[0][1])
+        
+        message = email.message_from_string(raw[:-3])
+        attachment = message.get_payload()[1]
+        self.assertEqual(attachment.get_filename(), 'test.epub')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_connection_reused(self, mock_smtp_ssl):
+        """测试连续发送复用已登录的连接"""
+        mock_server = mock_smtp_server()
+        mock_server.rset.return_value = (250, b'OK')
+        mock_smtp_ssl.return_value = mock_server
+        
+        self.assertTrue(self._send())
+        self.assertTrue(self._send())
+        
+        mock_smtp_ssl.assert_called_once()
+        mock_server.login.assert_called_once()
+        mock_server.rset.assert_called_once()
+        self.assertEqual(mock_server.mail.call_count, 2)
+        
+        reset_smtp_pool()
+        mock_server.quit.assert_called_once()
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_stale_connection_reconnects(self, mock_smtp_ssl):
+        """测试复用的连接已被服务器断开时自动重新连接"""
+        stale_server = mock_smtp_server()
+        stale_server.rset.return_value = (250, b'OK')
+        fresh_server = mock_smtp_server()
+        mock_smtp_ssl.side_effect = [stale_server, fresh_server]
+        
+        self.assertTrue(self._send())
+        
+        # 连接在RSET之后、发送过程中断开
+        stale_server.send.side_effect = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.assertTrue(self._send())
+        
+        self.assertEqual(mock_smtp_ssl.call_count, 2)
+        fresh_server.login.assert_called_once()
+        fresh_server.mail.assert_called_once()
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_failed_health_check_reconnects(self, mock_smtp_ssl):
+        """测试RSET失败的空闲连接被丢弃"""
+        stale_server = mock_smtp_server()
+        stale_server.rset.side_effect = smtplib.SMTPServerDisconnected()
+        fresh_server = mock_smtp_server()
+        mock_smtp_ssl.side_effect = [stale_server, fresh_server]
+        
+        self.assertTrue(self._send())
+        self.assertTrue(self._send())
+        
+        stale_server.mail.assert_called_once()
+        fresh_server.mail.assert_called_once()
+
+    def test_pack_attachments(self):
+        """测试附件按编码后大小装进尽量少的邮件"""
+        limit = MESSAGE_OVERHEAD + 4 * (estimate_encoded_size(3000) + ATTACHMENT_OVERHEAD)
+        sizes = [6000, 3000, 9000, 3000, 3000, 3000]
+        bins = pack_attachments(sizes, limit=limit)
+        
+        self.assertEqual(sorted(i for group in bins for i in group), list(range(len(sizes))))
+        self.assertEqual(len(bins), 3)
+        for group in bins:
+            used = sum(estimate_encoded_size(sizes[i]) + ATTACHMENT_OVERHEAD for i in group)
+            self.assertLessEqual(used, limit - MESSAGE_OVERHEAD)
+        
+        # 附件数量上限
+        self.assertEqual(len(pack_attachments([10] * 30, max_count=25)), 2)
+        # 超过限制的附件单独成一封
+        self.assertIn([1], pack_attachments([10, limit], limit=limit))
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_send_files_merged(self, mock_smtp_ssl):
+        """测试多个文件合并成一封邮件发送，缺失的文件单独报错"""
+        import email
+        mock_server = mock_smtp_server()
+        mock_smtp_ssl.return_value = mock_server
+        
+        contents = {}
+        paths = []
+        for name in ('a.epub', 'b.pdf', '中文.txt'):
+            path = os.path.join(self.test_dir, name)
+            contents[name] = os.urandom(1000)
+            with open(path, 'wb') as f:
+                f.write(contents[name])
+            paths.append(path)
+        paths.insert(1, os.path.join(self.test_dir, 'missing.epub'))
+        
+        errors = send_files_to_kindle(
+            kindle_email=self.test_config['kindle_email'],
+            sender_email=self.test_config['sender_email'],
+            sender_password=self.test_config['sender_password'],
+            file_paths=paths
+        )
+        
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], OSError)
+        self.assertEqual(errors[2:], [None, None])
+        mock_server.mail.assert_called_once()
+        
+        message = email.message_from_string(sent_message(mock_server)[:-3])
+        attachments = {part.get_filename(): part.get_payload(decode=True)
+                       for part in message.get_payload()[1:]}
+        self.assertEqual(attachments, contents)
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_send_files_rejected_message(self, mock_smtp_ssl):
+        """测试某封邮件被拒绝时只影响该邮件中的文件"""
+        mock_server = mock_smtp_server()
+        mock_server.getreply.side_effect = [(552, b'Message too large'), (250, b'OK')]
+        mock_smtp_ssl.return_value = mock_server
+        
+        with patch('app.utils.kindle_sender.pack_attachments',
+                   side_effect=lambda sizes, **kwargs: [[i] for i in range(len(sizes))]):
+            errors = send_files_to_kindle(
+                kindle_email=self.test_config['kindle_email'],
+                sender_email=self.test_config['sender_email'],
+                sender_password=self.test_config['sender_password'],
+                file_paths=[self.test_file, self.test_file]
+            )
+        
+        self.assertIsInstance(errors[0], smtplib.SMTPDataError)
+        self.assertIsNone(errors[1])
+        self.assertEqual(mock_server.mail.call_count, 2)
+
+    @patch('smtplib.SMTP_SSL')
+    def test_send_to_multiple_recipients(self, mock_smtp_ssl):
+        """测试多个Kindle邮箱在同一个事务中发送，被拒绝的邮箱单独报错"""
+        mock_server = mock_smtp_server()
+        mock_server.rcpt.side_effect = [(250, b'OK'), (550, b'No such user'), (250, b'OK')]
+        mock_smtp_ssl.return_value = mock_server
+        recipients = ['a@kindle.com', 'b@kindle.com', 'c@kindle.com']
+        
+        results = send_to_kindle_recipients(
+            kindle_emails=recipients,
+            sender_email=self.test_config['sender_email'],
+            sender_password=self.test_config['sender_password'],
+            file_path=self.test_file
+        )
+        
+        self.assertIsNone(results['a@kindle.com'])
+        self.assertIsInstance(results['b@kindle.com'], smtplib.SMTPRecipientsRefused)
+        self.assertIsNone(results['c@kindle.com'])
+        # 附件只传输一次
+        mock_server.mail.assert_called_once()
+        self.assertEqual([c[0][0] for c in mock_server.rcpt.call_args_list], recipients)
+        self.assertIn('To: a@kindle.com, b@kindle.com, c@kindle.com', sent_message(mock_server))
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_send_to_multiple_recipients_all_refused(self, mock_smtp_ssl):
+        """测试所有Kindle邮箱都被拒绝时不发送邮件内容"""
+        mock_server = mock_smtp_server()
+        mock_server.rcpt.return_value = (550, b'No such user')
+        mock_smtp_ssl.return_value = mock_server
+        
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            send_to_kindle_recipients(
+                kindle_emails=['a@kindle.com', 'b@kindle.com'],
+                sender_email=self.test_config['sender_email'],
+                sender_password=self.test_config['sender_password'],
+                file_path=self.test_file,
+                raise_on_error=True
+            )
+        mock_server.send.assert_not_called()
+
+    @patch('smtplib.SMTP_SSL')
+    def test_binary_transfer(self, mock_smtp_ssl):
+        """测试服务器支持CHUNKING和BINARYMIME时附件以原始字节通过BDAT发送"""
+        import email
+        from app.utils.mime_stream import BDAT_CHUNK_SIZE
+        mock_server = mock_smtp_server()
+        mock_server.has_extn.side_effect = lambda name: name in ('size', 'chunking', 'binarymime')
+        mock_smtp_ssl.return_value = mock_server
+        
+        content = os.urandom(BDAT_CHUNK_SIZE + 1000) + b'\r\n.\r\n'
+        with open(self.test_file, 'wb') as f:
+            f.write(content)
+        self.assertTrue(self._send())
+        
+        options = mock_server.mail.call_args[0][1]
+        self.assertIn('BODY=BINARYMIME', options)
+        mock_server.docmd.assert_not_called()
+        message, chunks = chunked_message(mock_server)
+        self.assertIn(f'SIZE={len(message)}', options)
+        # 附件按 BDAT_CHUNK_SIZE 分块，最后一块为结尾的分隔行
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(size <= BDAT_CHUNK_SIZE for size in chunks))
+        last_command = [c[0][0] for c in mock_server.send.call_args_list][-2]
+        self.assertEqual(last_command, f'BDAT {chunks[-1]} LAST\r\n'.encode('ascii'))
+        
+        attachment = email.message_from_bytes(message).get_payload()[1]
+        self.assertEqual(attachment['Content-Transfer-Encoding'], 'binary')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+    
+    @patch('smtplib.SMTP_SSL')
+    def test_size_limit_follows_transfer_encoding(self, mock_smtp_ssl):
+        """测试大小限制按实际使用的编码计算：base64编码后超限的文件可以用二进制发送"""
+        from app.utils import mime_stream
+        size = max_attachment_size() + 1024 * 1024
+        with open(self.test_file, 'wb') as f:
+            f.truncate(size)
+        self.assertLessEqual(size, max_attachment_size(binary=True))
+        
+        with patch.dict(mime_stream._binary_servers, clear=True):
+            base64_server = mock_smtp_server()
+            mock_smtp_ssl.return_value = base64_server
+            self.assertFalse(self._send())
+            base64_server.mail.assert_not_called()
+            
+            # 已知服务器不支持二进制传输时不再连接
+            mock_smtp_ssl.reset_mock()
+            reset_smtp_pool()
+            self.assertFalse(self._send())
+            mock_smtp_ssl.assert_not_called()
+            
+            binary_server = mock_smtp_server()
+            binary_server.has_extn.side_effect = lambda name: name in ('chunking', 'binarymime')
+            mock_smtp_ssl.return_value = binary_server
+            mime_stream._binary_servers.clear()
+            self.assertTrue(self._send())
+            self.assertLess(len(chunked_message(binary_server)[0]) - size, 16 * 1024)
+
+    @patch('smtplib.SMTP_SSL')
+    def test_prewarm(self, mock_smtp_ssl):
+        """测试预先建立的连接在第一次发送时直接复用"""
+        mock_server = mock_smtp_server()
+        mock_server.rset.return_value = (250, b'OK')
+        mock_smtp_ssl.return_value = mock_server
+        
+        get_smtp_pool().prewarm('smtp.163.com', 465, self.test_config['sender_email'],
+                                self.test_config['sender_password'])
+        mock_server.login.assert_called_once()
+        
+        self.assertTrue(self._send())
+        mock_smtp_ssl.assert_called_once()
+        mock_server.login.assert_called_once()
+        mock_server.mail.assert_called_once()
+    
+    def test_tls_session_resumed(self):
+        """测试新的TLS连接带上同一服务器上次保存的会话"""
+        import ssl
+        from app.utils import smtp_pool
+        session = MagicMock(spec=ssl.SSLSession)
+        ssl_sock = MagicMock(session=session)
+        
+        with patch.dict(smtp_pool._tls_sessions, clear=True), \
+                patch('ssl.SSLContext.wrap_socket') as mock_wrap:
+            smtp_pool.remember_tls_session('smtp.163.com', ssl_sock)
+            smtp_pool.remember_tls_session('smtp.qq.com', MagicMock(session=None))
+            self.assertEqual(smtp_pool._tls_sessions, {'smtp.163.com': session})
+            
+            context = get_ssl_context()
+            self.assertIs(context, get_ssl_context())
+            context.wrap_socket(MagicMock(), server_hostname='smtp.163.com')
+            self.assertIs(mock_wrap.call_args[1]['session'], session)
+            context.wrap_socket(MagicMock(), server_hostname='smtp.qq.com')
+            self.assertIsNone(mock_wrap.call_args[1]['session'])
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
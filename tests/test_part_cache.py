@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+已编码附件缓存测试文件
+"""
+import unittest
+import os
+import sys
+import time
+import socket
+import tempfile
+import shutil
+import threading
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.part_cache import PartCache, configure_part_cache, get_part_cache
+from app.utils.mime_stream import build_message_frame, iter_message, send_message_stream
+
+
+class TestPartCache(unittest.TestCase):
+    """测试附件缓存的索引、淘汰和发送时的使用"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.test_dir, 'cache')
+
+    def tearDown(self):
+        """测试后的清理"""
+        configure_part_cache(self.cache_dir, 0)
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _file(self, name, content):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return Path(path)
+
+    def _frame(self, path):
+        return build_message_frame('sender@163.com', 'test@kindle.com', 'convert', path, path.stat().st_size)
+
+    def _cached_parts(self):
+        return sorted(name for name in os.listdir(self.cache_dir) if name.endswith('.part'))
+
+    def test_key_uses_content_and_filename(self):
+        """测试缓存键由文件内容和附件头（文件名）决定"""
+        cache = PartCache(self.cache_dir)
+        a = self._file('a.pdf', b'same content')
+        b = self._file('b.pdf', b'same content')
+        self.assertEqual(cache.key(a, b'header-a'), cache.key(b, b'header-a'))
+        self.assertNotEqual(cache.key(a, b'header-a'), cache.key(a, b'header-b'))
+
+        with open(b, 'wb') as f:
+            f.write(b'other content!')
+        self.assertNotEqual(cache.key(a, b'header-a'), cache.key(b, b'header-a'))
+
+    def test_repeat_send_uses_cache(self):
+        """测试再次发送相同文件时直接使用缓存的附件部分，邮件内容不变"""
+        configure_part_cache(self.cache_dir)
+        path = self._file('书.pdf', os.urandom(300 * 1024 + 7))
+        frame = self._frame(path)
+
+        first = b''.join(iter_message(frame))
+        self.assertEqual(len(first), frame.size)
+        self.assertEqual(len(self._cached_parts()), 1)
+
+        with patch('app.utils.mime_stream.iter_encoded_file') as mock_encode:
+            second = b''.join(iter_message(frame))
+        mock_encode.assert_not_called()
+        self.assertEqual(second, first)
+
+    def test_interrupted_send_not_cached(self):
+        """测试发送中断时不保存不完整的缓存"""
+        configure_part_cache(self.cache_dir)
+        path = self._file('book.pdf', os.urandom(3 * 1024 * 1024))
+        server = MagicMock()
+        server.has_extn.return_value = False
+        server.mail.return_value = (250, b'OK')
+        server.rcpt.return_value = (250, b'OK')
+        server.docmd.return_value = (354, b'go ahead')
+        server.send.side_effect = [None, None, OSError('connection reset')]
+
+        with self.assertRaises(OSError):
+            send_message_stream(server, 'sender@163.com', 'test@kindle.com', self._frame(path))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_cached_part_sent_with_sendfile(self):
+        """测试命中缓存时附件部分通过 socket.sendfile 写入连接"""
+        configure_part_cache(self.cache_dir)
+        path = self._file('book.pdf', os.urandom(100 * 1024))
+        frame = self._frame(path)
+        expected = b''.join(iter_message(frame))
+
+        local, remote = socket.socketpair()
+        received = []
+        reader = threading.Thread(target=lambda: received.append(_read_all(remote)))
+        reader.start()
+        server = MagicMock()
+        server.sock = local
+        server.has_extn.return_value = False
+        server.mail.return_value = (250, b'OK')
+        server.rcpt.return_value = (250, b'OK')
+        server.docmd.return_value = (354, b'go ahead')
+        server.getreply.return_value = (250, b'queued')
+        server.send.side_effect = local.sendall
+
+        progress = []
+        with patch.object(socket.socket, 'sendfile', autospec=True, side_effect=socket.socket.sendfile) as mock_sendfile:
+            send_message_stream(server, 'sender@163.com', 'test@kindle.com', frame,
+                                lambda sent, total: progress.append((sent, total)))
+        local.close()
+        reader.join(5)
+        remote.close()
+
+        mock_sendfile.assert_called_once()
+        self.assertEqual(received[0], expected + b'.\r\n')
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+    def test_lru_eviction(self):
+        """测试超过上限时删除最久未使用的缓存"""
+        cache = PartCache(self.cache_dir, max_bytes=2500)
+        for name in ('a', 'b'):
+            writer = cache.writer(name, 1000)
+            writer.write(b'x' * 1000)
+            writer.commit()
+        # a 比 b 旧，读取 a 后 b 成为最久未用
+        old = time.time() - 100
+        os.utime(os.path.join(self.cache_dir, 'a.part'), (old, old))
+        os.utime(os.path.join(self.cache_dir, 'b.part'), (old + 1, old + 1))
+        cache.open('a').close()
+
+        writer = cache.writer('c', 1000)
+        writer.write(b'x' * 1000)
+        writer.commit()
+        self.assertEqual(self._cached_parts(), ['a.part', 'c.part'])
+
+        # 超过上限的附件不缓存
+        writer = cache.writer('d', 3000)
+        writer.write(b'x' * 3000)
+        writer.commit()
+        self.assertIsNone(cache.open('d'))
+
+    def test_disabled(self):
+        """测试上限为0时不使用缓存"""
+        configure_part_cache(self.cache_dir, 0)
+        self.assertIsNone(get_part_cache())
+
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
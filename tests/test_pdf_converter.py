@@ -6,18 +6,32 @@ PDF转换器测试文件
 import unittest
 import os
 import sys
+import time
+import signal
 import tempfile
 import shutil
 from pathlib import Path
 from unittest.mock import patch, MagicMock, call
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 # 添加项目根目录到系统路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.utils.pdf_converter import (
     find_calibre,
     convert_pdf_to_epub,
-    convert_pdf_to_epub_docker
+    convert_pdf_to_epub_docker,
+    get_converter,
+    input_formats,
+    DEFAULT_INPUT_FORMATS,
+    run_converter,
+    ConversionLimits,
+    ConversionCancelled,
+    ConversionTimeout
 )
 
 
@@ -33,12 +47,30 @@ class TestPDFConverter(unittest.TestCase):
         # 创建测试PDF文件
         with open(self.test_pdf, 'wb') as f:
             f.write(b'%PDF-1.4\nTest PDF content')
+        
+        # 模拟的转换进程没有真实的pid，不设置 rlimit
+        self.limits_patcher = patch.object(ConversionLimits, 'apply')
+        self.limits_patcher.start()
     
     def tearDown(self):
         """测试后的清理"""
+        self.limits_patcher.stop()
         if os.path.exists(self.test_dir):
             shutil.rmtree(self.test_dir)
     
+    def _process(self, returncode, stderr='', output=None):
+        """模拟已结束的转换进程，指定 output 时像 ebook-convert 一样生成输出文件"""
+        process = MagicMock(returncode=returncode, pid=12345)
+        
+        def communicate(timeout=None):
+            if output is not None:
+                with open(output, 'wb') as f:
+                    f.write(b'EPUB content')
+            return '', stderr
+        
+        process.communicate.side_effect = communicate
+        return process
+    
     @patch('platform.system')
     @patch('subprocess.run')
     @patch('pathlib.Path.exists')
@@ -138,63 +170,49 @@ class TestPDFConverter(unittest.TestCase):
         self.assertEqual(result, self.test_pdf)
     
     @patch('app.utils.pdf_converter.find_calibre')
-    @patch('subprocess.run')
-    def test_convert_pdf_to_epub_success(self, mock_run, mock_find):
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_convert_pdf_to_epub_success(self, mock_run, mock_killpg, mock_find):
         """测试成功转换PDF到EPUB"""
         mock_find.return_value = '/usr/bin/ebook-convert'
         
+        expected_epub = os.path.join(self.test_dir, 'test.epub')
+        
         # 模拟转换成功
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = self._process(0, output=expected_epub)
         
-        # 创建预期的EPUB文件
-        expected_epub = os.path.join(self.test_dir, 'test.epub')
+        result = convert_pdf_to_epub(self.test_pdf)
         
-        with patch('pathlib.Path.exists') as mock_exists:
-            # 模拟EPUB文件生成
-            def exists_side_effect(path):
-                if str(path) == expected_epub:
-                    # 创建实际文件
-                    with open(expected_epub, 'wb') as f:
-                        f.write(b'EPUB content')
-                    return True
-                return os.path.exists(str(path))
-            
-            mock_exists.side_effect = exists_side_effect
-            
-            result = convert_pdf_to_epub(self.test_pdf)
-            
-            self.assertEqual(result, expected_epub)
-            
-            # 验证调用了正确的命令
-            expected_cmd = [
-                '/usr/bin/ebook-convert',
-                self.test_pdf,
-                expected_epub,
-                '--enable-heuristics',
-                '--margin-top', '20',
-                '--margin-bottom', '20',
-                '--margin-left', '20',
-                '--margin-right', '20',
-                '--pretty-print',
-                '--insert-blank-line',
-                '--language', 'zh-CN'
-            ]
-            
-            mock_run.assert_called_once()
-            actual_cmd = mock_run.call_args[0][0]
-            self.assertEqual(actual_cmd, expected_cmd)
+        self.assertEqual(result, expected_epub)
+        
+        # 验证调用了正确的命令
+        expected_cmd = [
+            '/usr/bin/ebook-convert',
+            self.test_pdf,
+            expected_epub,
+            '--enable-heuristics',
+            '--margin-top', '20',
+            '--margin-bottom', '20',
+            '--margin-left', '20',
+            '--margin-right', '20',
+            '--pretty-print',
+            '--insert-blank-line',
+            '--language', 'zh-CN'
+        ]
+        
+        mock_run.assert_called_once()
+        actual_cmd = mock_run.call_args[0][0]
+        self.assertEqual(actual_cmd, expected_cmd)
     
     @patch('app.utils.pdf_converter.find_calibre')
-    @patch('subprocess.run')
-    def test_convert_pdf_to_epub_failure(self, mock_run, mock_find):
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_convert_pdf_to_epub_failure(self, mock_run, mock_killpg, mock_find):
         """测试转换失败的情况"""
         mock_find.return_value = '/usr/bin/ebook-convert'
         
         # 模拟转换失败
-        mock_run.return_value = MagicMock(
-            returncode=1,
-            stderr='Conversion error'
-        )
+        mock_run.return_value = self._process(1, 'Conversion error')
         
         result = convert_pdf_to_epub(self.test_pdf)
         
@@ -209,40 +227,29 @@ class TestPDFConverter(unittest.TestCase):
         self.assertIsNone(result)
     
     @patch('app.utils.pdf_converter.find_calibre')
-    @patch('subprocess.run')
-    def test_convert_pdf_with_output_dir(self, mock_run, mock_find):
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_convert_pdf_with_output_dir(self, mock_run, mock_killpg, mock_find):
         """测试指定输出目录的转换"""
         mock_find.return_value = '/usr/bin/ebook-convert'
-        mock_run.return_value = MagicMock(returncode=0)
-        
-        # 创建输出目录
         output_dir = os.path.join(self.test_dir, 'output')
         expected_epub = os.path.join(output_dir, 'test.epub')
+        mock_run.return_value = self._process(0, output=expected_epub)
         
-        with patch('pathlib.Path.exists') as mock_exists:
-            def exists_side_effect(path):
-                if str(path) == expected_epub:
-                    # 创建输出目录和文件
-                    os.makedirs(output_dir, exist_ok=True)
-                    with open(expected_epub, 'wb') as f:
-                        f.write(b'EPUB content')
-                    return True
-                return os.path.exists(str(path))
-            
-            mock_exists.side_effect = exists_side_effect
-            
-            result = convert_pdf_to_epub(self.test_pdf, output_dir)
-            
-            self.assertEqual(result, expected_epub)
-            self.assertTrue(os.path.exists(output_dir))
+        result = convert_pdf_to_epub(self.test_pdf, output_dir)
+        
+        # 输出目录由转换函数创建
+        self.assertEqual(result, expected_epub)
+        self.assertTrue(os.path.exists(output_dir))
     
     @patch('app.utils.pdf_converter.find_calibre')
-    @patch('subprocess.run')
-    def test_convert_pdf_exception_handling(self, mock_run, mock_find):
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_convert_pdf_exception_handling(self, mock_run, mock_killpg, mock_find):
         """测试转换过程中的异常处理"""
         mock_find.return_value = '/usr/bin/ebook-convert'
         
-        # 模拟subprocess.run抛出异常
+        # 模拟启动转换进程时抛出异常
         mock_run.side_effect = Exception('Unexpected error')
         
         result = convert_pdf_to_epub(self.test_pdf)
@@ -257,32 +264,199 @@ class TestPDFConverter(unittest.TestCase):
         self.assertEqual(result, self.test_pdf)
     
     @patch('app.utils.pdf_converter.find_calibre')
-    @patch('subprocess.run')
-    def test_convert_with_chinese_filename(self, mock_run, mock_find):
+    @patch('os.killpg')
+    @patch('subprocess.Popen')
+    def test_convert_with_chinese_filename(self, mock_run, mock_killpg, mock_find):
         """测试中文文件名的处理"""
         mock_find.return_value = '/usr/bin/ebook-convert'
-        mock_run.return_value = MagicMock(returncode=0)
-        
         # 创建中文名称的PDF文件
         chinese_pdf = os.path.join(self.test_dir, '测试文档.pdf')
         with open(chinese_pdf, 'wb') as f:
             f.write(b'%PDF-1.4\nChinese PDF')
         
         expected_epub = os.path.join(self.test_dir, '测试文档.epub')
+        mock_run.return_value = self._process(0, output=expected_epub)
         
-        with patch('pathlib.Path.exists') as mock_exists:
-            def exists_side_effect(path):
-                if str(path) == expected_epub:
-                    with open(expected_epub, 'wb') as f:
-                        f.write(b'EPUB content')
-                    return True
-                return os.path.exists(str(path))
-            
-            mock_exists.side_effect = exists_side_effect
-            
-            result = convert_pdf_to_epub(chinese_pdf)
+        result = convert_pdf_to_epub(chinese_pdf)
+        
+        self.assertEqual(result, expected_epub)
+
+
+@unittest.skipUnless(os.name == 'posix', '测试用的转换程序是shell脚本')
+class TestConverterDiscovery(unittest.TestCase):
+    """测试每个进程只查找一次Calibre，程序文件变化时才重新查找"""
+    
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.calibre_path = self._script('ebook-convert', 'echo "ebook-convert (calibre 7.0.0)"')
+        cached = patch('app.utils.pdf_converter._converter', None)
+        cached.start()
+        self.addCleanup(cached.stop)
+    
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+    
+    def _script(self, name, body):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\n{body}\n')
+        os.chmod(path, 0o755)
+        return path
+    
+    def test_probe_once(self):
+        """测试查找结果（路径、版本、输入格式）被缓存"""
+        self._script('calibre-debug', 'echo "EPUB PDF TXT"')
+        with patch('app.utils.pdf_converter.find_calibre', return_value=self.calibre_path) as mock_find:
+            converter = get_converter()
+            self.assertIs(get_converter(), converter)
+            self.assertEqual(mock_find.call_count, 1)
+        
+        self.assertTrue(converter['ready'])
+        self.assertEqual(converter['version'], 'ebook-convert (calibre 7.0.0)')
+        self.assertEqual(converter['input_formats'], ['epub', 'pdf', 'txt'])
+    
+    def test_reprobe_when_binary_changes(self):
+        """测试程序文件被删除或替换时重新查找，并重新查询版本"""
+        with patch('app.utils.pdf_converter.find_calibre', return_value=self.calibre_path) as mock_find:
+            get_converter()
+            os.remove(self.calibre_path)
+            self._script('ebook-convert', 'echo "ebook-convert (calibre 7.1.0)"')
+            converter = get_converter()
+            self.assertEqual(mock_find.call_count, 2)
+            self.assertEqual(converter['version'], 'ebook-convert (calibre 7.1.0)')
             
-            self.assertEqual(result, expected_epub)
+            os.remove(self.calibre_path)
+            mock_find.return_value = None
+            self.assertFalse(get_converter()['ready'])
+            # 未找到的结果同样缓存，除非要求刷新
+            get_converter()
+            self.assertEqual(mock_find.call_count, 3)
+            get_converter(refresh=True)
+            self.assertEqual(mock_find.call_count, 4)
+    
+    def test_input_formats_fallback(self):
+        """测试没有 calibre-debug 时使用默认的输入格式"""
+        self.assertEqual(input_formats(self.calibre_path), DEFAULT_INPUT_FORMATS)
+    
+    @patch('app.utils.pdf_converter.find_calibre')
+    def test_convert_uses_cached_converter(self, mock_find):
+        """测试转换时使用传入的转换器信息，不再查找Calibre"""
+        pdf_path = os.path.join(self.test_dir, 'book.pdf')
+        with open(pdf_path, 'wb') as f:
+            f.write(b'%PDF-1.4')
+        converter = {'ready': False, 'path': None, 'version': None, 'input_formats': [], 'probed_at': 0}
+        self.assertEqual(convert_pdf_to_epub(pdf_path, converter=converter), pdf_path)
+        mock_find.assert_not_called()
+
+
+@unittest.skipUnless(os.name == 'posix', '进程组和rlimit仅在POSIX系统下有效')
+class TestConversionSupervision(unittest.TestCase):
+    """用真实子进程测试转换的超时、取消和资源限制"""
+    
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.pid_file = os.path.join(self.test_dir, 'grandchild.pid')
+        grace = patch('app.utils.pdf_converter.KILL_GRACE', 1)
+        grace.start()
+        self.addCleanup(grace.stop)
+    
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+    
+    def _command(self, code):
+        return [sys.executable, '-c', code]
+    
+    def _spawn_grandchild(self, then):
+        """启动一个孙进程（记录其pid）后执行 then 的命令"""
+        return self._command(
+            'import subprocess, sys\n'
+            f'p = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])\n'
+            f'open({self.pid_file!r}, "w").write(str(p.pid))\n'
+            + then
+        )
+    
+    def _assert_grandchild_gone(self):
+        with open(self.pid_file) as f:
+            pid = int(f.read())
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.05)
+        self.fail('孙进程没有被终止')
+    
+    def test_normal_exit(self):
+        """测试正常结束时返回退出码和标准错误输出，残留的子进程被清理"""
+        returncode, stderr = run_converter(
+            self._spawn_grandchild('sys.stderr.write("warning")\nsys.exit(3)'),
+            ConversionLimits(timeout=30))
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stderr, 'warning')
+        self._assert_grandchild_gone()
+    
+    def test_timeout_kills_group(self):
+        """测试超过最长耗时时终止整个进程组"""
+        started = time.time()
+        with self.assertRaises(ConversionTimeout):
+            run_converter(self._spawn_grandchild('import time\ntime.sleep(60)'),
+                          ConversionLimits(timeout=1, cpu_seconds=0, memory_bytes=0))
+        self.assertLess(time.time() - started, 10)
+        self._assert_grandchild_gone()
+    
+    def test_ignored_sigterm(self):
+        """测试忽略 SIGTERM 的进程在宽限时间后被 SIGKILL"""
+        code = 'import signal, time\nsignal.signal(signal.SIGTERM, signal.SIG_IGN)\ntime.sleep(60)'
+        started = time.time()
+        with self.assertRaises(ConversionTimeout):
+            run_converter(self._command(code), ConversionLimits(timeout=0.5))
+        self.assertLess(time.time() - started, 10)
+    
+    def test_cancel(self):
+        """测试调用方取消时终止转换，启动前已取消时不启动进程"""
+        cancel_at = time.time() + 0.5
+        with self.assertRaises(ConversionCancelled):
+            run_converter(self._spawn_grandchild('import time\ntime.sleep(60)'),
+                          should_cancel=lambda: time.time() > cancel_at)
+        self._assert_grandchild_gone()
+        
+        with patch('subprocess.Popen') as mock_popen:
+            with self.assertRaises(ConversionCancelled):
+                run_converter(self._command('pass'), should_cancel=lambda: True)
+            mock_popen.assert_not_called()
+    
+    @unittest.skipUnless(hasattr(resource, 'prlimit'), '需要 prlimit')
+    def test_cpu_limit(self):
+        """测试CPU时间超过限制时进程被内核终止"""
+        returncode, _ = run_converter(self._command('while True: pass'),
+                                      ConversionLimits(timeout=30, cpu_seconds=1, memory_bytes=0))
+        self.assertIn(returncode, (-signal.SIGXCPU, -signal.SIGKILL))
+    
+    @unittest.skipUnless(hasattr(resource, 'prlimit'), '需要 prlimit')
+    def test_limits_inherited(self):
+        """测试启动后设置的限制由转换进程启动的子进程继承"""
+        code = ('import subprocess, sys\n'
+                'sys.exit(subprocess.run([sys.executable, "-c", "import resource, sys; '
+                'sys.stderr.write(str(resource.getrlimit(resource.RLIMIT_AS)[0]))"], '
+                'stderr=sys.stderr).returncode)')
+        returncode, stderr = run_converter(self._command(code),
+                                           ConversionLimits(timeout=30, memory_bytes=2 * 1024 ** 3))
+        self.assertEqual((returncode, stderr), (0, str(2 * 1024 ** 3)))
+    
+    @unittest.skipUnless(hasattr(resource, 'prlimit'), '需要 prlimit')
+    def test_memory_limit(self):
+        """测试内存超过限制时分配失败"""
+        returncode, stderr = run_converter(self._command('b = bytearray(512 * 1024 * 1024)'),
+                                           ConversionLimits(timeout=30, memory_bytes=256 * 1024 * 1024))
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('MemoryError', stderr)
 
 
 if __name__ == '__main__':
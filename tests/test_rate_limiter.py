@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发送速率限制测试文件
+"""
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.rate_limiter import RateLimits, reserve
+
+
+class TestRateLimiter(unittest.TestCase):
+    """测试发件账号的令牌桶"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, 'ratelimit.db')
+        self.now = 1000000.0
+        self.time_patcher = patch('app.utils.rate_limiter.time.time', side_effect=lambda: self.now)
+        self.time_patcher.start()
+
+    def tearDown(self):
+        """测试后的清理"""
+        self.time_patcher.stop()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_message_bucket(self):
+        """测试每分钟邮件数：允许突发到上限，之后按速率补充"""
+        limits = RateLimits(messages_per_minute=3, bytes_per_hour=0)
+        for _ in range(3):
+            self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 100, limits), 0)
+
+        wait = reserve(self.db_path, 'a@163.com', 1, 100, limits)
+        self.assertAlmostEqual(wait, 20, places=3)
+
+        self.now += 20
+        self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 100, limits), 0)
+        self.assertGreater(reserve(self.db_path, 'a@163.com', 1, 100, limits), 0)
+
+    def test_accounts_are_independent(self):
+        """测试不同发件账号（不区分大小写）各自计数"""
+        limits = RateLimits(messages_per_minute=1, bytes_per_hour=0)
+        self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 0, limits), 0)
+        self.assertEqual(reserve(self.db_path, 'b@qq.com', 1, 0, limits), 0)
+        self.assertGreater(reserve(self.db_path, 'A@163.com', 1, 0, limits), 0)
+
+    def test_byte_bucket(self):
+        """测试每小时字节数，令牌不足时不扣减"""
+        limits = RateLimits(messages_per_minute=0, bytes_per_hour=3600)
+        self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 3000, limits), 0)
+
+        wait = reserve(self.db_path, 'a@163.com', 1, 1000, limits)
+        self.assertAlmostEqual(wait, 400, places=3)
+        self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 600, limits), 0)
+
+    def test_oversized_request_waits_for_full_bucket(self):
+        """测试超过桶容量的请求在桶满时放行，之后按欠额等待"""
+        limits = RateLimits(messages_per_minute=0, bytes_per_hour=3600)
+        self.assertEqual(reserve(self.db_path, 'a@163.com', 1, 7200, limits), 0)
+        self.assertAlmostEqual(reserve(self.db_path, 'a@163.com', 1, 1, limits), 3601, places=3)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
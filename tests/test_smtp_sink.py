@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模拟SMTP服务器和发送吞吐量测试脚本的测试文件
+"""
+import unittest
+import os
+import sys
+import time
+import email
+import smtplib
+import tempfile
+import shutil
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.kindle_sender import send_to_kindle
+from app.utils.smtp_pool import reset_smtp_pool
+from tests.smtp_sink import FakeSMTPServer, plain_connections
+from tests.benchmark_delivery import run_benchmark, percentile
+
+
+class TestSMTPSink(unittest.TestCase):
+    """通过模拟服务器测试真实的 smtplib 发送流程"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+        self.server = FakeSMTPServer(users={'sender@163.com': 'secret'}, seed=0)
+        self.plain = plain_connections()
+        self.plain.__enter__()
+        reset_smtp_pool()
+
+    def tearDown(self):
+        """测试后的清理"""
+        reset_smtp_pool()
+        self.plain.__exit__(None, None, None)
+        self.server.close()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _file(self, name, content):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _send(self, path, password='secret'):
+        return send_to_kindle('test@kindle.com', 'sender@163.com', password, path,
+                              smtp_server=self.server.host, smtp_port=self.server.port, raise_on_error=True)
+
+    def test_send_end_to_end(self):
+        """测试附件经过编码、点填充和发送后与原文件一致"""
+        content = os.urandom(200 * 1024) + b'\r\n.\r\n..\r\n'
+        path = self._file('书.pdf', content)
+        self.assertTrue(self._send(path))
+
+        self.assertEqual(self.server.message_count, 1)
+        user, data = self.server.messages[0]
+        self.assertEqual(user, 'sender@163.com')
+        attachment = email.message_from_bytes(data).get_payload()[1]
+        self.assertEqual(attachment.get_filename(), '书.pdf')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+
+    def test_binary_end_to_end(self):
+        """测试服务器支持BINARYMIME时附件原样通过BDAT发送"""
+        self.server.binary = True
+        content = os.urandom(5 * 1024 * 1024) + b'\r\n.\r\n'
+        path = self._file('book.pdf', content)
+        self.assertTrue(self._send(path))
+
+        attachment = email.message_from_bytes(self.server.messages[0][1]).get_payload()[1]
+        self.assertEqual(attachment['Content-Transfer-Encoding'], 'binary')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+
+    def test_auth_failure(self):
+        """测试密码错误时返回535"""
+        path = self._file('book.txt', b'hello')
+        with self.assertRaises(smtplib.SMTPAuthenticationError) as context:
+            self._send(path, password='wrong')
+        self.assertEqual(context.exception.smtp_code, 535)
+        self.assertEqual(self.server.message_count, 0)
+
+    def test_injected_error(self):
+        """测试按概率注入的错误响应"""
+        self.server.fail_rate = 1
+        self.server.fail_codes = (451,)
+        path = self._file('book.txt', b'hello')
+        with self.assertRaises(smtplib.SMTPDataError) as context:
+            self._send(path)
+        self.assertEqual(context.exception.smtp_code, 451)
+        self.assertEqual(self.server.injected_errors, 1)
+
+    def test_drop_then_reconnect(self):
+        """测试连接中途断开后，下一次发送重新建立连接"""
+        path = self._file('book.txt', os.urandom(100 * 1024))
+        self.server.drop_rate = 1
+        with self.assertRaises((smtplib.SMTPServerDisconnected, OSError)):
+            self._send(path)
+        self.assertEqual(self.server.drops, 1)
+
+        self.server.drop_rate = 0
+        self.assertTrue(self._send(path))
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.message_count, 1)
+
+    def test_bandwidth_limit(self):
+        """测试接收速率上限"""
+        self.server.bandwidth = 2 * 1024 * 1024
+        self.server.keep_messages = False
+        path = self._file('book.pdf', os.urandom(1024 * 1024))
+        start = time.monotonic()
+        self.assertTrue(self._send(path))
+        # base64 编码后约 1.35MB，按 2MB/秒 至少需要 0.6 秒
+        self.assertGreater(time.monotonic() - start, 0.6)
+        self.assertEqual(self.server.messages, [])
+        self.assertGreater(self.server.bytes_received, 1024 * 1024)
+
+
+class TestBenchmark(unittest.TestCase):
+    """测试吞吐量测试脚本"""
+
+    def test_percentile(self):
+        """测试最近秩百分位数"""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3.0], 95), 3.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_small_run(self):
+        """测试小规模运行并输出统计结果"""
+        results = run_benchmark([64 * 1024], messages=3, concurrency=2, fail_rate=0.5, seed=1)
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['messages'] + result['failed'], 3)
+        self.assertGreater(result['peak_rss_mb'], 0)
+        if result['messages']:
+            self.assertGreater(result['messages_per_second'], 0)
+            self.assertLessEqual(result['p50'], result['p99'])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
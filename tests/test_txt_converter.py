@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TXT转换器测试文件
+"""
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+from unittest.mock import patch
+
+# 添加项目根目录到系统路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.txt_converter import detect_encoding, is_chapter_heading, convert_txt_to_epub
+from app.utils.pdf_converter import ConversionCancelled
+
+
+class TestTxtConverter(unittest.TestCase):
+    """测试编码检测、章节识别和EPUB生成"""
+
+    def setUp(self):
+        """测试前的设置"""
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """测试后的清理"""
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def _file(self, name, text, encoding='utf-8'):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'w', encoding=encoding, newline='') as f:
+            f.write(text)
+        return path
+
+    def _chapters(self, epub_path):
+        """按书脊顺序返回各XHTML文件的 (标题, 段落列表)"""
+        ns = {'opf': 'http://www.idpf.org/2007/opf', 'x': 'http://www.w3.org/1999/xhtml'}
+        with zipfile.ZipFile(epub_path) as archive:
+            package = ET.fromstring(archive.read('OEBPS/content.opf'))
+            hrefs = {item.get('id'): item.get('href') for item in package.find('opf:manifest', ns)}
+            chapters = []
+            for itemref in package.find('opf:spine', ns):
+                body = ET.fromstring(archive.read('OEBPS/' + hrefs[itemref.get('idref')])).find('x:body', ns)
+                heading = body.find('x:h1', ns)
+                chapters.append((heading.text if heading is not None else None,
+                                 [p.text for p in body.findall('x:p', ns)]))
+            return chapters
+
+    def test_detect_encoding(self):
+        """测试识别UTF-8、带BOM的UTF-8和GBK，多字节字符跨块时不误判"""
+        text = '第一章 开始\n天下大势，分久必合，合久必分。\n' * 100
+        self.assertEqual(detect_encoding(self._file('utf8.txt', text)), 'utf-8')
+        self.assertEqual(detect_encoding(self._file('bom.txt', text, 'utf-8-sig')), 'utf-8-sig')
+        self.assertEqual(detect_encoding(self._file('gbk.txt', text, 'gbk')), 'gb18030')
+        self.assertEqual(detect_encoding(self._file('ascii.txt', 'plain text\n')), 'utf-8')
+        # 检测范围在字符中间截断
+        self.assertEqual(detect_encoding(self._file('cut.txt', text), max_bytes=1001), 'utf-8')
+
+    def test_chapter_heading(self):
+        """测试常见的中英文章节标题"""
+        for line in ('第一章 初入江湖', '第12回', '第一百二十三章　新的开始', '楔子：风起', '序章', '番外 一',
+                     'Chapter 1', 'CHAPTER XII The End', 'Chapter Twenty-One', 'Part II', 'Prologue'):
+            self.assertTrue(is_chapter_heading(line), line)
+        for line in ('第三章说的是一件小事', '序列号', 'Chapter and verse', 'Part did something',
+                     '这一行很长' * 10 + '第一章', ''):
+            self.assertFalse(is_chapter_heading(line), line)
+
+    def test_convert_gbk_novel(self):
+        """测试GBK小说按章节转换，目录只包含章节，特殊字符被转义"""
+        text = ('书名页的说明\r\n\r\n'
+                '第一章 开始\r\n　　第一段 <a> & "b"\r\n\r\n　　第二段\r\n'
+                '第二章 结束\r\n　　最后一段\x0c\r\n')
+        txt_path = self._file('小说.txt', text, 'gbk')
+
+        epub_path = convert_txt_to_epub(txt_path)
+        self.assertEqual(epub_path, os.path.join(self.test_dir, '小说.epub'))
+        with zipfile.ZipFile(epub_path) as archive:
+            first = archive.infolist()[0]
+            self.assertEqual((first.filename, first.compress_type), ('mimetype', zipfile.ZIP_STORED))
+            self.assertEqual(archive.read('mimetype'), b'application/epub+zip')
+            self.assertIn('小说', archive.read('OEBPS/content.opf').decode('utf-8'))
+            nav = archive.read('OEBPS/nav.xhtml').decode('utf-8')
+            self.assertIn('第一章 开始', nav)
+            self.assertNotIn('书名页', nav)
+
+        self.assertEqual(self._chapters(epub_path), [
+            (None, ['书名页的说明']),
+            ('第一章 开始', ['第一段 <a> & "b"', '第二段']),
+            ('第二章 结束', ['最后一段']),
+        ])
+        # 没有留下临时文件
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['小说.epub', '小说.txt'])
+
+    def test_convert_heading_heuristic(self):
+        """测试转换时只有像标题的行才开始新章节，正文中以章节词开头的句子和过长的行仍是段落"""
+        # 符合章节格式但超过标题长度的行
+        long_line = '第二章 ' + '他沿着河岸走了很远的路' * 4
+        text = f'第一章 开始\n第三章说的是一件小事\nChapter and verse\n{long_line}\nChapter 2\nEnd\n'
+        epub_path = convert_txt_to_epub(self._file('heuristic.txt', text))
+
+        self.assertEqual(self._chapters(epub_path), [
+            ('第一章 开始', ['第三章说的是一件小事', 'Chapter and verse', long_line]),
+            ('Chapter 2', ['End']),
+        ])
+
+    def test_long_chapter_split(self):
+        """测试过长的章节拆分成多个文件，续篇不进入目录"""
+        text = 'Chapter 1\n' + ''.join(f'Paragraph {i}\n' for i in range(200)) + 'Chapter 2\nEnd\n'
+        with patch('app.utils.txt_converter.MAX_CHAPTER_BYTES', 500), \
+                patch('app.utils.txt_converter.READ_BLOCK_CHARS', 100):
+            epub_path = convert_txt_to_epub(self._file('long.txt', text))
+
+        chapters = self._chapters(epub_path)
+        self.assertGreater(len(chapters), 3)
+        self.assertEqual([title for title, _ in chapters if title], ['Chapter 1', 'Chapter 2'])
+        paragraphs = [p for _, items in chapters for p in items]
+        self.assertEqual(paragraphs, [f'Paragraph {i}' for i in range(200)] + ['End'])
+
+    def test_no_chapters_and_output_dir(self):
+        """测试没有章节标题时整本书为一章，目录使用书名；可以指定输出目录"""
+        output_dir = os.path.join(self.test_dir, 'output')
+        epub_path = convert_txt_to_epub(self._file('notes.txt', 'just some text\n'), output_dir)
+        self.assertEqual(epub_path, os.path.join(output_dir, 'notes.epub'))
+        self.assertEqual(self._chapters(epub_path), [(None, ['just some text'])])
+        with zipfile.ZipFile(epub_path) as archive:
+            self.assertIn('notes', archive.read('OEBPS/toc.ncx').decode('utf-8'))
+
+        self.assertIsNone(convert_txt_to_epub(os.path.join(self.test_dir, 'missing.txt')))
+
+    def test_cancel(self):
+        """测试转换过程中取消时抛出 ConversionCancelled，不留下EPUB和临时文件"""
+        text = ''.join(f'Paragraph {i}\n' for i in range(200))
+        checks = []
+
+        def should_cancel():
+            checks.append(1)
+            return len(checks) > 2
+
+        with patch('app.utils.txt_converter.READ_BLOCK_CHARS', 100):
+            with self.assertRaises(ConversionCancelled):
+                convert_txt_to_epub(self._file('long.txt', text), should_cancel=should_cancel)
+        self.assertEqual(len(checks), 3)
+        self.assertEqual(os.listdir(self.test_dir), ['long.txt'])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)